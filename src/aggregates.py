@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, date, timedelta
+from money import to_ms, to_meters, euros_to_cents, cents_to_euros
+
+# =========================
+# Totales del historial por día y tipo
+# =========================
+# Cada (día 'AAAA-MM-DD', tipo) guarda enteros exactos (ver money.py):
+# viajes, céntimos, ms parado, ms en movimiento y metros.
+# Se actualizan al guardar cada lote de trayectos, así un resumen no tiene
+# que releer el historial: solo suma una fila por día, sin importar
+# cuántos trayectos haya.
+TOTAL_FIELDS = ('viajes', 'centimos', 'ms_parado', 'ms_movimiento', 'metros')
+
+
+def day_of(value):
+    """Día 'AAAA-MM-DD' de una fecha del historial (datetime, date o texto)."""
+    if isinstance(value, datetime):
+        return value.date().isoformat()
+    if isinstance(value, date):
+        return value.isoformat()
+    return value[:10]
+
+
+def add_trips(totals, trips):
+    '''
+    Suma trayectos (dicts como trip_info) a totals {(día, tipo): [viajes, céntimos, ...]}.
+    Devuelve totals.
+    '''
+    for trip in trips:
+        key = (day_of(trip['fecha']), trip['tipo'])
+        row = totals.get(key)
+        if row is None:
+            row = totals[key] = [0, 0, 0, 0, 0]
+        row[0] += 1
+        row[1] += euros_to_cents(trip['coste_total'])
+        row[2] += to_ms(trip.get('tiempo_parado') or 0.0)
+        row[3] += to_ms(trip.get('tiempo_movimiento') or 0.0)
+        row[4] += to_meters(trip.get('distancia_total') or 0.0)
+    return totals
+
+
+def day_range(start=None, end=None):
+    """Límites de día [desde, hasta) para filtrar filas; end exclusivo salvo que tenga hora."""
+    lo = None if start is None else day_of(start)
+    hi = None
+    if end is not None:
+        hi = day_of(end)
+        if isinstance(end, datetime) and end.time() != datetime.min.time():
+            # El día de end ya ha empezado: se incluye completo
+            hi = (date.fromisoformat(hi) + timedelta(days=1)).isoformat()
+    return lo, hi
+
+
+def summarize(rows):
+    '''
+    Convierte filas (día, tipo, viajes, céntimos, ms, ms, metros) en un resumen
+    con las unidades del historial (euros, segundos, km).
+    '''
+    sums = [0, 0, 0, 0, 0]
+    for row in rows:
+        for k, value in enumerate(row[2:]):
+            sums[k] += value
+    count, cents, ms_stopped, ms_moving, meters = sums
+    return {
+        'viajes': count,
+        'coste_total': cents_to_euros(cents),
+        'tiempo_parado': ms_stopped / 1000,
+        'tiempo_movimiento': ms_moving / 1000,
+        'distancia_total': meters / 1000,
+    }
+
+
+def compare(stored, fresh):
+    '''
+    Diferencias entre dos totales {(día, tipo): valores}.
+    Devuelve una lista ordenada de (día, tipo, guardado, recalculado).
+    '''
+    keys = sorted(set(stored) | set(fresh))
+    return [(day, tipo, stored.get((day, tipo)), fresh.get((day, tipo)))
+            for day, tipo in keys if list(stored.get((day, tipo)) or []) != list(fresh.get((day, tipo)) or [])]
+
+
+# =========================
+# Totales del backend de texto (historial.txt.sum)
+# =========================
+class SummaryFile:
+    """
+    Totales del historial de texto guardados junto a él, en JSON.
+    TextBackend los pone al día con cada lote que escribe y los guarda de
+    forma atómica al sincronizar (salvo con durabilidad 'none') o al
+    cerrar; 'trayectos' dice cuántas entradas del índice lateral incluyen,
+    así tras una caída (o lo escrito por otros procesos) solo se suman las
+    que falten.
+    """
+
+    def __init__(self, history_path):
+        self.path = history_path + '.sum'
+        self.covered = 0
+        self.totals = {}
+        self.dirty = False
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                self.covered = data['trayectos']
+                self.totals = {(row[0], row[1]): row[2:] for row in data['totales']}
+            except (OSError, ValueError, KeyError, IndexError, TypeError):
+                # Archivo dañado: catch_up lo reconstruye
+                self.covered, self.totals = -1, {}
+
+    def add(self, trips):
+        add_trips(self.totals, trips)
+        self.covered += len(trips)
+        self.dirty = True
+
+    def catch_up(self, reader):
+        """Suma los trayectos del historial que aún no están en los totales (reader: MappedHistory)."""
+        n = len(reader)
+        if self.covered == n:
+            return
+        if not 0 <= self.covered < n:
+            self.replace({}, 0)
+        step = 10_000
+        for first in range(self.covered, n, step):
+            self.add(reader.records_range(first, first + step))
+
+    def replace(self, totals, covered):
+        self.totals, self.covered = totals, covered
+        self.dirty = True
+
+    def rows(self, start=None, end=None, tipo=None):
+        lo, hi = day_range(start, end)
+        return [(day, kind, *values) for (day, kind), values in sorted(self.totals.items())
+                if (lo is None or day >= lo) and (hi is None or day < hi) and (tipo is None or kind == tipo)]
+
+    def save(self):
+        if not self.dirty:
+            return
+        data = {'trayectos': self.covered, 'totales': [[*key, *values] for key, values in sorted(self.totals.items())]}
+        # Un temporal por proceso: varios procesos pueden guardar a la vez (gana el último)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+# =========================
+# Reconstrucción y verificación
+# =========================
+def rebuild(backend, check_only=False, out=sys.stderr):
+    '''
+    Recalcula los totales del backend desde cero y los compara con los guardados.
+    Informa de cada diferencia y, salvo con check_only, guarda los recalculados.
+    Devuelve la lista de diferencias (vacía si coinciden).
+    '''
+    differences = backend.rebuild_summary(check_only)
+    for day, tipo, stored, fresh in differences:
+        print(f"{day} {tipo}: guardado {stored}, recalculado {fresh}", file=out)
+    if differences:
+        action = "sin cambios (solo verificación)" if check_only else "totales reemplazados"
+        print(f"{len(differences)} días con diferencias; {action}", file=out)
+    else:
+        print("Los totales coinciden con el historial", file=out)
+    return differences
+
+
+def main(argv=None):
+    # history importa storage, que usa este módulo: se importa aquí para evitar el ciclo
+    from history import BACKENDS, open_backend
+    parser = argparse.ArgumentParser(
+        description="Recalcula los totales por día y tipo del historial y verifica que coinciden.")
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help="backend del historial (por defecto el de HISTORY_BACKEND en .env)")
+    parser.add_argument('--dest', help="ruta del historial (por defecto la del backend)")
+    parser.add_argument('--check', action='store_true', help="solo verifica, no reemplaza los totales")
+    args = parser.parse_args(argv)
+
+    backend = open_backend(args.backend, args.dest)
+    try:
+        differences = rebuild(backend, args.check)
+    finally:
+        backend.close()
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
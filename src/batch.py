@@ -0,0 +1,337 @@
+import sys
+import csv
+import json
+import argparse
+from datetime import datetime
+from itertools import islice
+import numpy as np
+from config import current_tariff
+from fares import calculate_time_fares_cents, calculate_distance_fares_cents, _time_fits, _distance_fits
+from fleet import FleetManager
+from schedule import schedule_for, local_seconds
+
+# =========================
+# Modo sin interfaz: precios por lotes
+# =========================
+# Entrada "trips": un viaje ya terminado por registro
+TRIP_FIELDS = ('id', 'tipo', 'tiempo_parado', 'tiempo_movimiento', 'distancia_total', 'inicio')
+TRIP_OUTPUT = ('id', 'tipo', 'coste_total', 'error')
+# Entrada "events": los comandos del taxímetro, en orden de llegada
+EVENT_FIELDS = ('id', 'instante', 'evento', 'valor')
+EVENT_OUTPUT = ('id', 'tipo', 'tiempo_parado', 'tiempo_movimiento', 'distancia_total', 'coste_total', 'error')
+EVENTS = ('start', 'stop', 'move', 'distance', 'finish')
+
+CHUNK_SIZE = 10_000
+
+
+# =========================
+# Lectura (CSV o JSONL) por bloques
+# =========================
+# Cada bloque es (columnas, errores): una tupla por campo pedido, con un
+# valor por registro (None si falta), y {posición: motivo} de los registros
+# que no se pudieron leer.
+
+def _csv_chunks(stream, fields, size):
+    """Bloques de un CSV con cabecera. Las columnas se separan con zip, sin bucles por fila."""
+    reader = csv.reader(stream)
+    header = next(reader, None)
+    if header is None:
+        return
+    width = len(header)
+    indices = [header.index(name) if name in header else None for name in fields]
+    while rows := list(islice(reader, size)):
+        errors = {}
+        # Comprobación rápida (en C); solo si hay filas irregulares se recorren una a una
+        if set(map(len, rows)) != {width}:
+            # Las líneas en blanco no son registros
+            rows = [row for row in rows if row]
+            if not rows:
+                continue
+            for i, row in enumerate(rows):
+                if len(row) != width:
+                    errors[i] = f"se esperaban {width} columnas y hay {len(row)}"
+                    rows[i] = [''] * width
+        columns = list(zip(*rows))
+        yield tuple(columns[i] if i is not None else (None,) * len(rows) for i in indices), errors
+
+
+def _jsonl_chunks(stream, fields, size):
+    """Bloques de un archivo JSONL (un objeto por línea; las líneas en blanco se saltan)."""
+    while lines := list(islice(stream, size)):
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            continue
+        records = []
+        errors = {}
+        for i, line in enumerate(lines):
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError("se esperaba un objeto")
+            except ValueError as e:
+                errors[i] = f"JSON no válido ({e})"
+                record = {}
+            records.append(tuple(record.get(name) for name in fields))
+        yield tuple(zip(*records)), errors
+
+
+def _floats(values, errors, name):
+    """
+    Convierte una columna a float64 de una vez (None y '' pasan a NaN);
+    si hay valores no numéricos cae a la conversión uno a uno y anota
+    el error de cada registro.
+    """
+    try:
+        return np.array(values, dtype=np.float64)
+    except (ValueError, TypeError):
+        pass
+    try:
+        return np.array([v if v not in (None, '') else 'nan' for v in values], dtype=np.float64)
+    except (ValueError, TypeError):
+        pass
+    result = np.full(len(values), np.nan)
+    for i, value in enumerate(values):
+        if value is None or value == '':
+            continue
+        try:
+            result[i] = float(value)
+        except (ValueError, TypeError):
+            errors.setdefault(i, f"{name} no es numérico: {value!r}")
+    return result
+
+
+def _start_seconds(value):
+    """'inicio' (fecha ISO o timestamp epoch) -> segundos locales."""
+    try:
+        return local_seconds(float(value))
+    except (ValueError, TypeError):
+        return local_seconds(datetime.fromisoformat(value))
+
+
+# =========================
+# Viajes terminados
+# =========================
+def price_trips(columns, errors, tariff):
+    '''
+    Calcula la tarifa de un bloque de viajes (columnas en el orden de TRIP_FIELDS)
+    con operaciones vectorizadas.
+    Devuelve (filas de salida en el orden de TRIP_OUTPUT, errores {posición: motivo});
+    los registros con errores llevan el motivo y ningún coste.
+    '''
+    ids, tipos, stopped, moving, distance, starts = columns
+    n = len(ids)
+    tipos = np.array([t if isinstance(t, str) else '' for t in tipos])
+    is_time = tipos == 'tiempo'
+    is_distance = tipos == 'distancia'
+    # Variantes con mayúsculas o espacios (poco habituales): se normalizan una a una
+    for i in np.flatnonzero(~is_time & ~is_distance).tolist():
+        tipos[i] = tipos[i].strip().lower()
+        is_time[i], is_distance[i] = tipos[i] == 'tiempo', tipos[i] == 'distancia'
+
+    stopped = _floats(stopped, errors, 'tiempo_parado')
+    moving = _floats(moving, errors, 'tiempo_movimiento')
+    distance = _floats(distance, errors, 'distancia_total')
+    for i in np.flatnonzero(~is_time & ~is_distance).tolist():
+        errors.setdefault(i, f"tipo desconocido: {str(tipos[i])!r}")
+    # NaN no cumple ninguna comparación; inf sí, por eso se pide isfinite
+    for i in np.flatnonzero(is_time & ~((stopped >= 0) & (moving >= 0) & np.isfinite(stopped + moving))).tolist():
+        errors.setdefault(i, "los tiempos deben ser números finitos no negativos")
+    for i in np.flatnonzero(is_distance & ~((distance > 0) & np.isfinite(distance))).tolist():
+        errors.setdefault(i, "la distancia debe ser un número finito mayor que 0")
+    for i in np.flatnonzero(is_time & ~_time_fits(stopped, moving, tariff.stopped_micros, tariff.moving_micros)).tolist():
+        errors.setdefault(i, "los tiempos son demasiado grandes")
+
+    # Franja de inicio de los viajes por distancia (solo si la tarifa tiene franjas)
+    dated = np.zeros(n, dtype=bool)
+    start_seconds = np.zeros(n)
+    if tariff.bands:
+        for i in np.flatnonzero(is_distance).tolist():
+            if starts[i] in (None, ''):
+                continue
+            try:
+                start_seconds[i] = _start_seconds(starts[i])
+                dated[i] = True
+            except (ValueError, TypeError):
+                errors.setdefault(i, f"inicio no es una fecha válida: {starts[i]!r}")
+    base_micros = np.full(n, tariff.base_micros, dtype=np.int64)
+    km_micros = np.full(n, tariff.km_micros, dtype=np.int64)
+    if dated.any():
+        rates = schedule_for(tariff).rates_at(start_seconds[dated])
+        base_micros[dated], km_micros[dated] = rates[:, 2], rates[:, 3]
+    for i in np.flatnonzero(is_distance & ~_distance_fits(distance, base_micros, km_micros)).tolist():
+        errors.setdefault(i, "la distancia es demasiado grande")
+
+    valid = np.ones(n, dtype=bool)
+    valid[list(errors)] = False
+    cents = np.zeros(n, dtype=np.int64)
+    use = valid & is_time
+    cents[use] = calculate_time_fares_cents(stopped[use], moving[use], tariff)
+    use = valid & is_distance & dated
+    cents[use] = calculate_distance_fares_cents(distance[use], tariff, start_seconds[use])
+    use = valid & is_distance & ~dated
+    cents[use] = calculate_distance_fares_cents(distance[use], tariff)
+
+    # c / 100 con dos decimales es exacto (no hay error de redondeo a ese nivel)
+    costs = [f"{c / 100:.2f}" for c in cents.tolist()]
+    messages = [''] * n
+    for i, message in errors.items():
+        costs[i] = ''
+        messages[i] = message
+    return list(zip(ids, tipos.tolist(), costs, messages)), errors
+
+
+# =========================
+# Flujo de eventos
+# =========================
+class EventPricer:
+    '''
+    Aplica eventos del taxímetro (start, stop, move, distance, finish)
+    a un FleetManager y devuelve una fila (EVENT_OUTPUT) por viaje
+    terminado o por evento con errores.
+    Los viajes con distance se cobran por distancia (tipo 'distancia'),
+    los demás por tiempo.
+    instante son segundos (timestamp epoch) o una fecha ISO.
+    '''
+
+    def __init__(self, tariff):
+        self.tariff = tariff
+        self.now = 0.0
+        self.fleet = FleetManager(clock=lambda: self.now, wall_clock=lambda: self.now)
+
+    def feed(self, columns, errors):
+        '''Procesa un bloque (columnas en el orden de EVENT_FIELDS). Devuelve (filas, errores).'''
+        rows = []
+        found = {}
+        for position, (trip_id, instant, event, value) in enumerate(zip(*columns)):
+            message = errors.get(position)
+            if message is None:
+                try:
+                    row = self._apply(trip_id, instant, event, value)
+                except (ValueError, TypeError, KeyError, RuntimeError) as e:
+                    message = e.args[0] if isinstance(e, KeyError) and e.args else str(e)
+                else:
+                    if row is not None:
+                        rows.append(row)
+                    continue
+            found[position] = message
+            rows.append((trip_id, '', '', '', '', '', message))
+        return rows, found
+
+    def _apply(self, trip_id, instant, event, value):
+        if trip_id is None or trip_id == '':
+            raise ValueError("falta el id del viaje")
+        event = (event or '').strip().lower()
+        if event not in EVENTS:
+            raise ValueError(f"evento desconocido: {event!r}")
+        try:
+            self.now = float(instant)
+        except (ValueError, TypeError):
+            self.now = datetime.fromisoformat(instant).timestamp()
+        if event == 'start':
+            self.fleet.start(trip_id, self.now, self.tariff)
+        elif event == 'stop':
+            self.fleet.stop(trip_id, self.now)
+        elif event == 'move':
+            self.fleet.move(trip_id, self.now)
+        elif event == 'distance':
+            km = float(value)
+            if not np.isfinite(km):
+                raise ValueError(f"la distancia debe ser un número finito: {value!r}")
+            self.fleet.add_distance(trip_id, km)
+        else:
+            distance_fare = self.fleet.distance_fare(trip_id)  # antes de liberar la fila
+            stopped, moving, distance, fare = self.fleet.finish(trip_id, self.now)
+            tipo = 'distancia' if distance > 0 else 'tiempo'
+            return (trip_id, tipo, round(stopped, 2), round(moving, 2), round(distance, 3),
+                    f"{distance_fare if distance > 0 else fare:.2f}", '')
+        return None
+
+    def close(self):
+        '''Filas de error de los viajes que quedaron sin finalizar.'''
+        return [(trip_id, '', '', '', '', '', "viaje sin finalizar") for trip_id in list(self.fleet.slots)]
+
+
+# =========================
+# Escritura
+# =========================
+def _writer(stream, fmt, fields):
+    if fmt == 'csv':
+        writer = csv.writer(stream, lineterminator='\n')
+        writer.writerow(fields)
+        return writer.writerows
+
+    def write(rows):
+        stream.write("".join(json.dumps(dict(zip(fields, row)), ensure_ascii=False) + "\n" for row in rows))
+    return write
+
+
+def run(sources, mode='trips', fmt=None, out_fmt=None, out=sys.stdout, err=sys.stderr,
+        chunk_size=CHUNK_SIZE, tariff=None):
+    '''
+    Calcula las tarifas de uno o varios archivos (o stdin si sources está
+    vacío o es '-') y escribe los resultados en out a medida que avanza,
+    bloque a bloque, con memoria acotada.
+    Los errores de cada registro se escriben en la columna error y en err.
+    Devuelve (registros de salida, registros con errores).
+    '''
+    tariff = tariff or current_tariff()
+    fields, output = (TRIP_FIELDS, TRIP_OUTPUT) if mode == 'trips' else (EVENT_FIELDS, EVENT_OUTPUT)
+    pricer = EventPricer(tariff) if mode == 'events' else None
+    write = None
+    written = errors = 0
+
+    def emit(rows, found, first):
+        nonlocal written, errors
+        for position, message in sorted(found.items()):
+            print(f"{name}: registro {first + position + 1}: {message}", file=err)
+        errors += len(found)
+        write(rows)
+        written += len(rows)
+
+    for name in sources or ['-']:
+        source_fmt = fmt or ('jsonl' if name.endswith(('.jsonl', '.json')) else 'csv')
+        if write is None:
+            write = _writer(out, out_fmt or source_fmt, output)
+        stream = sys.stdin if name == '-' else open(name, 'r', encoding='utf-8', newline='')
+        try:
+            first = 0
+            chunks = (_csv_chunks if source_fmt == 'csv' else _jsonl_chunks)(stream, fields, chunk_size)
+            for columns, found in chunks:
+                if pricer is None:
+                    emit(*price_trips(columns, found, tariff), first)
+                else:
+                    emit(*pricer.feed(columns, found), first)
+                first += len(columns[0]) if columns else 0
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+    if pricer is not None:
+        unfinished = pricer.close()
+        for row in unfinished:
+            print(f"id {row[0]}: {row[-1]}", file=err)
+        errors += len(unfinished)
+        write(unfinished)
+        written += len(unfinished)
+    out.flush()
+    return written, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='main.py', description="Calcula tarifas por lotes desde CSV o JSONL (archivos o stdin).")
+    parser.add_argument('sources', nargs='*', help="archivos de entrada ('-' o nada para stdin)")
+    parser.add_argument('--mode', choices=('trips', 'events'), default='trips',
+                        help="trips: un viaje terminado por registro; events: comandos del taxímetro")
+    parser.add_argument('--format', choices=('csv', 'jsonl'),
+                        help="formato de entrada (por defecto según la extensión, o csv)")
+    parser.add_argument('--output-format', choices=('csv', 'jsonl'),
+                        help="formato de salida (por defecto el de la entrada)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="registros por bloque")
+    args = parser.parse_args(argv)
+
+    _, errors = run(args.sources, args.mode, args.format, args.output_format, chunk_size=args.chunk_size)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
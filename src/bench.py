@@ -0,0 +1,311 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+import numpy as np
+from config import Tariff
+from fares import calculate_time_fare, calculate_distance_fare, calculate_time_fares_cents
+import history
+from history import save_history, read_history, close_history
+from storage import TextBackend, SQLiteBackend
+from writer import HistoryWriter
+
+# =========================
+# Benchmarks de los caminos calientes
+# =========================
+# Escenarios reproducibles (semilla fija, tarifa fija) de las tarifas, la
+# escritura y lectura del historial y el arranque de main.py.
+# El resultado es un JSON; con --baseline se compara con uno anterior y el
+# código de salida es 1 si algún resultado empeora más que la tolerancia.
+
+SIZES = {'10k': 10_000, '100k': 100_000, '1m': 1_000_000, '10m': 10_000_000}
+BACKEND_CLASSES = {'text': (TextBackend, 'historial.txt'), 'sqlite': (SQLiteBackend, 'historial.db')}
+SCENARIOS = ('fares', 'history_write', 'history_read', 'startup')
+TARIFF = Tariff(base_fare=1.5, price_per_km=0.25, stopped_fare=0.02, moving_fare=0.05)
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+DEFAULT_TOLERANCE = 0.10
+
+
+# =========================
+# Datos sintéticos
+# =========================
+def synthetic_trips(n, seed=42, start=datetime(2024, 1, 1)):
+    '''
+    Generador de n trayectos realistas y siempre iguales para la misma semilla
+    (mitad por tiempo, mitad por distancia, unas 700 al día).
+    '''
+    rng = random.Random(seed)
+    fecha = start
+    for _ in range(n):
+        fecha += timedelta(seconds=rng.randint(1, 240))
+        if rng.random() < 0.5:
+            stopped = round(rng.expovariate(1 / 120), 1)
+            moving = round(rng.expovariate(1 / 600), 1)
+            yield {'fecha': fecha, 'tipo': 'tiempo', 'tiempo_parado': stopped, 'tiempo_movimiento': moving,
+                   'duracion_total': round(stopped + moving, 1),
+                   'coste_total': calculate_time_fare(stopped, moving, TARIFF)}
+        else:
+            distance = round(rng.expovariate(1 / 6) + 0.1, 2)
+            yield {'fecha': fecha, 'tipo': 'distancia', 'distancia_total': distance,
+                   'coste_total': calculate_distance_fare(distance, TARIFF)}
+
+
+def history_file(data_dir, backend, n, seed=42):
+    '''
+    Ruta de un historial sintético de n trayectos para el backend indicado.
+    Se genera la primera vez (por lotes) y se reutiliza en las siguientes.
+    '''
+    backend_class, name = BACKEND_CLASSES[backend]
+    directory = os.path.join(data_dir, f"{backend}-{n}-{seed}")
+    path = os.path.join(directory, name)
+    done = os.path.join(directory, 'completo')
+    if os.path.exists(done):
+        return path
+    shutil.rmtree(directory, ignore_errors=True)
+    os.makedirs(directory)
+    store = backend_class(path)
+    store.set_durability('none')
+    batch = []
+    for trip in synthetic_trips(n, seed):
+        batch.append(trip)
+        if len(batch) == 100_000:
+            store.append_many(batch)
+            batch = []
+    if batch:
+        store.append_many(batch)
+    store.close()
+    open(done, 'w').close()
+    return path
+
+
+# =========================
+# Medición
+# =========================
+def _rate(name, operations, seconds, unit='ops/s'):
+    """Resultado de rendimiento (más es mejor) a partir de los tiempos de varias repeticiones."""
+    rates = [operations / s for s in seconds]
+    return name, {'value': max(rates), 'median': float(np.median(rates)), 'unit': unit,
+                  'better': 'higher', 'samples': rates}
+
+
+def _latency(name, seconds):
+    """Resultados de latencia (menos es mejor): p50 y p99 en milisegundos."""
+    ms = np.array(seconds) * 1000
+    return [(f"{name}.p50_ms", {'value': float(np.percentile(ms, 50)), 'unit': 'ms', 'better': 'lower'}),
+            (f"{name}.p99_ms", {'value': float(np.percentile(ms, 99)), 'unit': 'ms', 'better': 'lower'})]
+
+
+def _timed(function, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+# =========================
+# Escenarios
+# =========================
+def bench_fares(repeat=5, calls=100_000, batch=1_000_000):
+    rng = random.Random(1)
+    stopped = [rng.random() * 600 for _ in range(calls)]
+    moving = [rng.random() * 900 for _ in range(calls)]
+    distances = [rng.random() * 30 + 0.1 for _ in range(calls)]
+
+    def time_fares():
+        for s, m in zip(stopped, moving):
+            calculate_time_fare(s, m, TARIFF)
+
+    def distance_fares():
+        for d in distances:
+            calculate_distance_fare(d, TARIFF)
+
+    array_stopped = np.random.default_rng(1).random(batch) * 600
+    array_moving = np.random.default_rng(2).random(batch) * 900
+    yield _rate('fares.calculate_time_fare', calls, _timed(time_fares, repeat))
+    yield _rate('fares.calculate_distance_fare', calls, _timed(distance_fares, repeat))
+    yield _rate('fares.calculate_time_fares_cents', batch,
+                _timed(lambda: calculate_time_fares_cents(array_stopped, array_moving, TARIFF), repeat), 'viajes/s')
+
+
+def bench_history_write(n, backends, repeat=1):
+    '''save_history con el escritor en segundo plano (configuración por defecto), trayecto a trayecto.'''
+    trips = list(synthetic_trips(n))
+    for backend in backends:
+        backend_class, name = BACKEND_CLASSES[backend]
+        times = []
+        for _ in range(repeat):
+            directory = tempfile.mkdtemp(prefix='bench-')
+            try:
+                store = backend_class(os.path.join(directory, name))
+                history.set_backend(store, HistoryWriter(store, 100, 0.5, 'flush'))
+                start = time.perf_counter()
+                for trip in trips:
+                    save_history(trip)
+                close_history()
+                times.append(time.perf_counter() - start)
+            finally:
+                shutil.rmtree(directory, ignore_errors=True)
+        yield _rate(f"history_write.{backend}.{n}", n, times, 'viajes/s')
+
+
+def bench_history_read(n, backends, data_dir, repeat=20):
+    '''Latencia de las consultas habituales sobre un historial de n trayectos.'''
+    rng = random.Random(7)
+    for backend in backends:
+        backend_class, _ = BACKEND_CLASSES[backend]
+        store = backend_class(history_file(data_dir, backend, n))
+        history.set_backend(store)
+        try:
+            first = store.query(limit=1)[0]['fecha']
+            last = store.query(limit=1, descending=True)[0]['fecha']
+            days = (last - first).days + 1
+
+            def one_day():
+                day = datetime.combine(first.date(), datetime.min.time()) + timedelta(days=rng.randrange(days))
+                store.query(start=day, end=day + timedelta(days=1))
+
+            prefix = f"history_read.{backend}.{n}"
+            scenarios = {
+                'first_page': lambda: store.query(descending=True, limit=200),
+                'one_day': one_day,
+                'count': store.count,
+                'revenue': store.revenue,
+                'summary': store.summary,
+            }
+            if n <= 100_000:
+                # read_history devuelve todo el texto: solo tiene sentido en historiales pequeños
+                scenarios['read_history'] = read_history
+            for name, function in scenarios.items():
+                function()  # calentamiento (cachés del sistema y de SQLite)
+                yield from _latency(f"{prefix}.{name}", _timed(function, repeat))
+        finally:
+            close_history()
+
+
+def bench_startup(repeat=5):
+    '''Arranque del intérprete con main.py: modo por lotes (--help) y modo interactivo (en + exit).'''
+    directory = tempfile.mkdtemp(prefix='bench-')
+    try:
+        for name, args, text in (('batch_help', ['--help'], ''), ('interactive', [], 'en\nexit\n')):
+            def run():
+                subprocess.run([sys.executable, MAIN, *args], input=text, cwd=directory,
+                               capture_output=True, text=True, check=True, timeout=60)
+            run()  # calentamiento (.env, bytecode)
+            yield from _latency(f"startup.{name}", _timed(run, repeat))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def run_benchmarks(scenarios=SCENARIOS, sizes=('10k',), backends=tuple(BACKEND_CLASSES),
+                   data_dir=None, repeat=5, out=sys.stderr):
+    '''
+    Ejecuta los escenarios y devuelve {'meta': {...}, 'results': {nombre: resultado}}.
+    data_dir guarda los historiales sintéticos entre ejecuciones.
+    '''
+    data_dir = data_dir or os.path.join(tempfile.gettempdir(), 'taximetro-bench')
+    results = {}
+
+    def collect(items):
+        for name, result in items:
+            results[name] = result
+            print(f"{name}: {result['value']:.4g} {result['unit']}", file=out)
+
+    if 'fares' in scenarios:
+        collect(bench_fares(repeat))
+    for size in sizes:
+        n = SIZES[size] if size in SIZES else int(size)
+        if 'history_write' in scenarios:
+            collect(bench_history_write(n, backends))
+        if 'history_read' in scenarios:
+            collect(bench_history_read(n, backends, data_dir, max(repeat, 20)))
+    if 'startup' in scenarios:
+        collect(bench_startup(repeat))
+    return {'meta': _meta(), 'results': results}
+
+
+def _meta():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(MAIN)).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'fecha': datetime.now().isoformat(timespec='seconds'),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+# =========================
+# Comparación con una línea base
+# =========================
+def compare(current, baseline, tolerance=DEFAULT_TOLERANCE):
+    '''
+    Compara dos resultados de run_benchmarks.
+    Devuelve [(nombre, valor base, valor actual, cambio relativo, ¿regresión?)]
+    para los resultados presentes en ambos. El cambio es positivo si mejora.
+    '''
+    rows = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None or not base['value']:
+            continue
+        change = result['value'] / base['value'] - 1
+        if result['better'] == 'lower':
+            change = base['value'] / result['value'] - 1 if result['value'] else float('inf')
+        rows.append((name, base['value'], result['value'], change, change < -tolerance))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks de tarifas, historial y arranque.")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS,
+                        help="escenario a ejecutar (se puede repetir; por defecto todos)")
+    parser.add_argument('--size', action='append',
+                        help=f"trayectos del historial: {', '.join(SIZES)} o un número (por defecto 10k)")
+    parser.add_argument('--backend', action='append', choices=sorted(BACKEND_CLASSES),
+                        help="backend del historial (por defecto ambos)")
+    parser.add_argument('--repeat', type=int, default=5, help="repeticiones de cada medida")
+    parser.add_argument('--data-dir', help="directorio de los historiales sintéticos (se reutilizan)")
+    parser.add_argument('--output', help="archivo JSON de resultados (por defecto la salida estándar)")
+    parser.add_argument('--baseline', help="JSON de una ejecución anterior con el que comparar")
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE,
+                        help="empeoramiento relativo permitido antes de marcar regresión (0.10 = 10%%)")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.scenario or SCENARIOS, args.size or ['10k'],
+                            args.backend or tuple(BACKEND_CLASSES), args.data_dir, args.repeat)
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    if not args.baseline:
+        return 0
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)
+    rows = compare(report, baseline, args.tolerance)
+    for name, base, value, change, regression in rows:
+        mark = "REGRESIÓN" if regression else "ok"
+        print(f"{mark:9} {name}: {base:.4g} -> {value:.4g} ({change:+.1%})", file=sys.stderr)
+    regressions = sum(1 for row in rows if row[-1])
+    print(f"{regressions} regresiones de {len(rows)} resultados comparados", file=sys.stderr)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
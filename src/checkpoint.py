@@ -0,0 +1,234 @@
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+import threading
+from config import Tariff, current_tariff
+from meter import STOPPED, MOVING
+
+# =========================
+# Formato del checkpoint
+# =========================
+# Estado del viaje en el registro (0 = sin viaje)
+STATE_CODES = {STOPPED: 1, MOVING: 2}
+FINISHED = 3   # terminado, pendiente de llegar al historial
+
+# Registro de ancho fijo: el viaje en curso, con las horas en tiempo real (epoch),
+# porque el reloj monotónico del medidor no sobrevive a un reinicio
+RECORD = struct.Struct(
+    '<Q'       # seq: número de escritura (el registro válido más reciente gana)
+    'Q'        # trip
+    'B'        # active
+    'B'        # state (STATE_CODES o FINISHED)
+    '6x'
+    'd'        # state_since: inicio del tramo actual
+    'd'        # saved_at: última escritura (el viaje seguía vivo a esa hora)
+    'd'        # stopped_time de los tramos cerrados
+    'd'        # moving_time de los tramos cerrados
+    'q'        # cost: nano-euros de los tramos cerrados (solo con franjas)
+    'q'        # versión de la tarifa
+    'qqqq'     # tarifas en micro-euros (base, km, parado, en movimiento)
+)
+CRC = struct.Struct('<I')
+SLOT_SIZE = 128
+SLOTS = 2      # se alterna entre dos copias: una escritura cortada no pisa la anterior
+FILE_SIZE = SLOT_SIZE * SLOTS
+
+
+class TripCheckpoint:
+    '''
+    Copia del viaje en curso en un pequeño fichero mapeado en memoria, para
+    retomarlo si el proceso muere a mitad de viaje (ver recover).
+    save() se llama en cada transición del TripMeter y touch() periódicamente
+    (cada tick de la GUI o desde start_heartbeat en la CLI).
+    Escribir es copiar unos 100 bytes en la memoria mapeada: no hay llamadas
+    al sistema ni fsync, el sistema operativo vuelca la página por su cuenta.
+    Sobrevive a la caída del proceso; ante un corte de luz se pierden, como
+    mucho, los últimos segundos que el sistema no hubiera volcado.
+    Cada escritura va a la copia más antigua con su CRC, así una escritura
+    cortada deja intacta la anterior.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, 'a+b')
+        if os.fstat(self.file.fileno()).st_size != FILE_SIZE:
+            self.file.truncate(FILE_SIZE)
+        self.map = mmap.mmap(self.file.fileno(), FILE_SIZE)
+        self.lock = threading.Lock()
+        self.heartbeat = None
+        last = self._read()
+        self.seq = last[0] if last else 0
+        self.fields = list(last) if last else None
+
+    def _read(self):
+        """Devuelve los campos de la copia válida más reciente, o None."""
+        best = None
+        for slot in range(SLOTS):
+            offset = slot * SLOT_SIZE
+            data = self.map[offset:offset + RECORD.size]
+            (crc,) = CRC.unpack_from(self.map, offset + RECORD.size)
+            if zlib.crc32(data) != crc:
+                continue
+            fields = RECORD.unpack(data)
+            if fields[0] and (best is None or fields[0] > best[0]):
+                best = fields
+        return best
+
+    def _write(self, fields):
+        """Escribe fields en la copia más antigua (con el lock tomado)."""
+        self.seq += 1
+        fields[0] = self.seq
+        data = RECORD.pack(*fields)
+        offset = (self.seq % SLOTS) * SLOT_SIZE
+        self.map[offset:offset + RECORD.size + CRC.size] = data + CRC.pack(zlib.crc32(data))
+        self.fields = fields
+
+    def save(self, meter, now, finished=False):
+        '''
+        Guarda el estado de meter en el instante now (reloj del medidor).
+        Con finished=True, los tiempos ya son los finales del viaje.
+        '''
+        wall = meter.wall_clock()
+        tariff = meter.tariff
+        fields = [0, meter.trip_id, 1, FINISHED if finished else STATE_CODES[meter.state],
+                  wall - (now - meter.state_start), wall,
+                  meter.stopped_time, meter.moving_time, meter.cost, tariff.version,
+                  tariff.base_micros, tariff.km_micros, tariff.stopped_micros, tariff.moving_micros]
+        with self.lock:
+            self._write(fields)
+
+    def touch(self, wall=None):
+        '''Marca que el viaje sigue en curso a la hora wall (ahora por defecto); no lee el medidor.'''
+        with self.lock:
+            if self.fields is not None and self.fields[2] and self.fields[3] != FINISHED:
+                fields = list(self.fields)
+                fields[5] = time.time() if wall is None else wall
+                self._write(fields)
+
+    def clear(self, finished_only=False):
+        '''
+        Borra el viaje del checkpoint. Con finished_only=True solo si ya había
+        terminado (así no se borra un viaje nuevo que haya empezado después).
+        '''
+        with self.lock:
+            if self.map.closed or self.fields is None or not self.fields[2]:
+                return
+            if finished_only and self.fields[3] != FINISHED:
+                return
+            fields = list(self.fields)
+            fields[2] = 0
+            self._write(fields)
+
+    def release(self, future=None):
+        '''
+        Borra el viaje terminado cuando future (el de history.save_history)
+        se completa sin error; sin future, en el acto.
+        '''
+        if future is None:
+            self.clear(finished_only=True)
+        else:
+            future.add_done_callback(
+                lambda done: done.exception() is None and self.clear(finished_only=True))
+
+    def load(self):
+        '''
+        Devuelve el viaje interrumpido (un dict) o None si no lo hay.
+        Si la tarifa ha cambiado desde entonces, se reconstruye la del viaje
+        a partir de sus importes (sin franjas horarias).
+        '''
+        with self.lock:
+            fields = self.fields
+        if fields is None or not fields[2]:
+            return None
+        (_, trip, _, state, state_since, saved_at, stopped, moving, cost, version,
+         base, per_km, stopped_rate, moving_rate) = fields
+        tariff = current_tariff()
+        if tariff.version != version:
+            tariff = Tariff(base_fare=base / 1e6, price_per_km=per_km / 1e6,
+                            stopped_fare=stopped_rate / 1e6, moving_fare=moving_rate / 1e6,
+                            version=version)
+        finished = state == FINISHED
+        if finished:
+            elapsed = stopped, moving
+        elif state == STATE_CODES[MOVING]:
+            elapsed = stopped, moving + saved_at - state_since
+        else:
+            elapsed = stopped + saved_at - state_since, moving
+        return {
+            'trip': trip,
+            'state': MOVING if state == STATE_CODES[MOVING] else STOPPED,
+            'finished': finished,
+            # Un viaje terminado no tiene tramo abierto
+            'state_since': saved_at if finished else state_since,
+            'saved_at': saved_at,
+            'stopped_time': stopped,
+            'moving_time': moving,
+            'cost': cost,
+            'tariff': tariff,
+            # (tiempo parado, tiempo en movimiento) hasta el último guardado
+            'elapsed': elapsed,
+        }
+
+    def start_heartbeat(self, interval=1.0):
+        '''Llama a touch() cada interval segundos en un hilo de fondo.'''
+        if self.heartbeat is not None or interval <= 0:
+            return
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(interval):
+                self.touch()
+
+        self.heartbeat = (stop, threading.Thread(target=beat, name='checkpoint', daemon=True))
+        self.heartbeat[1].start()
+
+    def close(self):
+        if self.heartbeat is not None:
+            stop, thread = self.heartbeat
+            stop.set()
+            thread.join()
+            self.heartbeat = None
+        with self.lock:
+            if not self.map.closed:
+                self.map.flush()
+                self.map.close()
+                self.file.close()
+
+
+def checkpoint_path(path, interface):
+    '''Ruta del checkpoint de una interfaz: data/viaje_en_curso.ckpt -> data/viaje_en_curso.cli.ckpt.'''
+    if not path:
+        return ''
+    root, extension = os.path.splitext(path)
+    return f"{root}.{interface}{extension}"
+
+
+def open_checkpoint(path, interface):
+    '''Abre el checkpoint del viaje en curso de interface, o devuelve None si está desactivado (ruta vacía).'''
+    path = checkpoint_path(path, interface)
+    return TripCheckpoint(path) if path else None
+
+
+def recover(meter, snapshot, resume=False, now=None):
+    '''
+    Retoma en meter el viaje interrumpido de snapshot (ver TripCheckpoint.load).
+    Con resume=True, si el viaje no había terminado, sigue en curso en el mismo
+    estado y devuelve None. Si no, se cierra y devuelve
+    (tiempo parado, tiempo en movimiento, tarifa), como TripMeter.finish.
+    Se cobra hasta el último checkpoint: el tiempo con el taxímetro caído no.
+    '''
+    if now is None:
+        now = meter.clock()
+    meter.resume(snapshot, now)
+    if resume and not snapshot['finished']:
+        logging.info("Viaje %s retomado tras una interrupción", snapshot['trip'])
+        return None
+    result = meter.finish(now)
+    logging.info("Viaje %s interrumpido cerrado. Total: %.2f €", snapshot['trip'], result[2])
+    return result
@@ -1,23 +1,60 @@
 import os
-from dotenv import load_dotenv
+import time
+import signal
+import logging
+import threading
+from datetime import date
+from dataclasses import dataclass, field
+from dotenv import dotenv_values
+from money import to_micros
+
+ENV_FILE = '.env'
+
+# Variables que se han puesto en os.environ desde el .env, con su valor
+_from_env_file = {}
+_env_lock = threading.Lock()
+
+def load_env():
+    '''
+    Carga el .env en os.environ sin pisar las variables de entorno del
+    proceso, que tienen prioridad. Se puede llamar en cada recarga: las
+    variables que vinieron del .env se actualizan si cambian en el archivo
+    y se quitan si ya no están. Devuelve los valores del archivo.
+    '''
+    values = dotenv_values(ENV_FILE) if os.path.exists(ENV_FILE) else {}
+    with _env_lock:
+        for key, loaded in list(_from_env_file.items()):
+            if os.environ.get(key) != loaded:
+                # Cambiada desde el propio proceso: ya no es del .env
+                del _from_env_file[key]
+            elif values.get(key) is None:
+                # Quitada del .env
+                del os.environ[key]
+                del _from_env_file[key]
+        for key, value in values.items():
+            if value is not None and (key not in os.environ or key in _from_env_file):
+                os.environ[key] = _from_env_file[key] = value
+    return values
 
 def fare_config():
     '''
     Carga tarifas desde .env.
     Si no existe crea uno con valores por defecto.
     Valida que los valores sean numéricos.
+    Las variables de entorno del proceso tienen prioridad sobre el .env
+    (ver load_env).
     '''
     
     #Crear archivo por defecto si no existe
-    if not os.path.exists('.env'):
-        with open('.env', 'w') as f:
+    if not os.path.exists(ENV_FILE):
+        with open(ENV_FILE, 'w') as f:
             f.write('BASE_FARE=1.5\n')
             f.write('PRICE_PER_KM=0.25\n')
             f.write('STOPPED_FARE=0.02\n')
             f.write('MOVING_FARE=0.05\n')
 
     #cargar variables del .env
-    load_dotenv()
+    load_env()
     
     def get_float(key, default):
         """Convierte la variable a float. Si falla, devuelve por defecto."""
@@ -36,5 +73,322 @@ def fare_config():
     
     return config
 
+# =========================
+# Bandas horarias (noche, fin de semana, festivos...)
+# =========================
+DAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun', 'hol')
+HOLIDAY = 7  # índice de 'hol' en DAYS
+
+@dataclass(frozen=True, slots=True)
+class Band:
+    '''
+    Franja horaria con sus propias tarifas.
+    days usa los índices de DAYS (0 = lunes ... 6 = domingo, 7 = festivo);
+    start y end son segundos desde medianoche. Si end <= start la franja
+    cubre [start, 24:00) y [00:00, end) del mismo día.
+    '''
+    name: str
+    days: tuple
+    start: int
+    end: int
+    stopped_fare: float
+    moving_fare: float
+    base_fare: float
+    price_per_km: float
+
+    def covers(self, day, second):
+        if day not in self.days:
+            return False
+        if self.start < self.end:
+            return self.start <= second < self.end
+        return second >= self.start or second < self.end
+
+def _parse_days(text):
+    """'mon-fri', 'sat,sun,hol'... -> tupla de índices de DAYS."""
+    days = []
+    for part in text.lower().split(','):
+        first, _, last = part.partition('-')
+        lo, hi = DAYS.index(first), DAYS.index(last or first)
+        if hi < lo or (HOLIDAY in (lo, hi) and lo != hi):
+            raise ValueError(part)
+        days.extend(range(lo, hi + 1))
+    return tuple(sorted(set(days)))
+
+def _parse_clock(text):
+    """'HH:MM' -> segundos desde medianoche ('24:00' = fin del día)."""
+    hours, minutes = (int(x) for x in text.split(':'))
+    if not (0 <= minutes < 60 and 0 <= hours * 60 + minutes <= 24 * 60):
+        raise ValueError(text)
+    return hours * 3600 + minutes * 60
+
+def parse_band(name, text, flat):
+    '''
+    Lee una franja con el formato 'días HH:MM-HH:MM parado movimiento [base km]'.
+    Las tarifas que falten se toman de la tarifa general (flat).
+    '''
+    fields = text.split()
+    if len(fields) not in (4, 6):
+        raise ValueError("se esperaban 4 o 6 campos")
+    start, end = (_parse_clock(x) for x in fields[1].split('-'))
+    rates = [float(x) for x in fields[2:]]
+    if any(rate < 0 for rate in rates):
+        raise ValueError("las tarifas no pueden ser negativas")
+    if len(rates) == 2:
+        rates += [flat['base_fare'], flat['price_per_km']]
+    return Band(name.lower(), _parse_days(fields[0]), start, end, *rates)
+
+def schedule_config(flat):
+    '''
+    Carga las franjas horarias y los festivos desde .env.
+    Cada franja es una variable BAND_<NOMBRE>, por ejemplo:
+        BAND_NOCHE=mon-sun 22:00-06:00 0.03 0.07 2.10 0.35
+    Si varias franjas se solapan gana la que aparece antes en el archivo.
+    HOLIDAYS es una lista de fechas AAAA-MM-DD; esos días solo se aplican
+    las franjas que incluyen 'hol'.
+    Las franjas no válidas se ignoran con una advertencia.
+    Como el resto de variables, las del entorno del proceso tienen prioridad.
+    Devuelve (franjas, festivos).
+    '''
+    # En el orden del archivo y después las que solo están en el entorno
+    keys = list(load_env()) + sorted(os.environ)
+    merged = {key: os.environ[key] for key in keys
+              if (key.startswith('BAND_') or key == 'HOLIDAYS') and key in os.environ}
+
+    bands = []
+    for key, text in merged.items():
+        if not key.startswith('BAND_') or not text:
+            continue
+        try:
+            bands.append(parse_band(key[len('BAND_'):], text, flat))
+        except ValueError as e:
+            print(f"Advertencia: {key} no es una franja válida en .env ({e}). Se ignorará.")
+
+    holidays = set()
+    for text in (merged.get('HOLIDAYS') or '').split(','):
+        if text.strip():
+            try:
+                holidays.add(date.fromisoformat(text.strip()))
+            except ValueError:
+                print(f"Advertencia: {text.strip()} no es una fecha válida en HOLIDAYS. Se ignorará.")
+    return tuple(bands), tuple(sorted(holidays))
+
+# =========================
+# Tarifa en caché y recarga en caliente
+# =========================
+@dataclass(frozen=True, slots=True)
+class Tariff:
+    '''
+    Tarifas vigentes, inmutables. version identifica el .env del que salieron
+    (su fecha de modificación en microsegundos), así cada viaje puede
+    conservar la versión con la que empezó.
+    bands y holidays son las franjas horarias y los festivos (vacíos si
+    la tarifa es plana); ver schedule.schedule_for.
+    '''
+    base_fare: float
+    price_per_km: float
+    stopped_fare: float
+    moving_fare: float
+    version: int = 0
+    bands: tuple = ()
+    holidays: tuple = ()
+    # Las mismas tarifas en micro-euros, precalculadas (ver money.py)
+    base_micros: int = field(init=False, repr=False, compare=False)
+    km_micros: int = field(init=False, repr=False, compare=False)
+    stopped_micros: int = field(init=False, repr=False, compare=False)
+    moving_micros: int = field(init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, 'base_micros', to_micros(self.base_fare))
+        object.__setattr__(self, 'km_micros', to_micros(self.price_per_km))
+        object.__setattr__(self, 'stopped_micros', to_micros(self.stopped_fare))
+        object.__setattr__(self, 'moving_micros', to_micros(self.moving_fare))
+
+    def as_dict(self):
+        return {
+            'base_fare': self.base_fare,
+            'price_per_km': self.price_per_km,
+            'stopped_fare': self.stopped_fare,
+            'moving_fare': self.moving_fare,
+        }
+
+def _env_version():
+    try:
+        return os.stat(ENV_FILE).st_mtime_ns // 1000
+    except OSError:
+        return 0
+
+def load_tariff():
+    '''Lee el .env y devuelve una Tariff nueva.'''
+    config = fare_config()
+    bands, holidays = schedule_config(config)
+    return Tariff(version=_env_version(), bands=bands, holidays=holidays, **config)
+
+_tariff = None
+_tariff_lock = threading.Lock()
+
+def current_tariff():
+    '''
+    Devuelve la tarifa en caché. Solo lee el .env la primera vez;
+    después no hace ninguna operación de disco.
+    '''
+    if _tariff is None:
+        reload_tariff(force=True)
+    return _tariff
+
+def reload_tariff(force=False):
+    '''
+    Recarga la tarifa si el .env ha cambiado (o siempre, con force=True).
+    Cuesta un stat del archivo. Devuelve True si hay una versión nueva.
+    '''
+    global _tariff
+    with _tariff_lock:
+        if not force and _tariff is not None and _env_version() == _tariff.version:
+            return False
+        new = load_tariff()
+        changed = _tariff is None or new != _tariff
+        _tariff = new
+    if changed:
+        logging.info("Tarifa cargada (versión %s): %s", new.version, new.as_dict())
+    return changed
+
+def watch_tariff(interval=2.0):
+    '''
+    Vigila el .env en un hilo de fondo y recarga la tarifa cuando cambia.
+    En sistemas POSIX también recarga al recibir SIGHUP.
+    '''
+    current_tariff()
+
+    def watch():
+        while True:
+            time.sleep(interval)
+            try:
+                reload_tariff()
+            except Exception as e:
+                logging.error("No se pudo recargar la tarifa: %s", e)
+
+    threading.Thread(target=watch, name="tariff-watch", daemon=True).start()
+    if hasattr(signal, 'SIGHUP') and threading.current_thread() is threading.main_thread():
+        # La recarga se hace en otro hilo: el manejador de señales no debe esperar al lock
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(
+            target=reload_tariff, kwargs={'force': True}, daemon=True).start())
+
+def _get_number(key, default, cast):
+    """Convierte la variable al tipo indicado. Si falla, devuelve por defecto."""
+    try:
+        return cast(os.getenv(key, default))
+    except (ValueError, TypeError):
+        print(f"Advertencia: {key} no es numérico en .env. Se usará el valor por defecto: ({default}).")
+        return default
+
+HISTORY_BACKENDS = ('sqlite', 'text')
+HISTORY_DURABILITY = ('none', 'flush', 'fsync')
+
+def history_config():
+    '''
+    Carga la configuración del historial desde .env.
+    HISTORY_BACKEND puede ser 'sqlite' (por defecto) o 'text'.
+    HISTORY_ASYNC activa el escritor en segundo plano, que agrupa
+    los trayectos en lotes de HISTORY_BATCH_SIZE o cada
+    HISTORY_FLUSH_INTERVAL segundos.
+    HISTORY_DURABILITY puede ser 'none', 'flush' (por defecto) o 'fsync'.
+    EVENT_LOG es la ruta del registro de eventos de viaje (vacío para desactivarlo).
+    TRIP_CHECKPOINT es la ruta del checkpoint del viaje en curso (vacío para
+    desactivarlo); la CLI y la GUI usan cada una la suya (ver checkpoint_path).
+    TRIP_CHECKPOINT_INTERVAL es cada cuántos segundos se actualiza durante el viaje.
+    HISTORY_SEGMENT_BYTES: tamaño a partir del cual el historial de texto pasa
+    a un segmento nuevo y el anterior se comprime (0, por defecto, para no segmentarlo).
+    HISTORY_SEGMENT_DAILY empieza además un segmento nuevo cada día.
+    '''
+    load_env()
+
+    backend = os.getenv('HISTORY_BACKEND', 'sqlite').strip().lower()
+    if backend not in HISTORY_BACKENDS:
+        print("Advertencia: HISTORY_BACKEND no es válido en .env. Se usará el valor por defecto: (sqlite).")
+        backend = 'sqlite'
+
+    durability = os.getenv('HISTORY_DURABILITY', 'flush').strip().lower()
+    if durability not in HISTORY_DURABILITY:
+        print("Advertencia: HISTORY_DURABILITY no es válido en .env. Se usará el valor por defecto: (flush).")
+        durability = 'flush'
+
+    return {
+        'backend': backend,
+        'async': os.getenv('HISTORY_ASYNC', 'true').strip().lower() in ('1', 'true', 'yes', 'si', 'sí'),
+        'batch_size': max(1, _get_number('HISTORY_BATCH_SIZE', 100, int)),
+        'flush_interval': _get_number('HISTORY_FLUSH_INTERVAL', 0.5, float),
+        'durability': durability,
+        'event_log': os.getenv('EVENT_LOG', os.path.join('data', 'eventos.bin')).strip(),
+        'checkpoint': os.getenv('TRIP_CHECKPOINT', os.path.join('data', 'viaje_en_curso.ckpt')).strip(),
+        'checkpoint_interval': _get_number('TRIP_CHECKPOINT_INTERVAL', 1.0, float),
+        'segment_bytes': max(0, _get_number('HISTORY_SEGMENT_BYTES', 0, int)),
+        'segment_daily': os.getenv('HISTORY_SEGMENT_DAILY', 'false').strip().lower() in ('1', 'true', 'yes', 'si', 'sí'),
+    }
+
+def log_config():
+    '''
+    Carga la configuración del logging desde .env.
+    LOG_MAX_BYTES: tamaño máximo de cada segmento antes de rotar.
+    LOG_BACKUP_COUNT: segmentos antiguos (comprimidos) que se conservan.
+    LOG_ROTATE_HOURS: rota también cada N horas (0 para desactivarlo).
+    '''
+    load_env()
+
+    hours = _get_number('LOG_ROTATE_HOURS', 24, float)
+    return {
+        'max_bytes': max(1024, _get_number('LOG_MAX_BYTES', 5 * 1024 * 1024, int)),
+        'backup_count': max(1, _get_number('LOG_BACKUP_COUNT', 10, int)),
+        'rotate_seconds': hours * 3600 if hours > 0 else None,
+    }
+
+def metrics_config():
+    '''
+    Carga la configuración de la instrumentación desde .env.
+    METRICS_ENABLED la activa (desactivada por defecto, sin coste).
+    METRICS_FILE: archivo en formato de texto de Prometheus que se reescribe
+    cada METRICS_INTERVAL segundos (vacío para no escribirlo).
+    METRICS_PORT: puerto local donde se sirve /metrics por HTTP (0 para no servirlo).
+    '''
+    load_env()
+
+    return {
+        'enabled': os.getenv('METRICS_ENABLED', 'false').strip().lower() in ('1', 'true', 'yes', 'si', 'sí'),
+        'file': os.getenv('METRICS_FILE', os.path.join('logs', 'metrics.prom')).strip(),
+        'interval': max(0.1, _get_number('METRICS_INTERVAL', 10, float)),
+        'port': _get_number('METRICS_PORT', 0, int),
+    }
+
+def telemetry_config():
+    '''
+    Carga la configuración de la telemetría GPS desde .env.
+    GPS_MOVING_SPEED: velocidad (km/h) a partir de la cual el taxi está en movimiento.
+    GPS_MAX_SPEED: velocidad (km/h) por encima de la cual un tramo es un salto del GPS.
+    GPS_WINDOW: tramos con los que se promedia la velocidad (filtra el ruido al estar parado).
+    GPS_TRIP_TIMEOUT: segundos sin posiciones tras los que se da un viaje por terminado.
+    '''
+    load_env()
+
+    return {
+        'moving_speed': max(0.1, _get_number('GPS_MOVING_SPEED', 5.0, float)),
+        'max_speed': max(10.0, _get_number('GPS_MAX_SPEED', 200.0, float)),
+        'window': max(1, _get_number('GPS_WINDOW', 10, int)),
+        'trip_timeout': max(1.0, _get_number('GPS_TRIP_TIMEOUT', 600.0, float)),
+    }
+
+def ingest_config():
+    '''
+    Carga la configuración del servicio de ingesta de la flota desde .env.
+    INGEST_PORT: puerto local donde escucha (solo en 127.0.0.1).
+    INGEST_BATCH_SIZE: viajes máximos por escritura en el historial.
+    INGEST_MAX_PENDING: bloques recibidos que pueden esperar a guardarse; con la
+    cola llena el servidor deja de leer y los taxímetros esperan (contrapresión).
+    '''
+    load_env()
+
+    return {
+        'port': _get_number('INGEST_PORT', 8765, int),
+        'batch_size': max(1, _get_number('INGEST_BATCH_SIZE', 5000, int)),
+        'max_pending': max(1, _get_number('INGEST_MAX_PENDING', 64, int)),
+    }
+
 if __name__ == '__main__':
     fare_config()
\ No newline at end of file
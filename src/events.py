@@ -0,0 +1,253 @@
+import os
+import time
+import atexit
+import threading
+import numpy as np
+from config import current_tariff
+from fares import calculate_time_fares_cents
+from money import nanos_to_cents, cents_to_euros, round_seconds
+from schedule import schedule_for, local_seconds
+
+# =========================
+# Tipos de evento
+# =========================
+ANCHOR = 0     # relaciona el reloj del medidor con la hora real (value = time.time())
+START = 1      # value = versión de la tarifa del viaje (0 en registros antiguos)
+STOP = 2
+MOVE = 3
+FINISH = 4
+DISTANCE = 5   # value = kilómetros recorridos
+
+# Registro compacto de ancho fijo (25 bytes por evento)
+EVENT_DTYPE = np.dtype([
+    ('timestamp', '<f8'),  # reloj del medidor (monotónico)
+    ('trip', '<u8'),
+    ('kind', 'u1'),
+    ('value', '<f8'),
+])
+
+# Resultado de la reproducción: un registro por viaje terminado
+TRIP_DTYPE = np.dtype([
+    ('trip', '<u8'),
+    ('start', '<f8'),
+    ('end', '<f8'),
+    ('stopped_time', '<f8'),
+    ('moving_time', '<f8'),
+    ('distance', '<f8'),
+    ('fare', '<f8'),       # euros
+    ('cents', '<i8'),      # la misma tarifa en céntimos (para sumar sin error)
+])
+
+
+# =========================
+# Registro de eventos (solo añadir)
+# =========================
+class EventLog:
+    '''
+    Registro de eventos de viaje en un archivo binario de solo añadir.
+    Se puede usar directamente como listener de TripMeter y FleetManager.
+    Los eventos se acumulan en memoria y se escriben por bloques;
+    cada FINISH fuerza la escritura para no perder viajes cerrados.
+    '''
+
+    def __init__(self, path, buffer_size=4096, clock=time.monotonic):
+        self.path = path
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.file = open(path, 'ab')
+        # Ancla para pasar del reloj del medidor a la hora real
+        self.record(ANCHOR, 0, clock(), time.time())
+        atexit.register(self.close)
+
+    def record(self, kind, trip_id, timestamp, value=0.0):
+        with self.lock:
+            self.buffer.append((timestamp, trip_id, kind, value))
+            if kind == FINISH or len(self.buffer) >= self.buffer_size:
+                self._write()
+
+    __call__ = record
+
+    def _write(self):
+        if self.buffer and self.file is not None:
+            self.file.write(np.array(self.buffer, dtype=EVENT_DTYPE).tobytes())
+            self.file.flush()
+            self.buffer = []
+
+    def flush(self):
+        with self.lock:
+            self._write()
+
+    def close(self):
+        with self.lock:
+            self._write()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def open_event_log(path):
+    '''Abre el registro de eventos, o devuelve None si está desactivado (ruta vacía).'''
+    return EventLog(path) if path else None
+
+
+def read_events(path, chunk_size=1 << 22):
+    '''
+    Lee el registro por bloques de chunk_size eventos, mapeado en memoria.
+    Ignora un evento final incompleto (escritura cortada).
+    '''
+    if not os.path.exists(path):
+        return
+    count = os.path.getsize(path) // EVENT_DTYPE.itemsize
+    if count == 0:
+        return
+    events = np.memmap(path, dtype=EVENT_DTYPE, mode='r', shape=(count,))
+    for first in range(0, count, chunk_size):
+        yield events[first:first + chunk_size]
+
+
+# =========================
+# Reproducción determinista
+# =========================
+class Replayer:
+    '''
+    Pliega un flujo de eventos en viajes terminados, bloque a bloque.
+    Todo el bloque se procesa con operaciones vectorizadas; los viajes
+    que siguen abiertos al final de un bloque pasan al siguiente.
+    Los tiempos se suman tramo a tramo en el mismo orden que TripMeter y
+    FleetManager, así las tarifas coinciden exactamente con las del medidor.
+    tariffs relaciona versión -> config.Tariff; cada viaje se cobra con la
+    versión de su START, y las versiones desconocidas con la tarifa vigente.
+    Con franjas horarias los tramos se pasan a hora local con las anclas
+    del registro y se cobran según las franjas que cruzan.
+    '''
+
+    def __init__(self, tariffs=None):
+        self.tariffs = tariffs or {}
+        self.pending = np.zeros(0, dtype=EVENT_DTYPE)
+        self.skipped = 0   # eventos sin viaje válido (sin START previo, tras FINISH...)
+        self.anchors = []  # (reloj del medidor, hora real)
+
+    def feed(self, events):
+        '''Procesa un bloque de eventos y devuelve los viajes terminados (array TRIP_DTYPE).'''
+        events = np.asarray(events, dtype=EVENT_DTYPE)
+        anchors = events['kind'] == ANCHOR
+        if anchors.any():
+            self.anchors.extend(zip(events['timestamp'][anchors].tolist(), events['value'][anchors].tolist()))
+            events = events[~anchors]
+        if len(self.pending):
+            events = np.concatenate([self.pending, events])
+        if len(events) == 0:
+            return np.zeros(0, dtype=TRIP_DTYPE)
+
+        # Agrupar por viaje manteniendo el orden de llegada dentro de cada uno
+        events = events[np.argsort(events['trip'], kind='stable')]
+        trip = events['trip']
+        kind = events['kind']
+        n = len(events)
+        idx = np.arange(n)
+
+        # Cada evento pertenece al último START de su mismo viaje
+        group_first = np.maximum.accumulate(np.where(np.r_[True, trip[1:] != trip[:-1]], idx, 0))
+        is_start = kind == START
+        start_pos = np.maximum.accumulate(np.where(is_start, idx, -1))
+        valid = start_pos >= group_first
+        # Descarta lo que llega después del FINISH de su viaje
+        is_finish = kind == FINISH
+        finishes = np.cumsum(is_finish)
+        before = finishes - is_finish - np.where(valid, finishes[np.maximum(start_pos, 0)], 0)
+        valid &= before == 0
+        self.skipped += int(n - valid.sum())
+
+        events, kind = events[valid], kind[valid]
+        is_start, is_finish = is_start[valid], is_finish[valid]
+        instance = np.cumsum(is_start) - 1     # número de viaje dentro del bloque
+        n_trips = int(instance[-1]) + 1 if len(instance) else 0
+
+        # Tramos entre cambios de estado consecutivos del mismo viaje
+        state_events = kind != DISTANCE
+        ts = events['timestamp'][state_events]
+        st_kind = kind[state_events]
+        st_instance = instance[state_events]
+        same = (st_instance[1:] == st_instance[:-1]) & (st_kind[:-1] != FINISH)
+        duration = ts[1:] - ts[:-1]
+        stopped_segment = same & ((st_kind[:-1] == START) | (st_kind[:-1] == STOP))
+        moving_segment = same & (st_kind[:-1] == MOVE)
+        # Al centésimo y cobrados con esos tiempos, como TripMeter.finish
+        stopped = round_seconds(np.bincount(st_instance[:-1][stopped_segment], duration[stopped_segment], n_trips))
+        moving = round_seconds(np.bincount(st_instance[:-1][moving_segment], duration[moving_segment], n_trips))
+
+        is_distance = kind == DISTANCE
+        distance = np.bincount(instance[is_distance], events['value'][is_distance], n_trips)
+
+        finished = np.zeros(n_trips, dtype=bool)
+        finished[instance[is_finish]] = True
+
+        # Los viajes abiertos se guardan para el siguiente bloque, salvo los que
+        # quedaron sin FINISH porque el mismo id volvió a empezar
+        start_trips = events['trip'][is_start]
+        latest = np.r_[start_trips[1:] != start_trips[:-1], True]
+        keep = ~finished & latest
+        abandoned = ~finished & ~latest
+        self.skipped += int(abandoned[instance].sum())
+        self.pending = events[keep[instance]]
+
+        result = np.zeros(int(finished.sum()), dtype=TRIP_DTYPE)
+        result['trip'] = events['trip'][is_start][finished]
+        result['start'] = events['timestamp'][is_start][finished]
+        result['end'] = events['timestamp'][is_finish]
+        result['stopped_time'] = stopped[finished]
+        result['moving_time'] = moving[finished]
+        result['distance'] = distance[finished]
+        segments = (st_instance[:-1], ts[:-1], ts[1:], stopped_segment | moving_segment, moving_segment)
+        versions = events['value'][is_start].astype(np.int64)
+        starts = events['timestamp'][is_start]
+        result['cents'] = self._fares(stopped, moving, versions, starts, segments)[finished]
+        result['fare'] = cents_to_euros(result['cents'])
+        return result
+
+    def _fares(self, stopped, moving, versions, starts, segments):
+        """Tarifa en céntimos de cada viaje del bloque con la tarifa de su versión."""
+        cents = np.zeros(len(stopped), dtype=np.int64)
+        for version in np.unique(versions).tolist():
+            same = versions == version
+            tariff = self.tariffs.get(version) or current_tariff()
+            if not tariff.bands:
+                cents[same] = calculate_time_fares_cents(stopped[same], moving[same], tariff)
+                continue
+            # Mismo cálculo que el medidor: desfase a hora local fijado al empezar el viaje
+            instance, seg_start, seg_end, is_segment, is_moving = segments
+            offset = local_seconds(self.wall_times(starts)) - starts
+            use = is_segment & same[instance]
+            seg_offset = offset[instance[use]]
+            costs = schedule_for(tariff).time_cost(seg_start[use] + seg_offset, seg_end[use] + seg_offset,
+                                                   is_moving[use])
+            nanos = np.zeros(len(stopped), dtype=np.int64)
+            np.add.at(nanos, instance[use], costs)
+            cents[same] = nanos_to_cents(nanos[same])
+        return cents
+
+    def wall_times(self, timestamps):
+        '''Versión vectorizada de wall_time (anclas ordenadas por reloj del medidor).'''
+        if not self.anchors:
+            raise ValueError("No hay un ancla de reloj anterior a ese instante")
+        clocks, walls = np.array(sorted(self.anchors, key=lambda anchor: anchor[0])).T
+        i = np.searchsorted(clocks, timestamps, 'right') - 1
+        if (i < 0).any():
+            raise ValueError("No hay un ancla de reloj anterior a ese instante")
+        return walls[i] + (timestamps - clocks[i])
+
+    def wall_time(self, timestamp):
+        '''Convierte un instante del reloj del medidor a hora real (epoch), con el último ancla.'''
+        for clock_value, wall in reversed(self.anchors):
+            if clock_value <= timestamp:
+                return wall + (timestamp - clock_value)
+        raise ValueError("No hay un ancla de reloj anterior a ese instante")
+
+
+def replay_file(path, chunk_size=1 << 22, tariffs=None):
+    '''Reproduce un registro de eventos completo. Genera un array de viajes por bloque.'''
+    replayer = Replayer(tariffs)
+    for chunk in read_events(path, chunk_size):
+        yield replayer.feed(chunk)
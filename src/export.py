@@ -0,0 +1,212 @@
+import os
+import sys
+import json
+import struct
+import argparse
+import numpy as np
+from config import history_config
+from history import BACKENDS, open_backend
+from money import euros_to_cents
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet es opcional
+    pa = pq = None
+
+# =========================
+# Exportación columnar del historial
+# =========================
+# Un archivo .npy por columna en un directorio, más export.json con cuántas
+# filas son válidas y el último id exportado. Cada ejecución solo añade los
+# trayectos nuevos al final de cada columna y reescribe la cabecera .npy
+# (de tamaño fijo) con el número de filas, así np.load(..., mmap_mode='r')
+# lee las columnas sin copiarlas.
+# Si pyarrow está instalado también se escribe una parte Parquet por ejecución.
+EXPORT_DIR = os.path.join('data', 'export')
+MANIFEST = 'export.json'
+CHUNK_SIZE = 100_000
+
+# Columna -> dtype. Los campos que no aplican a un tipo de trayecto van como NaN.
+COLUMNS = {
+    'id': np.dtype('<i8'),
+    'fecha': np.dtype('<M8[s]'),   # hora local, como en el historial
+    'tipo': np.dtype('u1'),        # índice en TIPOS
+    'distancia_total': np.dtype('<f8'),
+    'tiempo_parado': np.dtype('<f8'),
+    'tiempo_movimiento': np.dtype('<f8'),
+    'duracion_total': np.dtype('<f8'),
+    'coste_total': np.dtype('<f8'),
+    'coste_centimos': np.dtype('<i8'),
+}
+TIPOS = ('tiempo', 'distancia')
+UNKNOWN_TIPO = 255
+
+# Cabecera .npy (versión 1.0) con espacio de sobra para cualquier número de filas
+HEADER_SIZE = 128
+
+
+def _npy_header(dtype, rows):
+    header = repr({'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (rows,)})
+    length = HEADER_SIZE - 10  # magic (6) + versión (2) + longitud (2)
+    return np.lib.format.magic(1, 0) + struct.pack('<H', length) + header.encode('latin1').ljust(length - 1) + b'\n'
+
+
+def _chunk_columns(trips):
+    """Convierte una lista de trayectos (dicts) en un array por columna."""
+    codes = {tipo: i for i, tipo in enumerate(TIPOS)}
+    nan = float('nan')
+    columns = {
+        'id': np.fromiter((t['id'] for t in trips), COLUMNS['id'], len(trips)),
+        'fecha': np.array([t['fecha'] for t in trips], dtype=COLUMNS['fecha']),
+        'tipo': np.fromiter((codes.get(t['tipo'], UNKNOWN_TIPO) for t in trips), COLUMNS['tipo'], len(trips)),
+    }
+    for name in ('distancia_total', 'tiempo_parado', 'tiempo_movimiento', 'duracion_total', 'coste_total'):
+        columns[name] = np.fromiter((t.get(name, nan) for t in trips), COLUMNS[name], len(trips))
+    columns['coste_centimos'] = euros_to_cents(columns['coste_total'])
+    return columns
+
+
+# =========================
+# Manifiesto
+# =========================
+def read_manifest(directory=EXPORT_DIR):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _write_manifest(directory, manifest):
+    path = os.path.join(directory, MANIFEST)
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# =========================
+# Exportación
+# =========================
+def export(backend, directory=EXPORT_DIR, source=None, full=False, parquet=None,
+           chunk_size=CHUNK_SIZE, out=sys.stderr):
+    '''
+    Exporta a directory los trayectos del backend añadidos desde la última
+    exportación (o todos, con full=True o si el historial de origen es otro).
+    Lee el historial por bloques de chunk_size trayectos, con memoria acotada.
+    parquet: True/False para forzarlo o None para usarlo si pyarrow está instalado.
+    Devuelve el número de trayectos exportados en esta ejecución.
+    '''
+    if parquet and pq is None:
+        raise RuntimeError("Para exportar a Parquet hace falta instalar pyarrow")
+    parquet = pq is not None if parquet is None else parquet
+    os.makedirs(directory, exist_ok=True)
+    manifest = read_manifest(directory)
+    if full or manifest is None or manifest.get('historial') != source:
+        manifest = {'historial': source, 'filas': 0, 'ultimo_id': 0, 'parquet': []}
+    rows = manifest['filas']
+
+    # Deja cada columna en las filas del manifiesto (descarta restos de una ejecución cortada)
+    files = {}
+    for name, dtype in COLUMNS.items():
+        path = os.path.join(directory, name + '.npy')
+        f = open(path, 'r+b' if os.path.exists(path) and rows else 'w+b')
+        f.truncate(HEADER_SIZE + rows * dtype.itemsize)
+        f.seek(0)
+        f.write(_npy_header(dtype, rows))
+        f.seek(0, os.SEEK_END)
+        files[name] = f
+    for name in os.listdir(directory):
+        if name.endswith('.parquet') and name not in manifest['parquet']:
+            os.remove(os.path.join(directory, name))
+
+    part = None
+    writer = None
+    exported = 0
+    try:
+        for trips in backend.iter_chunks(manifest['ultimo_id'], chunk_size):
+            columns = _chunk_columns(trips)
+            for name, f in files.items():
+                f.write(columns[name].tobytes())
+            if parquet:
+                table = pa.table({name: columns[name] for name in COLUMNS})
+                if writer is None:
+                    part = f"parte-{len(manifest['parquet']) + 1:05d}.parquet"
+                    writer = pq.ParquetWriter(os.path.join(directory, part), table.schema)
+                writer.write_table(table)
+            exported += len(trips)
+            manifest['ultimo_id'] = int(columns['id'][-1])
+            print(f"{exported} trayectos exportados", file=out)
+        if writer is not None:
+            writer.close()
+            writer = None
+            manifest['parquet'].append(part)
+        # Primero los datos y las cabeceras; el manifiesto al final los da por buenos
+        for name, f in files.items():
+            f.seek(0)
+            f.write(_npy_header(COLUMNS[name], rows + exported))
+            f.flush()
+            os.fsync(f.fileno())
+        manifest['filas'] = rows + exported
+        _write_manifest(directory, manifest)
+    finally:
+        if writer is not None:
+            writer.close()
+        for f in files.values():
+            f.close()
+    return exported
+
+
+# =========================
+# Lectura
+# =========================
+def load_columns(directory=EXPORT_DIR):
+    '''
+    Columnas exportadas como arrays de NumPy mapeados en memoria
+    (solo lectura, sin copiar): {nombre: array}. tipo es un índice en TIPOS.
+    '''
+    manifest = read_manifest(directory)
+    rows = manifest['filas'] if manifest else 0
+    if rows == 0:
+        return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+    return {name: np.load(os.path.join(directory, name + '.npy'), mmap_mode='r')[:rows]
+            for name in COLUMNS}
+
+
+def load_parquet(directory=EXPORT_DIR):
+    '''Tabla de pyarrow con todas las partes Parquet exportadas.'''
+    if pq is None:
+        raise RuntimeError("Para leer Parquet hace falta instalar pyarrow")
+    manifest = read_manifest(directory) or {'parquet': []}
+    tables = [pq.read_table(os.path.join(directory, part)) for part in manifest['parquet']]
+    return pa.concat_tables(tables) if tables else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Exporta el historial a columnas (.npy y, con pyarrow, Parquet) para análisis.")
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help="backend del historial (por defecto el de HISTORY_BACKEND en .env)")
+    parser.add_argument('--dest', help="ruta del historial (por defecto la del backend)")
+    parser.add_argument('--out', default=EXPORT_DIR, help=f"directorio de salida (por defecto {EXPORT_DIR})")
+    parser.add_argument('--full', action='store_true', help="exporta todo de nuevo en lugar de solo lo nuevo")
+    parser.add_argument('--parquet', choices=('auto', 'yes', 'no'), default='auto',
+                        help="escribir también Parquet (auto: si pyarrow está instalado)")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help="trayectos por bloque")
+    args = parser.parse_args(argv)
+
+    path = args.dest or BACKENDS[args.backend or history_config()['backend']][1]
+    backend = open_backend(args.backend, path)
+    try:
+        exported = export(backend, args.out, os.path.abspath(path), args.full,
+                          {'auto': None, 'yes': True, 'no': False}[args.parquet], args.chunk_size)
+    finally:
+        backend.close()
+    print(f"Exportación terminada: {exported} trayectos nuevos en {args.out}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
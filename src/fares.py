@@ -0,0 +1,196 @@
+import math
+import numpy as np
+from config import current_tariff
+from schedule import schedule_for
+from money import MAX_NANOS, to_ms, to_meters, nanos_to_cents, cents_to_euros
+from metrics import timed
+
+# =========================
+# Función de tarifa
+# =========================
+# Las tarifas se calculan en enteros (céntimos y nano-euros, ver money.py);
+# las funciones que devuelven euros solo dividen los céntimos entre 100.
+
+def _time_nanos(ms_stopped, ms_moving, stopped_micros, moving_micros):
+    """Fórmula de tarifa por tiempo en nano-euros. Sirve igual para enteros y arrays."""
+    return (ms_stopped * stopped_micros) + (ms_moving * moving_micros)
+
+def _distance_nanos(meters, base_micros, km_micros):
+    """Fórmula de tarifa por distancia en nano-euros. Sirve igual para enteros y arrays."""
+    return base_micros * 1000 + meters * km_micros
+
+def _time_fits(seconds_stopped, seconds_moving, stopped_micros, moving_micros):
+    """
+    True (o máscara) si los tiempos caben en enteros de 64 bits: ms e importe
+    por debajo de MAX_NANOS. Se estima en float, antes de convertir a enteros
+    (un valor enorme da inf, que tampoco cabe).
+    """
+    with np.errstate(over='ignore', invalid='ignore'):
+        return ((seconds_stopped * 1000 < MAX_NANOS) & (seconds_moving * 1000 < MAX_NANOS)
+                & (_time_nanos(seconds_stopped * 1000, seconds_moving * 1000, stopped_micros, moving_micros) < MAX_NANOS))
+
+def _distance_fits(distance, base_micros, km_micros):
+    """Como _time_fits, para distancias en km."""
+    with np.errstate(over='ignore', invalid='ignore'):
+        return (distance * 1000 < MAX_NANOS) & (_distance_nanos(distance * 1000, base_micros, km_micros) < MAX_NANOS)
+
+def calculate_time_fare_cents(seconds_stopped, seconds_moving, tariff=None):
+    '''
+    Tarifa por tiempo en céntimos (entero).
+    Sin tariff se usa la tarifa vigente (config.current_tariff).
+    '''
+    if not (math.isfinite(seconds_stopped) and math.isfinite(seconds_moving)):
+        raise ValueError("Los tiempos deben ser números finitos")
+    if seconds_stopped < 0 or seconds_moving < 0:
+        raise ValueError("Los tiempos no pueden ser negativos")
+    if tariff is None:
+        tariff = current_tariff()
+    if not _time_fits(seconds_stopped, seconds_moving, tariff.stopped_micros, tariff.moving_micros):
+        raise ValueError("Los tiempos son demasiado grandes")
+    return nanos_to_cents(_time_nanos(to_ms(seconds_stopped), to_ms(seconds_moving),
+                                      tariff.stopped_micros, tariff.moving_micros))
+
+@timed('fare_calculation_seconds', kind='tiempo')
+def calculate_time_fare(seconds_stopped, seconds_moving, tariff=None):
+    '''
+    funcion para calcular la tarifa usando tiempo.
+    stopped: 0.02€/s
+    moving: 0.05€/s
+    Sin tariff se usa la tarifa vigente (config.current_tariff).
+    Devuelve euros redondeados al céntimo.
+    '''
+    fare = cents_to_euros(calculate_time_fare_cents(seconds_stopped, seconds_moving, tariff))
+    #print(lang["total_fare"].format(fare=fare))
+    return fare
+
+def calculate_distance_fare_cents(distance, tariff=None, start=None):
+    '''
+    Tarifa por distancia en céntimos (entero).
+    Sin tariff se usa la tarifa vigente (config.current_tariff).
+    Con start (segundos locales, ver schedule.local_seconds) se aplica
+    la franja horaria en la que empezó el viaje.
+    '''
+    if not math.isfinite(distance):
+        raise ValueError("La distancia debe ser un número finito")
+    if distance <= 0:
+        raise ValueError("La distancia debe ser mayor que 0")
+    if tariff is None:
+        tariff = current_tariff()
+    if start is not None and tariff.bands:
+        _, _, base_micros, km_micros = schedule_for(tariff).rates_at(start).tolist()
+    else:
+        base_micros, km_micros = tariff.base_micros, tariff.km_micros
+    if not _distance_fits(distance, base_micros, km_micros):
+        raise ValueError("La distancia es demasiado grande")
+    return nanos_to_cents(_distance_nanos(to_meters(distance), base_micros, km_micros))
+
+@timed('fare_calculation_seconds', kind='distancia')
+def calculate_distance_fare(distance, tariff=None, start=None):
+    '''
+    funcion para calcular la tarifa usando distancia.
+    Acepta los mismos argumentos que calculate_distance_fare_cents.
+    Devuelve euros redondeados al céntimo.
+    '''
+    fare = cents_to_euros(calculate_distance_fare_cents(distance, tariff, start))
+    #print(lang["total_fare"].format(fare=fare))
+    return fare
+
+# =========================
+# Tarifas por lotes
+# =========================
+
+def _bad_indices(mask):
+    """Devuelve los índices donde la máscara es True (como lista)."""
+    return np.flatnonzero(mask).tolist()
+
+def calculate_time_fares_cents(seconds_stopped, seconds_moving, tariff=None):
+    '''
+    Calcula la tarifa por tiempo de muchos viajes a la vez, en céntimos.
+    Acepta arrays de NumPy o cualquier secuencia/buffer numérico.
+    Devuelve un array int64 con una tarifa por viaje, igual a la de
+    calculate_time_fare_cents viaje a viaje.
+    '''
+    stopped = np.asarray(seconds_stopped, dtype=np.float64)
+    moving = np.asarray(seconds_moving, dtype=np.float64)
+    if stopped.shape != moving.shape:
+        raise ValueError("Los arrays de tiempo parado y en movimiento deben tener la misma forma")
+    bad = _bad_indices(~(np.isfinite(stopped) & np.isfinite(moving)))
+    if bad:
+        raise ValueError(f"Los tiempos deben ser números finitos (índices: {bad})")
+    bad = _bad_indices((stopped < 0) | (moving < 0))
+    if bad:
+        raise ValueError(f"Los tiempos no pueden ser negativos (índices: {bad})")
+    if tariff is None:
+        tariff = current_tariff()
+    bad = _bad_indices(~_time_fits(stopped, moving, tariff.stopped_micros, tariff.moving_micros))
+    if bad:
+        raise ValueError(f"Los tiempos son demasiado grandes (índices: {bad})")
+    return nanos_to_cents(_time_nanos(to_ms(stopped), to_ms(moving),
+                                      tariff.stopped_micros, tariff.moving_micros))
+
+def calculate_time_fares(seconds_stopped, seconds_moving, tariff=None):
+    '''
+    Calcula la tarifa por tiempo de muchos viajes a la vez.
+    Devuelve un array float64 con una tarifa por viaje, en euros.
+    '''
+    return cents_to_euros(calculate_time_fares_cents(seconds_stopped, seconds_moving, tariff))
+
+def calculate_distance_fares_cents(distances, tariff=None, starts=None):
+    '''
+    Calcula la tarifa por distancia de muchos viajes a la vez, en céntimos.
+    Acepta arrays de NumPy o cualquier secuencia/buffer numérico.
+    Con starts (segundos locales) cada viaje usa la franja en la que empezó.
+    Devuelve un array int64 con una tarifa por viaje.
+    '''
+    distances = np.asarray(distances, dtype=np.float64)
+    bad = _bad_indices(~np.isfinite(distances))
+    if bad:
+        raise ValueError(f"La distancia debe ser un número finito (índices: {bad})")
+    bad = _bad_indices(~(distances > 0))
+    if bad:
+        raise ValueError(f"La distancia debe ser mayor que 0 (índices: {bad})")
+    if tariff is None:
+        tariff = current_tariff()
+    if starts is not None and tariff.bands:
+        starts = np.asarray(starts, dtype=np.float64)
+        if starts.shape != distances.shape:
+            raise ValueError("Los arrays de distancias e inicios deben tener la misma forma")
+        rates = schedule_for(tariff).rates_at(starts)
+        base_micros, km_micros = rates[..., 2], rates[..., 3]
+    else:
+        base_micros, km_micros = tariff.base_micros, tariff.km_micros
+    bad = _bad_indices(~_distance_fits(distances, base_micros, km_micros))
+    if bad:
+        raise ValueError(f"La distancia es demasiado grande (índices: {bad})")
+    return nanos_to_cents(_distance_nanos(to_meters(distances), base_micros, km_micros))
+
+def calculate_distance_fares(distances, tariff=None, starts=None):
+    '''
+    Calcula la tarifa por distancia de muchos viajes a la vez.
+    Devuelve un array float64 con una tarifa por viaje, en euros.
+    '''
+    return cents_to_euros(calculate_distance_fares_cents(distances, tariff, starts))
+
+# =========================
+# Tarifas con franjas horarias
+# =========================
+
+def calculate_segment_nanos(starts, ends, moving, tariff=None):
+    '''
+    Coste por tiempo, en nano-euros, de tramos de viaje [inicio, fin) en
+    segundos locales (ver schedule.local_seconds); moving indica si el tramo
+    fue en movimiento. Un tramo que cruza varias franjas horarias se reparte
+    entre ellas. Los tramos no se redondean: se suman por viaje y el total
+    se pasa a céntimos con money.nanos_to_cents.
+    Acepta escalares o arrays (devuelve un int o un array int64).
+    '''
+    starts = np.asarray(starts, dtype=np.float64)
+    ends = np.asarray(ends, dtype=np.float64)
+    if starts.shape != ends.shape:
+        raise ValueError("Los arrays de inicio y fin deben tener la misma forma")
+    bad = _bad_indices(np.atleast_1d(ends < starts))
+    if bad:
+        raise ValueError(f"Los tramos no pueden terminar antes de empezar (índices: {bad})")
+    if tariff is None:
+        tariff = current_tariff()
+    return schedule_for(tariff).time_cost(starts, ends, moving)
@@ -0,0 +1,228 @@
+import time
+import numpy as np
+from config import current_tariff
+from fares import _time_nanos, _distance_nanos, calculate_time_fare
+from money import to_ms, to_meters, nanos_to_cents, cents_to_euros, round_seconds
+from schedule import schedule_for, local_seconds
+from events import START, STOP, MOVE, FINISH, DISTANCE
+
+# Estados (mismo significado que en meter.TripMeter)
+IDLE = 0
+STOPPED = 1
+MOVING = 2
+
+
+class FleetManager:
+    '''
+    Gestor de todos los viajes activos de una cochera.
+    Guarda el estado en arrays de NumPy (una columna por campo, una fila por viaje),
+    así cada evento se aplica en O(1) por id de viaje y las tarifas en vivo
+    de toda la flota se calculan en una sola pasada vectorizada.
+    Acumula los tiempos igual que TripMeter, así los resultados coinciden.
+    Si se indica listener, se llama listener(tipo, id_viaje, instante, valor)
+    en cada evento (por ejemplo, un events.EventLog, que usa ids enteros).
+    Cada fila guarda las tarifas vigentes al empezar su viaje, así una
+    recarga de la tarifa solo afecta a los viajes nuevos.
+    Con franjas horarias, cada tramo se cobra según las franjas que cruza
+    y la tarifa por distancia es la de la franja en la que empezó el viaje.
+    '''
+
+    def __init__(self, capacity=1024, clock=time.monotonic, listener=None, wall_clock=time.time):
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.listener = listener
+        self.slots = {}    # id de viaje -> fila
+        self.free = []     # filas libres para reutilizar
+        self.size = 0      # filas usadas alguna vez
+        self.tariff_codes = {}  # tarifa -> código (columna tariff_code)
+        self.coded = []         # código -> tarifa
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        def grow(old, dtype):
+            new = np.zeros(capacity, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+        self.ids = grow(getattr(self, 'ids', None), object)
+        self.state = grow(getattr(self, 'state', None), np.uint8)
+        self.state_start = grow(getattr(self, 'state_start', None), np.float64)
+        self.stopped_time = grow(getattr(self, 'stopped_time', None), np.float64)
+        self.moving_time = grow(getattr(self, 'moving_time', None), np.float64)
+        self.distance = grow(getattr(self, 'distance', None), np.float64)
+        self.tariffs = grow(getattr(self, 'tariffs', None), object)
+        self.tariff_code = grow(getattr(self, 'tariff_code', None), np.int32)
+        # Tarifas por fila (copiadas de self.tariffs para el cálculo vectorizado)
+        self.stopped_micros = grow(getattr(self, 'stopped_micros', None), np.int64)
+        self.moving_micros = grow(getattr(self, 'moving_micros', None), np.int64)
+        self.base_micros = grow(getattr(self, 'base_micros', None), np.int64)
+        self.km_micros = grow(getattr(self, 'km_micros', None), np.int64)
+        # Solo con franjas: reloj del medidor -> segundos locales, y coste de los tramos cerrados
+        self.wall_offset = grow(getattr(self, 'wall_offset', None), np.float64)
+        self.cost = grow(getattr(self, 'cost', None), np.int64)  # nano-euros
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, trip_id):
+        return trip_id in self.slots
+
+    def _slot(self, trip_id):
+        try:
+            return self.slots[trip_id]
+        except KeyError:
+            raise KeyError(f"No hay un viaje en curso con id {trip_id}") from None
+
+    # =========================
+    # Eventos
+    # =========================
+    def start(self, trip_id, now=None, tariff=None):
+        '''Inicia un viaje en estado parado. Sin tariff se usa la tarifa vigente.'''
+        if trip_id in self.slots:
+            raise RuntimeError(f"Ya hay un viaje en curso con id {trip_id}")
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self._allocate(self.capacity * 2)
+            slot = self.size
+            self.size += 1
+        if now is None:
+            now = self.clock()
+        self.slots[trip_id] = slot
+        self.ids[slot] = trip_id
+        self.state[slot] = STOPPED
+        self.state_start[slot] = now
+        self.stopped_time[slot] = 0.0
+        self.moving_time[slot] = 0.0
+        self.distance[slot] = 0.0
+        if tariff is None:
+            tariff = current_tariff()
+        self.tariffs[slot] = tariff
+        code = self.tariff_codes.get(tariff)
+        if code is None:
+            code = self.tariff_codes[tariff] = len(self.coded)
+            self.coded.append(tariff)
+        self.tariff_code[slot] = code
+        self.stopped_micros[slot] = tariff.stopped_micros
+        self.moving_micros[slot] = tariff.moving_micros
+        self.base_micros[slot] = tariff.base_micros
+        self.km_micros[slot] = tariff.km_micros
+        self.cost[slot] = 0
+        if tariff.bands:
+            self.wall_offset[slot] = local_seconds(self.wall_clock()) - now
+            _, _, self.base_micros[slot], self.km_micros[slot] = \
+                schedule_for(tariff).rates_at(now + self.wall_offset[slot]).tolist()
+        if self.listener is not None:
+            self.listener(START, trip_id, now, float(tariff.version))
+
+    def _switch(self, trip_id, state, kind, now):
+        slot = self._slot(trip_id)
+        if now is None:
+            now = self.clock()
+        # Convertir a float de Python para sumar exactamente igual que TripMeter
+        duration = now - float(self.state_start[slot])
+        tariff = self.tariffs[slot]
+        if tariff.bands:
+            offset = float(self.wall_offset[slot])
+            self.cost[slot] += schedule_for(tariff).time_cost(
+                float(self.state_start[slot]) + offset, now + offset, self.state[slot] == MOVING)
+        if self.state[slot] == STOPPED:
+            self.stopped_time[slot] = float(self.stopped_time[slot]) + duration
+        else:
+            self.moving_time[slot] = float(self.moving_time[slot]) + duration
+        self.state_start[slot] = now
+        self.state[slot] = state
+        if self.listener is not None:
+            self.listener(kind, trip_id, now, 0.0)
+        return slot
+
+    def stop(self, trip_id, now=None):
+        self._switch(trip_id, STOPPED, STOP, now)
+
+    def move(self, trip_id, now=None):
+        self._switch(trip_id, MOVING, MOVE, now)
+
+    def add_distance(self, trip_id, km):
+        '''Suma kilómetros recorridos a un viaje.'''
+        if km < 0:
+            raise ValueError("La distancia no puede ser negativa")
+        self.distance[self._slot(trip_id)] += km
+        if self.listener is not None:
+            self.listener(DISTANCE, trip_id, self.clock(), km)
+
+    def distance_fare(self, trip_id):
+        '''Tarifa por distancia de un viaje activo (con la franja en la que empezó).'''
+        slot = self._slot(trip_id)
+        nanos = _distance_nanos(to_meters(float(self.distance[slot])),
+                                int(self.base_micros[slot]), int(self.km_micros[slot]))
+        return cents_to_euros(nanos_to_cents(nanos))
+
+    def finish(self, trip_id, now=None):
+        '''
+        Termina un viaje y libera su fila.
+        Devuelve (tiempo parado, tiempo en movimiento, distancia, tarifa por tiempo),
+        con los tiempos al centésimo y cobrados como en TripMeter.finish.
+        '''
+        slot = self._switch(trip_id, IDLE, FINISH, now)
+        stopped = round_seconds(float(self.stopped_time[slot]))
+        moving = round_seconds(float(self.moving_time[slot]))
+        distance = float(self.distance[slot])
+        tariff = self.tariffs[slot]
+        if tariff.bands:
+            fare = cents_to_euros(nanos_to_cents(int(self.cost[slot])))
+        else:
+            fare = calculate_time_fare(stopped, moving, tariff)
+        del self.slots[trip_id]
+        self.ids[slot] = None
+        self.tariffs[slot] = None
+        self.free.append(slot)
+        return stopped, moving, distance, fare
+
+    # =========================
+    # Tarifas en vivo (vectorizadas)
+    # =========================
+    def elapsed(self, now=None):
+        '''Tiempos parado y en movimiento de todas las filas, incluido el tramo actual.'''
+        if now is None:
+            now = self.clock()
+        n = self.size
+        state = self.state[:n]
+        duration = now - self.state_start[:n]
+        stopped = self.stopped_time[:n] + np.where(state == STOPPED, duration, 0.0)
+        moving = self.moving_time[:n] + np.where(state == MOVING, duration, 0.0)
+        return stopped, moving
+
+    def live_fares(self, now=None):
+        '''
+        Tarifa por tiempo de todos los viajes activos en una pasada.
+        Devuelve (ids, tarifas).
+        '''
+        if now is None:
+            now = self.clock()
+        stopped, moving = self.elapsed(now)
+        n = self.size
+        active = self.state[:n] != IDLE
+        nanos = _time_nanos(to_ms(stopped[active]), to_ms(moving[active]),
+                            self.stopped_micros[:n][active], self.moving_micros[:n][active])
+        # Los viajes con franjas: coste acumulado + tramo actual, por tarifa
+        codes = self.tariff_code[:n][active]
+        for code in np.unique(codes).tolist():
+            tariff = self.coded[code]
+            if not tariff.bands:
+                continue
+            same = codes == code
+            slots = np.flatnonzero(active)[same]
+            offset = self.wall_offset[slots]
+            nanos[same] = self.cost[slots] + schedule_for(tariff).time_cost(
+                self.state_start[slots] + offset, now + offset, self.state[slots] == MOVING)
+        return self.ids[:n][active], cents_to_euros(nanos_to_cents(nanos))
+
+    def live_distance_fares(self):
+        '''Tarifa por distancia de los viajes activos que ya han recorrido algo.'''
+        n = self.size
+        active = (self.state[:n] != IDLE) & (self.distance[:n] > 0)
+        nanos = _distance_nanos(to_meters(self.distance[:n][active]),
+                                self.base_micros[:n][active], self.km_micros[:n][active])
+        return self.ids[:n][active], cents_to_euros(nanos_to_cents(nanos))
@@ -1,100 +1,77 @@
 import sys
 import os
-import time
 import logging
-from datetime import datetime
 from PyQt5.QtWidgets import (
-    QApplication, QWidget, QLabel, QPushButton, QLineEdit, QTextEdit,
+    QApplication, QWidget, QLabel, QPushButton, QLineEdit,
     QVBoxLayout, QHBoxLayout, QMessageBox, QScrollArea
 )
 from PyQt5.QtGui import QMovie
-from PyQt5.QtCore import Qt, QTimer
-from history import save_history, read_history 
-from config import fare_config
-from taximeter import calculate_time_fare, calculate_distance_fare
+from PyQt5.QtCore import Qt, QTimer, QThreadPool
+from history import close_history
+from history_view import HistoryWindow, HistorySaver
+from config import history_config, log_config, watch_tariff
+from log_setup import setup_logging
+from events import open_event_log
+from checkpoint import open_checkpoint, recover
+from metrics import timer, start_exporter
+from taximeter import calculate_distance_fare
+from meter import TripMeter, time_trip_info, distance_trip_info
 
 # =========================
 # Logging y configuración
 # =========================
-if not os.path.exists('logs'):
-    os.makedirs('logs')
+setup_logging(os.path.join('logs', 'taximeter_gui.log'), **log_config())
 
-logging.basicConfig(
-    filename='logs/taximeter_gui.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-config = fare_config()
-trip_active = False
-start_time = None
-stopped_time = 0
-moving_time = 0
-state = None
+watch_tariff()
+start_exporter()
+settings = history_config()
+checkpoint = open_checkpoint(settings['checkpoint'], 'gui')
+meter = TripMeter(listener=open_event_log(settings['event_log']), checkpoint=checkpoint)
 
 # =========================
 # Funciones de control
 # =========================
 def start_trip():
-    global trip_active, start_time, stopped_time, moving_time, state
-    if trip_active:
+    if meter.active:
         QMessageBox.warning(None, "Advertencia", "Ya hay un viaje en curso")
         logging.error("Intento de iniciar un viaje cuando ya hay uno en curso")
         return
-    trip_active = True
-    start_time = time.time()
-    stopped_time = 0
-    moving_time = 0
-    state = 'stopped'
+    # Los manejadores se miden sin los diálogos, que esperan al usuario
+    with timer('gui_handler_seconds', handler='start_trip'):
+        meter.start()
+        logging.info("Viaje iniciado (modo GUI)")
     QMessageBox.information(None, "Info", "El viaje ha sido iniciado. Estado inicial: parado.")
-    logging.info("Viaje iniciado (modo GUI)")
 
 def stop_trip():
-    global trip_active, start_time, stopped_time, moving_time, state
-    if not trip_active:
+    if not meter.active:
         QMessageBox.warning(None, "Advertencia", "No hay un viaje en curso")
         logging.error("Intento de parar un viaje cuando no hay uno en curso")
         return
-    now = time.time()
-    if state == 'moving':
-        moving_time += now - start_time
-    else:
-        stopped_time += now - start_time
-    state = 'stopped'
-    start_time = now
-    update_labels()
-    logging.info("Estado de Viaje: parado")
+    with timer('gui_handler_seconds', handler='stop_trip'):
+        meter.stop()
+        update_labels()
+        logging.info("Estado de Viaje: parado")
 
 def move_trip():
-    global trip_active, start_time, stopped_time, moving_time, state
-    if not trip_active:
+    if not meter.active:
         QMessageBox.warning(None, "Advertencia", "No hay un viaje en curso")
         logging.error("Intento de mover un viaje cuando no hay uno en curso")
         return
-    now = time.time()
-    if state == 'stopped':
-        stopped_time += now - start_time
-    else:
-        moving_time += now - start_time
-    state = 'moving'
-    start_time = now
-    update_labels()
-    logging.info("Estado de Viaje: en movimiento")
+    with timer('gui_handler_seconds', handler='move_trip'):
+        meter.move()
+        update_labels()
+        logging.info("Estado de Viaje: en movimiento")
 
 
 def finish_trip():
-    global trip_active, start_time, stopped_time, moving_time, state
-    if not trip_active:
+    if not meter.active:
         QMessageBox.warning(None, "Advertencia", "No hay un viaje en curso")
         logging.error("Intento de finalizar un viaje cuando no hay uno en curso")
         return
-    now = time.time()
-    if state == 'stopped':
-        stopped_time += now - start_time
-    else:
-        moving_time += now - start_time
-    trip_active = False
-    total_fare = calculate_time_fare(stopped_time, moving_time)
+    with timer('gui_handler_seconds', handler='finish_trip'):
+        stopped_time, moving_time, total_fare = meter.finish()
+        #Guardar en Historial (en segundo plano, ver on_trip_saved)
+        saver.save(time_trip_info(stopped_time, moving_time, total_fare))
     QMessageBox.information(
         None,
         "Fin del viaje, resumen",
@@ -102,18 +79,6 @@ def finish_trip():
         f"Tiempo en movimiento: {moving_time:.2f} s\n"
         f"Total a pagar: {total_fare:.2f} €"
     )
-    #Guardar en Historial
-    trip_info = {
-        'fecha': datetime.now(),
-        'tipo': 'tiempo',
-        'tiempo_parado': round(stopped_time, 2),
-        'tiempo_movimiento': round(moving_time, 2),
-        'duracion_total': round(stopped_time + moving_time, 2),
-        'coste_total': round(total_fare, 2)
-    }
-    save_history(trip_info)
-    logging.info("Trayecto por tiempo guardado en historial")
-    reset_time_trip()
 
 def start_distance_trip():
     try:
@@ -124,38 +89,21 @@ def start_distance_trip():
         QMessageBox.warning(None, "Advertencia", "Distancia inválida. Debe ser un número positivo.")
         logging.error("Distancia inválida ingresada para viaje por distancia")
         return
-    total_fare = calculate_distance_fare(distance)
+    total_fare, trip_info = distance_trip_info(distance)
+    saver.save(trip_info)
     QMessageBox.information(
         None,
         "Fin del viaje por distancia, resumen: ",
         f"Distancia: {distance:.2f} km\nTotal a pagar: {total_fare:.2f} €"
     )
-    trip_info = {
-        'fecha': datetime.now(),
-        'tipo': 'distancia',
-        'distancia_total': round(distance, 2),
-        'coste_total': round(total_fare, 2)
-    }
-    save_history(trip_info)
-    logging.info("Trayecto por distancia guardado en historial")
     gui.fare_distance_label.setText("Tarifa actual: 0.00 €")
     gui.distance_entry.clear()
 
-def reset_time_trip():
-    global trip_active, start_time, stopped_time, moving_time, state
-    trip_active = False
-    start_time = None
-    stopped_time = 0
-    moving_time = 0
-    state = None
-    
 def update_labels():
+    stopped_time, moving_time = meter.elapsed()
     gui.stopped_label.setText(f"Tiempo parado: {stopped_time:.2f} s")
     gui.moving_label.setText(f"Tiempo en movimiento: {moving_time:.2f} s")
-    if trip_active:
-        gui.fare_label.setText(f"Tarifa actual: {calculate_time_fare(stopped_time, moving_time):.2f} €")
-    else:
-        gui.fare_label.setText("Tarifa actual: 0.00 €")
+    gui.fare_label.setText(f"Tarifa actual: {meter.current_fare():.2f} €")
 
 def update_distance_fare():
     try:
@@ -166,36 +114,63 @@ def update_distance_fare():
         gui.fare_distance_label.setText("Tarifa actual: 0.00 €")
 
 def update_time_labels():
-    if trip_active and start_time is not None:
-        now = time.time()
-        duration = now - start_time
-        current_stopped = stopped_time + duration if state == 'stopped' else stopped_time
-        current_moving = moving_time + duration if state == 'moving' else moving_time
-        gui.stopped_label.setText(f"Tiempo parado: {current_stopped:.2f} s")
-        gui.moving_label.setText(f"Tiempo en movimiento: {current_moving:.2f} s")
-        gui.fare_label.setText(f"Tarifa actual: {calculate_time_fare(current_stopped, current_moving):.2f} €")
-
-#Mostrar historial
-def show_history():
-    hist_window = QWidget()
-    hist_window.setWindowTitle("Historial de viajes")
-    hist_window.setGeometry(150, 150, 500, 500)
+    if meter.active:
+        with timer('gui_handler_seconds', handler='update_time_labels'):
+            update_labels()
+
+def recover_trip():
+    '''
+    Si la GUI se cerró de golpe a mitad de viaje, pregunta si retomarlo;
+    si no, lo cierra cobrando hasta el último checkpoint y lo guarda en el historial.
+    '''
+    snapshot = checkpoint.load() if checkpoint is not None else None
+    if snapshot is None:
+        return
+    resume = False
+    if not snapshot['finished']:
+        stopped, moving = snapshot['elapsed']
+        answer = QMessageBox.question(
+            None, "Viaje interrumpido",
+            f"Hay un viaje interrumpido:\n"
+            f"Tiempo parado: {stopped:.2f} s\n"
+            f"Tiempo en movimiento: {moving:.2f} s\n"
+            f"¿Retomarlo? Si no, se cerrará y se guardará en el historial.")
+        resume = answer == QMessageBox.Yes
+    result = recover(meter, snapshot, resume)
+    if result is None:
+        update_labels()
+        return
+    stopped_time, moving_time, total_fare = result
+    saver.save(time_trip_info(stopped_time, moving_time, total_fare))
+    QMessageBox.information(
+        None,
+        "Viaje interrumpido cerrado",
+        f"Tiempo parado: {stopped_time:.2f} s\n"
+        f"Tiempo en movimiento: {moving_time:.2f} s\n"
+        f"Total a pagar: {total_fare:.2f} €"
+    )
 
-    layout = QVBoxLayout()
+def on_trip_saved(trip_info):
+    logging.info("Trayecto por %s guardado en historial", trip_info['tipo'])
+    if checkpoint is not None and trip_info['tipo'] == 'tiempo':
+        checkpoint.release()
+    # Si el historial está abierto, que muestre el trayecto nuevo
+    hist_window = getattr(gui, 'hist_window', None)
+    if hist_window is not None and hist_window.isVisible():
+        hist_window.model.reload()
 
-    title_label = QLabel("Historial de Viajes")
-    title_label.setStyleSheet("font-size:16pt; font-weight:bold; color:white;")
-    title_label.setAlignment(Qt.AlignCenter)
-    layout.addWidget(title_label)
+def on_trip_failed(trip_info, message):
+    logging.error("Error al guardar el trayecto por %s: %s", trip_info['tipo'], message)
+    QMessageBox.warning(None, "Advertencia",
+                        f"No se pudo guardar el trayecto: {message}\nSe volverá a intentar al cerrar.")
 
-    text_area = QTextEdit()
-    text_area.setReadOnly(True)
-    text_area.setStyleSheet("background-color:#2B2B2B; color:white; font-family:Consolas; font-size:11pt;")
-    text_area.setText(read_history())
-    layout.addWidget(text_area)
+#Mostrar historial
+history_window = None
 
-    hist_window.setLayout(layout)
-    hist_window.show()
+def show_history():
+    global history_window
+    history_window = HistoryWindow()
+    history_window.show()
 
 
 # =========================
@@ -229,10 +204,15 @@ class Taximeter(QWidget):
         # Construir widgets
         self.init_ui()
 
-        # Timer actualización tiempo
+        # Timer actualización tiempo (update_time_labels, instrumentada en las métricas)
         self.timer = QTimer()
-        self.timer.timeout.connect(self.update_time_labels)
+        self.timer.timeout.connect(update_time_labels)
         self.timer.start(1000)
+        # Checkpoint del viaje en curso (escribe en memoria, sin fsync)
+        if checkpoint is not None:
+            self.checkpoint_timer = QTimer()
+            self.checkpoint_timer.timeout.connect(checkpoint.touch)
+            self.checkpoint_timer.start(max(1, int(settings['checkpoint_interval'] * 1000)))
 
     # =========================
     # Ajustar fondo y scroll al redimensionar
@@ -336,42 +316,36 @@ class Taximeter(QWidget):
             }}
         """)
 
-    # =========================
-    # Funciones actualización labels
-    # =========================
-    def update_time_labels(self):
-        global start_time, stopped_time, moving_time, state
-        if trip_active and start_time is not None:
-            now = time.time()
-            duration = now - start_time
-            current_stopped = stopped_time + duration if state == 'stopped' else stopped_time
-            current_moving = moving_time + duration if state == 'moving' else moving_time
-            self.stopped_label.setText(f"Tiempo parado: {current_stopped:.2f} s")
-            self.moving_label.setText(f"Tiempo en movimiento: {current_moving:.2f} s")
-            self.fare_label.setText(f"Tarifa actual: {calculate_time_fare(current_stopped, current_moving):.2f} €")
-
     # =========================
     # Historial
     # =========================
     def show_history(self):
-        self.hist_window = QWidget()
-        self.hist_window.setWindowTitle("Historial de viajes")
-        self.hist_window.setGeometry(150, 150, 500, 500)
-
-        layout = QVBoxLayout()
-        text_area = QTextEdit()
-        text_area.setReadOnly(True)
-        text_area.setText(read_history())
-        text_area.setStyleSheet("background-color:#2B2B2B; color:white; font-family:Consolas; font-size:11pt;")
-        layout.addWidget(text_area)
-
-        self.hist_window.setLayout(layout)
+        self.hist_window = HistoryWindow()
         self.hist_window.show()
 
+    # =========================
+    # Cierre: no perder trayectos pendientes
+    # =========================
+    def closeEvent(self, event):
+        lost = saver.close()
+        QThreadPool.globalInstance().waitForDone()  # consultas del historial en curso
+        close_history()
+        if checkpoint is not None and not lost:
+            # El último viaje ya está en el historial (las señales saved no llegarán)
+            checkpoint.release()
+        if lost:
+            QMessageBox.critical(self, "Error",
+                                 f"No se pudieron guardar {len(lost)} trayecto(s). Los datos están en el log.")
+        super().closeEvent(event)
+
 # =========================
 # Ejecutar app
 # =========================
 app = QApplication(sys.argv)
+saver = HistorySaver()
+saver.saved.connect(on_trip_saved)
+saver.failed.connect(on_trip_failed)
 gui = Taximeter()
 gui.show()
+recover_trip()
 sys.exit(app.exec_())
\ No newline at end of file
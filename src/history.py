@@ -1,39 +1,157 @@
 import os
-from datetime import datetime
+import atexit
+import threading
+from concurrent.futures import Future
+from config import history_config
+from storage import TextBackend, SQLiteBackend, format_block
+from writer import HistoryWriter
+from metrics import timed
 
-def save_history(trip_info):
+HISTORY_FILE = os.path.join('data', 'historial.txt')
+HISTORY_DB = os.path.join('data', 'historial.db')
+
+# Backends disponibles: nombre -> (clase, ruta por defecto)
+BACKENDS = {
+    'sqlite': (SQLiteBackend, HISTORY_DB),
+    'text': (TextBackend, HISTORY_FILE),
+}
+
+_backend = None
+_writer = None
+# La GUI abre el historial desde sus hilos de fondo: que solo se cree una vez
+_setup_lock = threading.Lock()
+
+def open_backend(name=None, path=None, settings=None):
+    """
+    Abre un backend del historial: name ('sqlite' o 'text', por defecto el de
+    HISTORY_BACKEND) en path (por defecto su ruta de siempre), con los
+    segmentos del .env si es de texto.
+    """
+    settings = settings or history_config()
+    backend_class, default_path = BACKENDS[name or settings['backend']]
+    if backend_class is TextBackend:
+        return TextBackend(path or default_path, settings['segment_bytes'], settings['segment_daily'])
+    return backend_class(path or default_path)
+
+def _setup():
+    """Crea el backend (y el escritor en segundo plano) según el .env."""
+    global _backend, _writer
+    with _setup_lock:
+        if _backend is not None:
+            return
+        settings = history_config()
+        backend = open_backend(settings=settings)
+        if settings['async']:
+            _writer = HistoryWriter(backend, settings['batch_size'],
+                                    settings['flush_interval'], settings['durability'])
+        else:
+            backend.set_durability(settings['durability'])
+        _backend = backend
+        atexit.register(close_history)
+
+def get_backend():
+    """
+    Devuelve el backend del historial, creándolo la primera vez según el .env.
+    Antes de devolverlo espera a que el escritor haya guardado lo pendiente,
+    así las lecturas ven siempre los trayectos ya enviados.
+    """
+    if _backend is None:
+        _setup()
+    if _writer is not None:
+        _writer.flush()
+    return _backend
+
+def set_backend(backend, writer=None):
+    """Cambia el backend del historial (por ejemplo, en tests o migraciones)."""
+    global _backend, _writer
+    close_history()
+    _backend = backend
+    _writer = writer
+
+def close_history():
+    """Escribe lo pendiente y cierra el backend actual."""
+    global _backend, _writer
+    if _writer is not None:
+        _writer.close()
+    if _backend is not None:
+        _backend.close()
+    _backend = None
+    _writer = None
+
+@timed('history_save_seconds')
+def save_history(trip_info, wait=False):
     """
-    Guarda un trayecto en /data/historial.txt
+    Guarda un trayecto en el backend del historial.
     Compatible con trayectos por tiempo y por distancia.
+    Devuelve un Future que se completa cuando el trayecto está escrito (sin
+    escritor en segundo plano, ya completado) o con la excepción si no se
+    pudo guardar; con wait=True espera a ese momento y, si no se pudo
+    guardar, lanza la excepción en lugar de mostrarla.
     """
-    os.makedirs('data', exist_ok=True)
-    ruta = os.path.join('data', 'historial.txt')
-    
+    if _backend is None:
+        _setup()
     try:
-        with open(ruta, 'a', encoding='utf-8') as f:
-            f.write("\n==============================\n")
-            f.write(f"Fecha: {trip_info['fecha'].strftime('%Y-%m-%d %H:%M:%S')}\n")
-            f.write(f"Tipo de trayecto: {trip_info['tipo']}\n")
-            
-            if trip_info['tipo'] == 'distancia':
-                f.write(f"Distancia: {trip_info['distancia_total']} km\n")
-                
-            if trip_info['tipo'] == 'tiempo':
-                f.write(f"Tiempo parado: {trip_info['tiempo_parado']} segundos\n")
-                f.write(f"Tiempo en movimiento: {trip_info['tiempo_movimiento']} segundos\n")
-                f.write(f"Duración total: {trip_info['duracion_total']} segundos\n")
-                
-            f.write(f"Coste total: {trip_info['coste_total']} €\n")
-            f.write("==============================\n")
+        if _writer is not None:
+            future = _writer.submit(trip_info)
+            if wait:
+                future.result()
+            return future
+        _backend.append(trip_info)
+        future = Future()
+        future.set_result(None)
+        return future
     except Exception as e:
+        if wait:
+            raise
         print(f"Error al guardar el historial: {e}")
-        
-HISTORY_FILE = os.path.join('data', 'historial.txt')
+        # Quien espera el Future (p. ej. checkpoint.release) ve que falló
+        future = Future()
+        future.set_exception(e)
+        return future
 
 def read_history():
-    """Lee todo el historial del archivo historial.txt y lo devuelve como texto."""
-    if not os.path.exists(HISTORY_FILE):
+    """Devuelve todo el historial como texto, con el formato clásico de historial.txt."""
+    text = get_backend().read_text()
+    if not text:
         return "No hay historial todavía."
-    
-    with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
-        return f.read()
+    return text
+
+def query_history(start=None, end=None, tipo=None, min_cost=None, max_cost=None,
+                  order_by='fecha', descending=False, offset=0, limit=None):
+    """
+    Devuelve los trayectos (dicts) que cumplen los filtros.
+    start es inclusivo y end exclusivo.
+    """
+    return get_backend().query(start, end, tipo, min_cost, max_cost,
+                               order_by, descending, offset, limit)
+
+def count_history(start=None, end=None, tipo=None, min_cost=None, max_cost=None):
+    """Cuenta los trayectos que cumplen los filtros."""
+    return get_backend().count(start, end, tipo, min_cost, max_cost)
+
+def revenue(start=None, end=None, tipo=None):
+    """Suma el coste total de los trayectos entre dos fechas."""
+    return get_backend().revenue(start, end, tipo)
+
+def summary_history(start=None, end=None, tipo=None):
+    """
+    Totales (viajes, coste_total, tiempo_parado, tiempo_movimiento, distancia_total)
+    de los días entre start (inclusivo) y end (exclusivo). Se leen de los
+    totales por día que mantiene el backend, sin recorrer los trayectos.
+    """
+    return get_backend().summary(start, end, tipo)
+
+def daily_summary(start=None, end=None, tipo=None):
+    """Filas (día, tipo, viajes, céntimos, ms parado, ms en movimiento, metros)."""
+    return get_backend().daily_summary(start, end, tipo)
+
+def rebuild_summary(check_only=False):
+    """Recalcula los totales por día desde el historial. Devuelve las diferencias encontradas."""
+    return get_backend().rebuild_summary(check_only)
+
+def export_text(path=HISTORY_FILE):
+    """Exporta todo el historial al formato de texto clásico."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for trip in get_backend().iter_trips():
+            f.write(format_block(trip))
@@ -0,0 +1,419 @@
+import os
+import mmap
+import zlib
+import threading
+from contextlib import contextmanager
+import numpy as np
+from trip_format import SEPARATOR, CONTROL, parse_blocks, parse_control
+from money import euros_to_cents, cents_to_euros
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# =========================
+# Índice lateral (historial.txt.idx)
+# =========================
+# Un registro de ancho fijo por trayecto:
+# (offset del bloque en bytes, timestamp de la fecha, coste total)
+INDEX_DTYPE = np.dtype([('offset', '<u8'), ('timestamp', '<f8'), ('cost', '<f8')])
+SEPARATOR_LINE = (SEPARATOR + "\n").encode('utf-8')
+CONTROL_PREFIX = (CONTROL + ":").encode('utf-8')
+O_BINARY = getattr(os, 'O_BINARY', 0)
+
+
+def index_path_for(history_path):
+    """Ruta del índice lateral de un archivo de historial."""
+    return history_path + '.idx'
+
+
+def _entry(offset, trip):
+    return (offset, trip['fecha'].timestamp(), trip['coste_total'])
+
+
+def _map(path):
+    """Mapea un archivo en memoria (solo lectura). Devuelve None si está vacío."""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return None
+    with open(path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _framed_block(data, opening, control_start):
+    """
+    Comprueba el bloque con línea de control que abre el separador en opening.
+    Devuelve (trayecto, fin) si está entero y su CRC cuadra, o None si no.
+    """
+    control_end = data.find(b"\n", control_start)
+    if control_end == -1:
+        return None
+    control = parse_control(data[control_start + len(CONTROL_PREFIX):control_end].decode(
+        'utf-8', errors='replace').strip())
+    if control is None:
+        return None
+    length, crc = control
+    body_end = control_end + 1 + length
+    end = body_end + len(SEPARATOR_LINE)
+    if data[body_end:end] != SEPARATOR_LINE or zlib.crc32(data[control_end + 1:body_end]) != crc:
+        return None
+    trips = list(parse_blocks(data[opening:end].decode('utf-8', errors='replace').splitlines()))
+    return (trips[0], end) if trips else None
+
+
+def scan_blocks(data, start=0):
+    """
+    Recorre los bytes del historial desde start y devuelve
+    (offset, trayecto, fin) por cada bloque completo.
+    El offset apunta a la línea separadora que abre el bloque.
+    Los bloques con línea de control cortados o dañados se saltan y la
+    búsqueda sigue en el siguiente separador.
+    """
+    pos = start
+    opening = None
+    size = len(data)
+    while pos < size:
+        end = data.find(b"\n", pos)
+        end = size if end == -1 else end + 1
+        if data[pos:end] == SEPARATOR_LINE:
+            if data[end:end + len(CONTROL_PREFIX)] == CONTROL_PREFIX:
+                opening = None
+                block = _framed_block(data, pos, end)
+                if block is not None:
+                    yield pos, *block
+                    pos = block[1]
+                    continue
+            elif opening is None:
+                opening = pos
+            else:
+                block = data[opening:end].decode('utf-8', errors='replace')
+                for trip in parse_blocks(block.splitlines()):
+                    yield opening, trip, end
+                opening = None
+        pos = end
+
+
+@contextmanager
+def locked(fd, shared=False):
+    """
+    Candado entre procesos sobre un archivo abierto: exclusivo, o compartido
+    con shared=True (en Windows siempre es exclusivo).
+    """
+    if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            os.lseek(fd, 0, os.SEEK_SET)
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+
+
+class HistoryIndex:
+    """
+    Índice lateral del historial de texto.
+    Permite saltar a cualquier trayecto o rango de fechas sin leer el archivo completo.
+    Las escrituras en historial.txt no lo tocan (así varios procesos pueden
+    añadir trayectos sin esperarse): catch_up lo pone al día antes de cada
+    lectura, leyendo solo lo escrito desde la última vez, con un candado
+    entre procesos (historial.txt.lock) para que las entradas sigan el orden
+    del archivo.
+    """
+
+    def __init__(self, history_path):
+        self.history_path = history_path
+        self.path = index_path_for(history_path)
+        self.fd = None
+        self.lock_fd = None
+        self.lock = threading.Lock()
+        # (entradas, fin del último bloque indexado) de la última puesta al día
+        self.position = (0, 0)
+        # (entradas revisadas, si sus fechas van en orden, última fecha): ver ordered
+        self.order = (0, True, None)
+
+    @contextmanager
+    def locked(self):
+        """
+        Candado exclusivo entre hilos y entre procesos (historial.txt.lock).
+        Reabre el índice si otro proceso lo ha regenerado o movido.
+        """
+        with self.lock:
+            if self.lock_fd is None:
+                self.lock_fd = open_lock(self.history_path)
+            with locked(self.lock_fd):
+                if self.fd is not None and not same_file(self.fd, self.path):
+                    self.close_file()
+                if self.fd is None:
+                    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT | O_BINARY, 0o644)
+                    self.position = (0, 0)
+                    self.order = (0, True, None)
+                yield self.fd
+
+    def _last_offset(self, fd):
+        """Offset del último trayecto indexado, o None si el índice está vacío."""
+        size = os.fstat(fd).st_size
+        # Una entrada a medias (caída durante la escritura) se descarta
+        if size % INDEX_DTYPE.itemsize:
+            size -= size % INDEX_DTYPE.itemsize
+            os.ftruncate(fd, size)
+        if size == 0:
+            return 0, None
+        os.lseek(fd, size - INDEX_DTYPE.itemsize, os.SEEK_SET)
+        last = np.frombuffer(os.read(fd, INDEX_DTYPE.itemsize), dtype=INDEX_DTYPE)
+        return size // INDEX_DTYPE.itemsize, int(last['offset'][0])
+
+    def catch_up(self):
+        """
+        Indexa los bloques del historial que aún no están en el índice
+        (escritos por este u otros procesos, o historiales antiguos sin índice).
+        Solo se lee a partir del último bloque indexado.
+        """
+        with self.locked() as fd:
+            self.catch_up_locked(fd)
+
+    def catch_up_locked(self, fd):
+        """catch_up con el candado ya tomado (fd: el índice, de locked())."""
+        data = _map(self.history_path)
+        if data is None:
+            return
+        try:
+            count, last = self._last_offset(fd)
+            start = 0
+            if count and self.position[0] == count:
+                start = self.position[1]
+            elif count:
+                first = next(scan_blocks(data, last), None)
+                if first is None or first[0] != last:
+                    # El índice no corresponde a este historial: se regenera
+                    os.ftruncate(fd, 0)
+                    count = 0
+                else:
+                    start = first[2]
+            new = [(offset, trip, end) for offset, trip, end in scan_blocks(data, start)]
+        finally:
+            data.close()
+        if new:
+            entries = np.array([_entry(offset, trip) for offset, trip, _ in new], dtype=INDEX_DTYPE)
+            os.lseek(fd, 0, os.SEEK_END)
+            os.write(fd, entries.tobytes())
+            count, start = count + len(new), new[-1][2]
+        self.position = (count, start)
+
+    def rebuild(self):
+        """
+        Regenera el índice completo desde el historial. Se escribe aparte y se
+        reemplaza, así los lectores que lo tengan mapeado no se ven afectados.
+        """
+        with self.locked():
+            tmp = self.path + '.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(build_index(self.history_path).tobytes())
+            self.close_file()
+            os.replace(tmp, self.path)
+            self.position = (0, 0)
+            self.order = (0, True, None)
+
+    def ordered(self, timestamps):
+        """
+        True si las fechas del índice (timestamps, en orden del archivo) son
+        crecientes. Los trayectos se suelen añadir al terminar, pero no siempre
+        (varios procesos, telemetría, migraciones): solo se revisan las
+        entradas nuevas desde la última vez.
+        """
+        count, ordered, last = self.order
+        if count > len(timestamps):
+            count, ordered, last = 0, True, None
+        if ordered and count < len(timestamps):
+            new = timestamps[count:]
+            ordered = bool(last is None or new[0] >= last) and is_ordered(new)
+            last = float(new[-1])
+        self.order = (len(timestamps), ordered, last)
+        return ordered
+
+    def close_file(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def close(self):
+        with self.lock:
+            self.close_file()
+            if self.lock_fd is not None:
+                os.close(self.lock_fd)
+                self.lock_fd = None
+
+    def load(self):
+        """Devuelve el índice como array estructurado de NumPy (mapeado en memoria)."""
+        return load_index(self.path)
+
+
+def load_index(path):
+    """Lee un archivo de índice (.idx) como array estructurado, mapeado en memoria."""
+    if not os.path.exists(path):
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    size = os.path.getsize(path) // INDEX_DTYPE.itemsize
+    if size == 0:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    return np.memmap(path, dtype=INDEX_DTYPE, mode='r', shape=(size,))
+
+
+def is_ordered(timestamps):
+    """True si las fechas van en orden creciente."""
+    return bool(np.all(timestamps[1:] >= timestamps[:-1]))
+
+
+def date_range(timestamps, start=None, end=None):
+    """Posiciones [lo, hi) de las entradas con start <= fecha < end (timestamps en orden)."""
+    lo = 0 if start is None else int(np.searchsorted(timestamps, start.timestamp(), 'left'))
+    hi = len(timestamps) if end is None else int(np.searchsorted(timestamps, end.timestamp(), 'left'))
+    return lo, max(lo, hi)
+
+
+def date_positions(timestamps, start=None, end=None, ordered=True):
+    """
+    Posiciones de las entradas con start <= fecha < end, en orden del archivo:
+    un range con búsqueda binaria si las fechas van en orden, o un array
+    con las que cumplen el filtro si no.
+    """
+    if ordered:
+        return range(*date_range(timestamps, start, end))
+    keep = np.ones(len(timestamps), dtype=bool)
+    if start is not None:
+        keep &= timestamps >= start.timestamp()
+    if end is not None:
+        keep &= timestamps < end.timestamp()
+    return np.flatnonzero(keep)
+
+
+def as_index(positions):
+    """Posiciones de date_positions como índice de NumPy (un range pasa a slice, sin copiar)."""
+    if isinstance(positions, range):
+        return slice(positions.start, positions.stop, positions.step)
+    return positions
+
+
+def build_index(history_path):
+    """Índice completo (array estructurado) de un archivo de historial, leyéndolo entero."""
+    data = _map(history_path)
+    if data is None:
+        return np.zeros(0, dtype=INDEX_DTYPE)
+    try:
+        return np.array([_entry(offset, trip) for offset, trip, _ in scan_blocks(data)], dtype=INDEX_DTYPE)
+    finally:
+        data.close()
+
+
+def open_lock(history_path):
+    """Abre el archivo de candado del historial (historial.txt.lock)."""
+    return os.open(history_path + '.lock', os.O_RDWR | os.O_CREAT | O_BINARY, 0o644)
+
+
+def same_file(fd, path):
+    """True si fd sigue siendo el archivo de path (no se ha reemplazado)."""
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(path))
+    except OSError:
+        return False
+
+
+# =========================
+# Lector mapeado en memoria
+# =========================
+class MappedHistory:
+    """
+    Lector del historial de texto con mmap y el índice lateral.
+    Acceso directo al trayecto n y búsqueda binaria por fecha.
+    Las fechas suelen ir en orden creciente, porque los trayectos se añaden
+    al terminar; si no (ordered es False), las búsquedas por fecha recorren
+    las fechas del índice.
+    """
+
+    def __init__(self, index, first_id=0):
+        self.first_id = first_id
+        self.index = index.load()
+        self.data = _map(index.history_path)
+        if self.data is None:
+            self.index = self.index[:0]
+        else:
+            # Ignora entradas que apunten más allá del final (escritura a medias);
+            # los offsets van en orden, así basta con cortar (sin copiar el índice)
+            self.index = self.index[:int(np.searchsorted(self.index['offset'], len(self.data)))]
+        self.ordered = index.ordered(self.index['timestamp'])
+
+    @classmethod
+    def from_data(cls, entries, data, first_id=0, ordered=None):
+        """Lector sobre un índice y unos datos ya cargados (p. ej. un segmento descomprimido)."""
+        reader = cls.__new__(cls)
+        reader.first_id = first_id
+        reader.index = entries
+        reader.data = data
+        reader.ordered = is_ordered(entries['timestamp']) if ordered is None else ordered
+        return reader
+
+    def __len__(self):
+        return len(self.index)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.data = None
+
+    def record(self, n):
+        """Devuelve el trayecto n (empezando en 0)."""
+        offset = int(self.index['offset'][n])
+        for _, trip, _ in scan_blocks(self.data, offset):
+            trip['id'] = self.first_id + n + 1
+            return trip
+        raise IndexError(n)
+
+    def records(self, positions):
+        return [self.record(int(n)) for n in positions]
+
+    def read(self, positions):
+        """Trayectos en positions (de date_positions): seguidos si son un tramo, si no uno a uno."""
+        if isinstance(positions, range) and positions.step == 1:
+            return self.records_range(positions.start, positions.stop)
+        return self.records(positions)
+
+    def records_range(self, lo, hi):
+        """
+        Trayectos lo..hi-1 de una vez: decodifica el tramo de bytes que ocupan
+        y lo analiza seguido, bastante más rápido que leerlos uno a uno.
+        """
+        hi = min(hi, len(self))
+        if lo >= hi:
+            return []
+        end = int(self.index['offset'][hi]) if hi < len(self) else len(self.data)
+        text = self.data[int(self.index['offset'][lo]):end].decode('utf-8', errors='replace')
+        trips = list(parse_blocks(text.splitlines()))
+        if len(trips) != hi - lo:
+            # El tramo no coincide con el índice (archivo modificado): uno a uno
+            return self.records(range(lo, hi))
+        for n, trip in enumerate(trips, self.first_id + lo + 1):
+            trip['id'] = n
+        return trips
+
+    def positions(self, start=None, end=None):
+        """Posiciones de los trayectos con start <= fecha < end (ver date_positions)."""
+        return date_positions(self.index['timestamp'], start, end, self.ordered)
+
+    def tail(self, k):
+        """Últimos k trayectos."""
+        return self.records(range(max(0, len(self) - k), len(self)))
+
+    def revenue(self, start=None, end=None):
+        costs = self.index['cost'][as_index(self.positions(start, end))]
+        return cents_to_euros(int(euros_to_cents(costs).sum()))
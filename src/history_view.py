@@ -0,0 +1,337 @@
+import logging
+import threading
+from datetime import datetime, timedelta
+from PyQt5.QtWidgets import (
+    QWidget, QLabel, QLineEdit, QComboBox, QPushButton, QTableView,
+    QHeaderView, QVBoxLayout, QHBoxLayout
+)
+from PyQt5.QtCore import (
+    Qt, QAbstractTableModel, QModelIndex, QObject, QRunnable, QThreadPool, pyqtSignal
+)
+from history import query_history, count_history, summary_history, save_history
+
+PAGE_SIZE = 200
+
+# (cabecera, clave del trayecto, columna de ordenación o None si no se puede ordenar)
+COLUMNS = [
+    ("Fecha", 'fecha', 'fecha'),
+    ("Tipo", 'tipo', 'tipo'),
+    ("Distancia (km)", 'distancia_total', None),
+    ("Parado (s)", 'tiempo_parado', None),
+    ("Movimiento (s)", 'tiempo_movimiento', None),
+    ("Coste (€)", 'coste_total', 'coste_total'),
+]
+
+
+# =========================
+# Carga en segundo plano
+# =========================
+class _PageSignals(QObject):
+    loaded = pyqtSignal(int, int, object)  # generación, total, filas
+    summarized = pyqtSignal(int, object)   # generación, totales (history.summary_history)
+    failed = pyqtSignal(int, str)
+
+
+class _PageLoader(QRunnable):
+    """Consulta una página del historial fuera del hilo de la interfaz."""
+
+    def __init__(self, generation, filters, order_by, descending, offset, with_count):
+        super().__init__()
+        self.signals = _PageSignals()
+        self.generation = generation
+        self.filters = filters
+        self.order_by = order_by
+        self.descending = descending
+        self.offset = offset
+        self.with_count = with_count
+
+    def run(self):
+        try:
+            total = count_history(**self.filters) if self.with_count else -1
+            rows = query_history(order_by=self.order_by, descending=self.descending,
+                                 offset=self.offset, limit=PAGE_SIZE, **self.filters)
+            # Los totales salen de los resúmenes por día: no recorren el historial
+            summary = summary_history(**self.filters) if self.with_count else None
+        except Exception as e:
+            self.signals.failed.emit(self.generation, str(e))
+            return
+        self.signals.loaded.emit(self.generation, total, rows)
+        if summary is not None:
+            self.signals.summarized.emit(self.generation, summary)
+
+
+# =========================
+# Guardado en segundo plano
+# =========================
+class _SaveSignals(QObject):
+    saved = pyqtSignal(object)        # trayecto
+    failed = pyqtSignal(object, str)  # trayecto, error
+
+
+class _TripSaver(QRunnable):
+    """Guarda un trayecto en el historial fuera del hilo de la interfaz."""
+
+    def __init__(self, saver, trip_info):
+        super().__init__()
+        self.signals = _SaveSignals()
+        self.saver = saver
+        self.trip_info = trip_info
+
+    def run(self):
+        try:
+            save_history(self.trip_info, wait=True)
+        except Exception as e:
+            self.saver._done(self.trip_info, e)
+            self.signals.failed.emit(self.trip_info, str(e))
+            return
+        self.saver._done(self.trip_info)
+        self.signals.saved.emit(self.trip_info)
+
+
+class HistorySaver(QObject):
+    """
+    Guarda los trayectos de la GUI en segundo plano, de uno en uno y en orden
+    (el historial va ordenado por fecha). Avisa con las señales saved y failed.
+    Lleva la cuenta de los trayectos sin confirmar: close() espera a los que
+    están en curso y reintenta los fallidos antes de cerrar la aplicación.
+    """
+    saved = pyqtSignal(object)
+    failed = pyqtSignal(object, str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.lock = threading.Lock()
+        self.pending = []  # enviados y aún sin guardar
+        self.unsaved = []  # el guardado falló; se reintentan al cerrar
+
+    def save(self, trip_info):
+        with self.lock:
+            self.pending.append(trip_info)
+        task = _TripSaver(self, trip_info)
+        task.signals.saved.connect(self.saved)
+        task.signals.failed.connect(self.failed)
+        self.pool.start(task)
+
+    def _done(self, trip_info, error=None):
+        """Lo llama el hilo de fondo al terminar, antes de emitir la señal."""
+        with self.lock:
+            self.pending = [trip for trip in self.pending if trip is not trip_info]
+            if error is not None:
+                self.unsaved.append(trip_info)
+
+    def close(self):
+        """
+        Espera a los guardados en curso y reintenta en este hilo los que fallaron.
+        Devuelve los trayectos que siguen sin guardar (quedan también en el log).
+        """
+        self.pool.waitForDone()
+        with self.lock:
+            retry, self.unsaved = self.unsaved + self.pending, []
+            self.pending = []
+        lost = []
+        for trip_info in retry:
+            try:
+                save_history(trip_info, wait=True)
+            except Exception as e:
+                logging.error("Trayecto no guardado en el historial (%s): %s", e, trip_info)
+                lost.append(trip_info)
+        return lost
+
+
+# =========================
+# Modelo de tabla paginado
+# =========================
+class TripTableModel(QAbstractTableModel):
+    """
+    Modelo del historial que solo carga las filas que la vista necesita,
+    página a página, consultando el backend del historial en segundo plano.
+    """
+    total_changed = pyqtSignal(int)
+    summary_changed = pyqtSignal(object)
+    load_failed = pyqtSignal(str)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+        self.total = 0
+        self.filters = {}
+        self.order_by = 'fecha'
+        self.descending = True
+        self.generation = 0
+        self.loading = False
+        self.pool = QThreadPool.globalInstance()
+
+    # --- API de QAbstractTableModel ---
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(COLUMNS)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return COLUMNS[section][0]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == Qt.TextAlignmentRole and index.column() >= 2:
+            return Qt.AlignRight | Qt.AlignVCenter
+        if role != Qt.DisplayRole:
+            return None
+        value = self.rows[index.row()].get(COLUMNS[index.column()][1])
+        if value is None:
+            return ""
+        if isinstance(value, datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        if isinstance(value, float):
+            return f"{value:.2f}"
+        return str(value)
+
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and not self.loading and len(self.rows) < self.total
+
+    def fetchMore(self, parent=QModelIndex()):
+        if self.canFetchMore(parent):
+            self._load(len(self.rows), with_count=False)
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        order_by = COLUMNS[column][2]
+        if order_by is None:
+            return
+        self.order_by = order_by
+        self.descending = order == Qt.DescendingOrder
+        self.reload()
+
+    # --- Carga ---
+    def set_filters(self, start=None, end=None, tipo=None):
+        self.filters = {'start': start, 'end': end, 'tipo': tipo}
+        self.reload()
+
+    def reload(self):
+        """Descarta las filas cargadas y pide la primera página de nuevo."""
+        self.generation += 1
+        self.beginResetModel()
+        self.rows = []
+        self.total = 0
+        self.endResetModel()
+        self._load(0, with_count=True)
+
+    def _load(self, offset, with_count):
+        self.loading = True
+        loader = _PageLoader(self.generation, dict(self.filters), self.order_by,
+                             self.descending, offset, with_count)
+        loader.signals.loaded.connect(self._on_loaded)
+        loader.signals.summarized.connect(self._on_summarized)
+        loader.signals.failed.connect(self._on_failed)
+        self.pool.start(loader)
+
+    def _on_loaded(self, generation, total, rows):
+        if generation != self.generation:
+            return  # respuesta de una consulta anterior (filtro u orden ya cambiado)
+        self.loading = False
+        if total >= 0:
+            self.total = total
+            self.total_changed.emit(total)
+        if rows:
+            first = len(self.rows)
+            self.beginInsertRows(QModelIndex(), first, first + len(rows) - 1)
+            self.rows.extend(rows)
+            self.endInsertRows()
+        elif total < 0:
+            # El historial se ha reducido mientras se paginaba
+            self.total = len(self.rows)
+
+    def _on_summarized(self, generation, summary):
+        if generation == self.generation:
+            self.summary_changed.emit(summary)
+
+    def _on_failed(self, generation, message):
+        if generation == self.generation:
+            self.loading = False
+            self.load_failed.emit(message)
+
+
+# =========================
+# Ventana del historial
+# =========================
+def _parse_day(text):
+    """Convierte 'AAAA-MM-DD' en datetime. Devuelve None si está vacío."""
+    text = text.strip()
+    if not text:
+        return None
+    return datetime.strptime(text, '%Y-%m-%d')
+
+
+class HistoryWindow(QWidget):
+    """Ventana del historial con tabla paginada, ordenación y filtros."""
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Historial de viajes")
+        self.setGeometry(150, 150, 700, 500)
+        self.setStyleSheet("background-color:#2B2B2B; color:white; font-size:11pt;")
+
+        layout = QVBoxLayout()
+
+        title_label = QLabel("Historial de Viajes")
+        title_label.setStyleSheet("font-size:16pt; font-weight:bold; color:white;")
+        title_label.setAlignment(Qt.AlignCenter)
+        layout.addWidget(title_label)
+
+        # Filtros
+        filters = QHBoxLayout()
+        self.from_entry = QLineEdit()
+        self.from_entry.setPlaceholderText("Desde (AAAA-MM-DD)")
+        self.to_entry = QLineEdit()
+        self.to_entry.setPlaceholderText("Hasta (AAAA-MM-DD)")
+        self.type_combo = QComboBox()
+        self.type_combo.addItems(["Todos", "tiempo", "distancia"])
+        self.filter_btn = QPushButton("Filtrar")
+        self.filter_btn.clicked.connect(self.apply_filters)
+        for w in [self.from_entry, self.to_entry, self.type_combo, self.filter_btn]:
+            filters.addWidget(w)
+        layout.addLayout(filters)
+
+        # Tabla
+        self.model = TripTableModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setSortingEnabled(True)
+        self.table.horizontalHeader().setSortIndicator(0, Qt.DescendingOrder)
+        self.table.horizontalHeader().setSectionResizeMode(QHeaderView.Stretch)
+        self.table.verticalHeader().setVisible(False)
+        self.table.setEditTriggers(QTableView.NoEditTriggers)
+        self.table.setStyleSheet("font-family:Consolas;")
+        layout.addWidget(self.table)
+
+        self.status_label = QLabel("Cargando...")
+        layout.addWidget(self.status_label)
+        self.model.total_changed.connect(lambda total: self.status_label.setText(f"{total} viajes"))
+        self.model.summary_changed.connect(self.show_summary)
+        self.model.load_failed.connect(lambda msg: self.status_label.setText(f"Error al leer el historial: {msg}"))
+
+        self.setLayout(layout)
+        self.model.reload()
+
+    def show_summary(self, summary):
+        self.status_label.setText(
+            f"{summary['viajes']} viajes - {summary['coste_total']:.2f} € - "
+            f"{summary['distancia_total']:.1f} km - "
+            f"{(summary['tiempo_parado'] + summary['tiempo_movimiento']) / 3600:.1f} h")
+
+    def apply_filters(self):
+        try:
+            start = _parse_day(self.from_entry.text())
+            end = _parse_day(self.to_entry.text())
+        except ValueError:
+            self.status_label.setText("Fecha inválida. Usa el formato AAAA-MM-DD.")
+            return
+        if end is not None:
+            end += timedelta(days=1)  # 'hasta' incluye el día completo
+        tipo = self.type_combo.currentText()
+        self.status_label.setText("Cargando...")
+        self.model.set_filters(start, end, None if tipo == "Todos" else tipo)
@@ -0,0 +1,373 @@
+import os
+import sys
+import time
+import asyncio
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from config import current_tariff, ingest_config
+from batch import EventPricer, price_trips
+from storage import TextBackend, SQLiteBackend
+from history import get_backend
+
+# =========================
+# Servicio de ingesta de la flota (asyncio, solo en local)
+# =========================
+# Cada taxímetro mantiene una conexión abierta y envía líneas de texto:
+#   M,<taxímetro>                          identifica el taxímetro (opcional)
+#   E,<id>,<instante>,<evento>[,<valor>]   evento del viaje (start, stop, move, distance, finish)
+#   T,<id>,<tipo>,<tiempo_parado>,<tiempo_movimiento>,<distancia_total>[,<inicio>]
+#                                          viaje ya terminado (campos de batch.TRIP_FIELDS)
+# El servidor contesta en orden, por cada bloque recibido:
+#   ERR <línea> <motivo>   por cada línea rechazada (contadas desde 1)
+#   OK <n>                 las n líneas del bloque están procesadas y sus
+#                          viajes guardados en el historial
+# Los ids de viaje son de cada taxímetro: al tarificar se distinguen por
+# taxímetro (<taxímetro>/<id>); el historial no guarda ids.
+# Al cerrar el servidor se procesa y confirma lo ya leído de cada conexión;
+# lo que el taxímetro envíe después no se confirma (debe reenviarlo).
+
+READ_SIZE = 64 * 1024
+MAX_LINE = 64 * 1024
+
+
+def parse_lines(lines):
+    '''
+    Separa las líneas de un bloque en eventos y viajes.
+    Devuelve (taxímetro o None, eventos, viajes, errores): eventos y viajes son
+    (posiciones, filas) y errores una lista de (posición, motivo).
+    '''
+    meter = None
+    events, event_rows = [], []
+    trips, trip_rows = [], []
+    errors = []
+    for position, line in enumerate(lines):
+        parts = line.strip().split(',')
+        kind = parts[0]
+        if kind == 'E' and len(parts) in (4, 5):
+            events.append(position)
+            event_rows.append((parts[1], parts[2], parts[3], parts[4] if len(parts) == 5 else ''))
+        elif kind == 'T' and len(parts) in (6, 7):
+            trips.append(position)
+            trip_rows.append(tuple(parts[1:]) + (('',) if len(parts) == 6 else ()))
+        elif kind == 'M' and len(parts) == 2 and parts[1]:
+            meter = parts[1]
+        elif line.strip():
+            errors.append((position, f"línea no válida: {line.strip()[:80]!r}"))
+    return meter, (events, event_rows), (trips, trip_rows), errors
+
+
+class IngestServer:
+    '''
+    Recibe eventos y viajes de muchos taxímetros a la vez, calcula las tarifas
+    con las funciones compartidas (batch.EventPricer y batch.price_trips) y
+    guarda los viajes terminados en el historial por lotes, desde un único
+    hilo escritor: lo que llega mientras se escribe un lote va en el siguiente.
+    Contrapresión: los bloques esperan en una cola acotada (max_pending); si se
+    llena, el servidor deja de leer de las conexiones y son los taxímetros los
+    que esperan (TCP). Si el historial falla, el lote se reintenta: no se
+    confirma ni se descarta nada que no esté guardado.
+    '''
+
+    def __init__(self, backend=None, tariff=None, batch_size=None, max_pending=None):
+        settings = ingest_config()
+        self.backend = backend
+        self.pricer = EventPricer(tariff or current_tariff())
+        self.fixed_tariff = tariff is not None
+        self.batch_size = batch_size or settings['batch_size']
+        self.max_pending = max_pending or settings['max_pending']
+        self.executor = ThreadPoolExecutor(1, thread_name_prefix='ingest-writer')
+        self.queue = None
+        self.server = None
+        self.writer_task = None
+        self.connections = 0
+        self.handlers = {}  # tarea de cada conexión abierta -> (reader, writer)
+        self.stats = {'lineas': 0, 'viajes': 0, 'errores': 0, 'lotes': 0}
+
+    async def start(self, port=None, host='127.0.0.1', path=None):
+        '''Empieza a escuchar en host:port (o en el socket unix path). Devuelve el asyncio.Server.'''
+        loop = asyncio.get_running_loop()
+        if self.backend is None:
+            self.backend = await loop.run_in_executor(self.executor, get_backend)
+        self.queue = asyncio.Queue(self.max_pending)
+        self.writer_task = asyncio.create_task(self._write_loop())
+        if path:
+            self.server = await asyncio.start_unix_server(self._handle, path)
+        else:
+            self.server = await asyncio.start_server(
+                self._handle, host, ingest_config()['port'] if port is None else port)
+        return self.server
+
+    async def close(self):
+        '''Deja de aceptar conexiones, guarda lo pendiente y para el escritor.'''
+        self.server.close()
+        # wait_closed no espera a las conexiones abiertas (Python 3.11): se deja
+        # de leer de ellas y se espera a que confirmen lo ya leído, así nada
+        # llega a la cola detrás del None
+        for reader, writer in self.handlers.values():
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        await asyncio.gather(*self.handlers, return_exceptions=True)
+        await self.server.wait_closed()
+        await self.queue.put(None)
+        await self.writer_task
+        self.executor.shutdown()
+
+    # =========================
+    # Conexiones
+    # =========================
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self.handlers[task] = (reader, writer)
+        self.connections += 1
+        meter = f"taxi{self.connections}"
+        first = 0
+        rest = b""
+        done = None
+        try:
+            while True:
+                data = await reader.read(READ_SIZE)
+                if not data:
+                    if not rest.strip():
+                        break
+                    data = b"\n"  # última línea sin salto de línea
+                data = rest + data
+                cut = data.rfind(b"\n") + 1
+                rest = data[cut:]
+                if len(rest) > MAX_LINE:
+                    writer.write(f"ERR {first + 1} línea demasiado larga\n".encode('utf-8'))
+                    break
+                if not cut:
+                    continue
+                lines = data[:cut].decode('utf-8', errors='replace').splitlines()
+                meter, records, errors = self._process(lines, meter, first)
+                first += len(lines)
+                done = asyncio.get_running_loop().create_future()
+                # Con la cola llena se espera aquí: no se lee más de esta conexión
+                await self.queue.put((records, len(lines), errors, writer, done))
+            if done is not None:
+                await done  # las últimas respuestas, antes de cerrar
+        except ConnectionError:
+            pass
+        finally:
+            del self.handlers[task]
+            writer.close()
+
+    def _process(self, lines, meter, first):
+        '''Tarifica un bloque. Devuelve (taxímetro, registros de historial, errores por línea).'''
+        named, (event_positions, events), (trip_positions, trips), bad = parse_lines(lines)
+        meter = named or meter
+        if not self.fixed_tariff:
+            self.pricer.tariff = current_tariff()  # los viajes en curso conservan la suya
+        now = datetime.now()
+        records = []
+        errors = [(first + position + 1, message) for position, message in bad]
+
+        if events:
+            ids, instants, kinds, values = zip(*events)
+            rows, found = self.pricer.feed((tuple(f"{meter}/{i}" for i in ids), instants, kinds, values), {})
+            errors += [(first + event_positions[position] + 1, message) for position, message in found.items()]
+            for row in rows:
+                if row[-1] == '':
+                    _, tipo, stopped, moving, distance, cost, _ = row
+                    if tipo == 'distancia':
+                        records.append({'fecha': now, 'tipo': 'distancia', 'distancia_total': distance,
+                                        'coste_total': float(cost)})
+                        continue
+                    records.append({'fecha': now, 'tipo': 'tiempo', 'tiempo_parado': stopped,
+                                    'tiempo_movimiento': moving,
+                                    'duracion_total': round(stopped + moving, 2),
+                                    'coste_total': float(cost)})
+
+        if trips:
+            columns = tuple(zip(*trips))
+            rows, found = price_trips(columns, {}, self.pricer.tariff)
+            errors += [(first + trip_positions[position] + 1, message) for position, message in found.items()]
+            for position, (_, tipo, cost, message) in enumerate(rows):
+                if message:
+                    continue
+                if tipo == 'tiempo':
+                    # Los tiempos tal cual se cobraron, para que tarificar el registro dé lo mismo
+                    stopped, moving = float(columns[2][position]), float(columns[3][position])
+                    records.append({'fecha': now, 'tipo': 'tiempo', 'tiempo_parado': stopped,
+                                    'tiempo_movimiento': moving,
+                                    'duracion_total': stopped + moving,
+                                    'coste_total': float(cost)})
+                else:
+                    records.append({'fecha': now, 'tipo': 'distancia',
+                                    'distancia_total': round(float(columns[4][position]), 2),
+                                    'coste_total': float(cost)})
+
+        errors.sort()
+        self.stats['lineas'] += len(lines)
+        self.stats['errores'] += len(errors)
+        return meter, records, errors
+
+    # =========================
+    # Escritor por lotes
+    # =========================
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self.queue.get()
+            if item is None:
+                break
+            batch = [item]
+            count = len(item[0])
+            # Todo lo que ya está en cola va en el mismo lote (group commit)
+            while count < self.batch_size:
+                try:
+                    item = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+                count += len(item[0])
+            trips = [record for records, *_ in batch for record in records]
+            delay = 0.1
+            while trips:
+                try:
+                    await loop.run_in_executor(self.executor, self._store, trips)
+                    break
+                except Exception as e:
+                    print(f"Error al guardar el historial (se reintenta en {delay:.1f} s): {e}", file=sys.stderr)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 5.0)
+            self.stats['viajes'] += len(trips)
+            self.stats['lotes'] += 1
+            for _, lines, errors, writer, done in batch:
+                if not writer.is_closing():
+                    reply = "".join(f"ERR {line} {message}\n" for line, message in errors)
+                    writer.write((reply + f"OK {lines}\n").encode('utf-8'))
+                done.set_result(None)
+
+    def _store(self, trips):
+        self.backend.append_many(trips)
+        self.backend.sync()
+
+
+# =========================
+# Cliente de carga
+# =========================
+def _trip_lines(trip, events, start):
+    '''Líneas de un viaje: start, events - 3 cambios de estado, distance y finish.'''
+    t = start
+    lines = [f"E,{trip},{t:.1f},start\n"]
+    for n in range(events - 3):
+        t += 7.0
+        lines.append(f"E,{trip},{t:.1f},{'move' if n % 2 == 0 else 'stop'}\n")
+    lines.append(f"E,{trip},{t:.1f},distance,1.25\n")
+    lines.append(f"E,{trip},{t + 3:.1f},finish\n")
+    return lines
+
+
+async def _load_meter(connect, number, trips, events, chunk, stats):
+    reader, writer = await connect()
+
+    async def read_replies():
+        while line := await reader.readline():
+            if line.startswith(b"OK "):
+                stats['confirmadas'] += int(line[3:])
+            else:
+                stats['errores'] += 1
+
+    replies = asyncio.create_task(read_replies())
+    writer.write(f"M,carga{number}\n".encode('utf-8'))
+    pending = []
+    sent = 1
+    start = 1_700_000_000.0 + number * 86400
+    for trip in range(trips):
+        if trip % 10 == 9:
+            pending.append(f"T,{trip},distancia,,,{1.5 + trip % 7},\n")
+        else:
+            pending.extend(_trip_lines(trip, events, start + trip * 600))
+        if len(pending) >= chunk:
+            writer.write("".join(pending).encode('utf-8'))
+            sent += len(pending)
+            pending = []
+            await writer.drain()  # contrapresión: espera si el servidor no lee
+    writer.write("".join(pending).encode('utf-8'))
+    sent += len(pending)
+    writer.write_eof()
+    await writer.drain()
+    await replies
+    writer.close()
+    stats['enviadas'] += sent
+
+
+async def load_test(port=None, host='127.0.0.1', path=None, meters=50, trips=200, events=8, chunk=500):
+    '''
+    Simula meters taxímetros conectados a la vez, cada uno enviando trips viajes
+    (nueve de cada diez como events eventos; el resto como viaje por distancia
+    terminado). Devuelve las líneas enviadas, confirmadas, con error y la tasa.
+    '''
+    if path:
+        connect = lambda: asyncio.open_unix_connection(path)
+    else:
+        port = ingest_config()['port'] if port is None else port
+        connect = lambda: asyncio.open_connection(host, port)
+    stats = {'enviadas': 0, 'confirmadas': 0, 'errores': 0}
+    started = time.perf_counter()
+    await asyncio.gather(*(_load_meter(connect, n, trips, events, chunk, stats) for n in range(meters)))
+    stats['segundos'] = time.perf_counter() - started
+    stats['lineas_por_segundo'] = stats['confirmadas'] / stats['segundos']
+    return stats
+
+
+# =========================
+# Ejecución
+# =========================
+def _backend_for(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    return SQLiteBackend(path) if path.endswith('.db') else TextBackend(path)
+
+
+async def _serve(args):
+    backend = _backend_for(args.history) if args.history else None
+    server = IngestServer(backend)
+    await server.start(args.port, path=args.unix)
+    where = args.unix or f"127.0.0.1:{server.server.sockets[0].getsockname()[1]}"
+    print(f"Recibiendo viajes en {where} (Ctrl+C para terminar)", file=sys.stderr)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.close()
+        if backend is not None:
+            backend.close()
+        print(f"Líneas: {server.stats['lineas']}, viajes guardados: {server.stats['viajes']}, "
+              f"lotes: {server.stats['lotes']}, errores: {server.stats['errores']}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='ingest.py', description="Servicio local de ingesta de viajes de la flota.")
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve = commands.add_parser('serve', help="recibe eventos y viajes de los taxímetros")
+    serve.add_argument('--history', help="historial donde guardar (.db o .txt; por defecto el del .env)")
+    load = commands.add_parser('load', help="prueba de carga contra un servidor en marcha")
+    load.add_argument('--meters', type=int, default=50, help="taxímetros simultáneos")
+    load.add_argument('--trips', type=int, default=200, help="viajes por taxímetro")
+    load.add_argument('--events', type=int, default=8, help="eventos por viaje (mínimo 3)")
+    for command in (serve, load):
+        command.add_argument('--port', type=int, help="puerto en 127.0.0.1 (por defecto INGEST_PORT)")
+        command.add_argument('--unix', metavar='RUTA', help="usar un socket unix en lugar de TCP")
+    args = parser.parse_args(argv)
+
+    if args.command == 'serve':
+        try:
+            asyncio.run(_serve(args))
+        except KeyboardInterrupt:
+            pass
+        return 0
+    stats = asyncio.run(load_test(args.port, path=args.unix, meters=args.meters,
+                                  trips=args.trips, events=max(3, args.events)))
+    print(f"{stats['enviadas']} líneas enviadas, {stats['confirmadas']} confirmadas, "
+          f"{stats['errores']} errores en {stats['segundos']:.2f} s "
+          f"({stats['lineas_por_segundo']:,.0f} líneas/s)")
+    return 0 if stats['confirmadas'] == stats['enviadas'] and not stats['errores'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
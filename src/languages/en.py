@@ -24,4 +24,8 @@ LANG_EN = {
     "enter_distance": "Enter the distance in kilometers: ",
     "invalid_distance": "Invalid distance. Must be a positive number different from 0. Try again",
 
+    "interrupted_trip": "There is an interrupted trip: {stopped:.2f} s stopped, {moving:.2f} s moving. Resume it? (y/n): ",
+    "trip_resumed": "The trip has been resumed. Current state: {state}.",
+    "trip_recovered": "The interrupted trip has been closed.",
+
 }
\ No newline at end of file
@@ -28,6 +28,11 @@ LANG_ES = {
     "choose_mode": "Elige modo de Cálculo de Tarifa: 'distancia' o 'tiempo': ",
     "enter_distance": "Introduce la distancia en kilómetros: ",
     "invalid_distance": "Distancia inválida. Debe ser un número positivo diferente de 0. Intenta de nuevo",
+
+    #Viaje interrumpido (ver checkpoint.py)
+    "interrupted_trip": "Hay un viaje interrumpido: {stopped:.2f} s parado, {moving:.2f} s en movimiento. ¿Retomarlo? (s/n): ",
+    "trip_resumed": "El viaje ha sido retomado. Estado actual: {state}.",
+    "trip_recovered": "Se ha cerrado el viaje interrumpido.",
     
 }
 
@@ -0,0 +1,117 @@
+import os
+import glob
+import gzip
+import time
+import queue
+import atexit
+import shutil
+import logging
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listener = None
+
+
+class _DeferredQueueHandler(QueueHandler):
+    '''
+    QueueHandler que no formatea el mensaje al encolarlo:
+    el formateo (%-args, fecha...) lo hace el hilo del listener.
+    '''
+
+    def prepare(self, record):
+        return record
+
+
+class CompressingRotatingFileHandler(RotatingFileHandler):
+    '''
+    Handler que rota el log por tamaño o por tiempo y comprime
+    los segmentos cerrados (.gz) en un hilo aparte.
+    Cada segmento cerrado se nombra con la fecha en que se cerró
+    y solo se conservan los backup_count más recientes.
+    '''
+
+    def __init__(self, filename, max_bytes, backup_count, rotate_seconds=None):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+                         encoding='utf-8', delay=True)
+        self.rotate_seconds = rotate_seconds
+        # Periodo (día, hora...) al que pertenece el segmento actual;
+        # se toma de la última escritura para que funcione entre reinicios
+        started = os.path.getmtime(filename) if os.path.exists(filename) else time.time()
+        self.period = self._period(started)
+        # Un único hilo comprime los segmentos en orden
+        self.compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="log-compress")
+
+    def _period(self, timestamp):
+        return int(timestamp // self.rotate_seconds) if self.rotate_seconds else 0
+
+    def shouldRollover(self, record):
+        if self.rotate_seconds and self._period(record.created) != self.period:
+            return True
+        return bool(super().shouldRollover(record))
+
+    def doRollover(self):
+        if self.stream:
+            self.stream.close()
+            self.stream = None
+        if os.path.exists(self.baseFilename) and os.path.getsize(self.baseFilename) > 0:
+            # Renombrar es inmediato; la compresión se hace en segundo plano
+            closed = f"{self.baseFilename}.{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+            os.replace(self.baseFilename, closed)
+            self.compressor.submit(self._compress, closed)
+        self.period = self._period(time.time())
+
+    def _compress(self, path):
+        with open(path, 'rb') as f_in, gzip.open(path + '.tmp', 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        os.replace(path + '.tmp', path + '.gz')
+        os.remove(path)
+        # Borra los segmentos más antiguos
+        segments = sorted(glob.glob(glob.escape(self.baseFilename) + '.*.gz'))
+        for old in segments[:-self.backupCount]:
+            os.remove(old)
+
+    def close(self):
+        super().close()
+        self.compressor.shutdown(wait=True)
+
+
+def setup_logging(filename, level=logging.INFO, max_bytes=5 * 1024 * 1024,
+                  backup_count=10, rotate_seconds=None):
+    '''
+    Configura el logging de la aplicación sin bloquear a quien registra:
+    los mensajes van a una cola y un hilo (QueueListener) los escribe en disco.
+    Si ya estaba configurado, sustituye la configuración anterior.
+    '''
+    global _listener
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+
+    handler = CompressingRotatingFileHandler(filename, max_bytes, backup_count, rotate_seconds)
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    # Vacía la cola anterior y cierra su archivo y su hilo de compresión
+    stop_logging()
+    root.addHandler(_DeferredQueueHandler(log_queue))
+    root.setLevel(level)
+
+    _listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.unregister(stop_logging)  # una sola vez, aunque se reconfigure
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    '''Escribe los mensajes pendientes y detiene el hilo de logging.'''
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
@@ -1,8 +1,19 @@
+import sys
 from languages.es import LANG_ES
 from languages.en import LANG_EN
 from taximeter import taximeter
+import batch
+
+def main(argv=None):
+    '''
+    Sin argumentos abre el taxímetro interactivo.
+    Con argumentos calcula tarifas por lotes sin interfaz (ver batch.py),
+    por ejemplo: python main.py viajes.csv > precios.csv
+    '''
+    argv = sys.argv[1:] if argv is None else argv
+    if argv:
+        return batch.main(argv)
 
-def main():
     #Elegir Idioma
     choice = input(LANG_ES["choose_language"]).strip().lower()
     if choice == 'es':
@@ -27,4 +38,4 @@ def main():
     taximeter(lang, commands)
         
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
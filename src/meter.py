@@ -0,0 +1,213 @@
+import time
+from datetime import datetime
+from config import current_tariff
+from fares import calculate_time_fare, calculate_distance_fare
+from money import nanos_to_cents, cents_to_euros, round_seconds
+from schedule import schedule_for, local_seconds
+from events import START, STOP, MOVE, FINISH
+from metrics import timed
+
+STOPPED = 'stopped'
+MOVING = 'moving'
+
+
+class TripMeter:
+    '''
+    Motor del taxímetro: la máquina de estados de un viaje por tiempo.
+    Lo usan la CLI y la GUI (y cualquier servicio sin interfaz).
+    Mide con un reloj monotónico, así los cambios de hora del sistema
+    no alteran la tarifa.
+    Si se indica listener, se llama listener(tipo, id_viaje, instante, valor)
+    en cada transición (por ejemplo, un events.EventLog).
+    Cada viaje conserva la tarifa vigente al empezar, aunque se recargue
+    durante el viaje; el START lleva su versión como valor.
+    Si la tarifa tiene franjas horarias, cada tramo se cobra según las
+    franjas que cruza (wall_clock da la hora real del inicio del viaje).
+    Si se indica checkpoint (un checkpoint.TripCheckpoint), cada transición
+    guarda en él el viaje en curso, para retomarlo tras una caída.
+    '''
+    __slots__ = ('clock', 'wall_clock', 'listener', 'checkpoint', 'trip_id', 'active', 'state',
+                 'state_start', 'stopped_time', 'moving_time', 'tariff', 'schedule', 'wall_offset',
+                 'cost')
+
+    def __init__(self, clock=time.monotonic, listener=None, wall_clock=time.time, checkpoint=None):
+        self.clock = clock
+        self.wall_clock = wall_clock
+        self.listener = listener
+        self.checkpoint = checkpoint
+        self.trip_id = 0
+        self.reset()
+
+    def reset(self):
+        self.active = False
+        self.state = None
+        self.state_start = 0.0
+        self.stopped_time = 0.0
+        self.moving_time = 0.0
+        self.tariff = None
+        self.schedule = None   # índice de franjas (None si la tarifa es plana)
+        self.wall_offset = 0.0 # reloj del medidor -> segundos locales
+        self.cost = 0          # nano-euros de los tramos cerrados (solo con franjas)
+
+    def _segment_cost(self, now):
+        """Coste del tramo actual según las franjas horarias."""
+        return self.schedule.time_cost(self.state_start + self.wall_offset,
+                                       now + self.wall_offset, self.state == MOVING)
+
+    def _close_segment(self, now):
+        """Suma al estado actual el tiempo transcurrido desde el último cambio."""
+        if self.schedule is not None:
+            self.cost += self._segment_cost(now)
+        if self.state == STOPPED:
+            self.stopped_time += now - self.state_start
+        else:
+            self.moving_time += now - self.state_start
+        self.state_start = now
+
+    @timed('meter_transition_seconds', transition='start')
+    def start(self, now=None, trip_id=None, tariff=None):
+        '''
+        Inicia un viaje en estado parado.
+        Sin trip_id se usa uno nuevo basado en la hora (en microsegundos).
+        Sin tariff se usa la tarifa vigente.
+        '''
+        if self.active:
+            raise RuntimeError("Ya hay un viaje en curso")
+        if now is None:
+            now = self.clock()
+        self.trip_id = time.time_ns() // 1000 if trip_id is None else trip_id
+        self.active = True
+        self.state = STOPPED
+        self.state_start = now
+        self.stopped_time = 0.0
+        self.moving_time = 0.0
+        self.tariff = current_tariff() if tariff is None else tariff
+        self.schedule = schedule_for(self.tariff) if self.tariff.bands else None
+        self.wall_offset = local_seconds(self.wall_clock()) - now
+        self.cost = 0
+        if self.listener is not None:
+            self.listener(START, self.trip_id, now, float(self.tariff.version))
+        if self.checkpoint is not None:
+            self.checkpoint.save(self, now)
+
+    def resume(self, snapshot, now=None):
+        '''
+        Retoma un viaje interrumpido (ver checkpoint.TripCheckpoint.load) en su
+        estado y con su tarifa. El tramo en curso al caer se cuenta hasta el
+        último guardado; a partir de now el viaje sigue como si no hubiera
+        parado. No avisa al listener: el viaje ya tenía su START.
+        '''
+        if self.active:
+            raise RuntimeError("Ya hay un viaje en curso")
+        if now is None:
+            now = self.clock()
+        self.trip_id = snapshot['trip']
+        self.active = True
+        self.state = snapshot['state']
+        self.stopped_time = snapshot['stopped_time']
+        self.moving_time = snapshot['moving_time']
+        self.tariff = snapshot['tariff']
+        self.schedule = schedule_for(self.tariff) if self.tariff.bands else None
+        self.cost = snapshot['cost']
+        # El tramo interrumpido, con la hora real en que ocurrió
+        self.state_start = now - (snapshot['saved_at'] - snapshot['state_since'])
+        self.wall_offset = local_seconds(snapshot['state_since']) - self.state_start
+        self._close_segment(now)
+        self.wall_offset = local_seconds(self.wall_clock()) - now
+        if self.checkpoint is not None:
+            self.checkpoint.save(self, now)
+
+    def _switch(self, state, kind, now):
+        if not self.active:
+            raise RuntimeError("No hay un viaje en curso")
+        if now is None:
+            now = self.clock()
+        self._close_segment(now)
+        self.state = state
+        if self.listener is not None:
+            self.listener(kind, self.trip_id, now, 0.0)
+        if self.checkpoint is not None:
+            self.checkpoint.save(self, now)
+
+    @timed('meter_transition_seconds', transition='stop')
+    def stop(self, now=None):
+        '''Pasa el viaje a estado parado.'''
+        self._switch(STOPPED, STOP, now)
+
+    @timed('meter_transition_seconds', transition='move')
+    def move(self, now=None):
+        '''Pasa el viaje a estado en movimiento.'''
+        self._switch(MOVING, MOVE, now)
+
+    def elapsed(self, now=None):
+        '''Devuelve (tiempo parado, tiempo en movimiento) incluyendo el tramo actual.'''
+        if not self.active:
+            return self.stopped_time, self.moving_time
+        duration = (self.clock() if now is None else now) - self.state_start
+        if self.state == STOPPED:
+            return self.stopped_time + duration, self.moving_time
+        return self.stopped_time, self.moving_time + duration
+
+    def current_fare(self, now=None):
+        '''Tarifa acumulada hasta ahora, redondeada al céntimo (0 si no hay viaje).'''
+        if not self.active:
+            return 0.0
+        if self.schedule is not None:
+            nanos = self.cost + self._segment_cost(self.clock() if now is None else now)
+            return cents_to_euros(nanos_to_cents(nanos))
+        stopped, moving = self.elapsed(now)
+        return calculate_time_fare(stopped, moving, self.tariff)
+
+    @timed('meter_transition_seconds', transition='finish')
+    def finish(self, now=None):
+        '''
+        Termina el viaje y devuelve (tiempo parado, tiempo en movimiento, tarifa).
+        Los tiempos van al centésimo, como en el historial, y la tarifa se
+        calcula con ellos (ver money.round_seconds).
+        El medidor queda listo para un nuevo viaje.
+        '''
+        if not self.active:
+            raise RuntimeError("No hay un viaje en curso")
+        if now is None:
+            now = self.clock()
+        self._close_segment(now)
+        stopped, moving = round_seconds(self.stopped_time), round_seconds(self.moving_time)
+        if self.schedule is not None:
+            fare = cents_to_euros(nanos_to_cents(self.cost))
+        else:
+            fare = calculate_time_fare(stopped, moving, self.tariff)
+        if self.checkpoint is not None:
+            # Queda como terminado hasta que llegue al historial (checkpoint.release)
+            self.checkpoint.save(self, now, finished=True)
+        self.reset()
+        if self.listener is not None:
+            self.listener(FINISH, self.trip_id, now, 0.0)
+        return stopped, moving, fare
+
+
+def time_trip_info(stopped_time, moving_time, total_fare):
+    '''Crea el registro de historial de un viaje por tiempo.'''
+    return {
+        "fecha": datetime.now(),
+        "tipo": "tiempo",
+        "tiempo_parado": round_seconds(stopped_time),
+        "tiempo_movimiento": round_seconds(moving_time),
+        "duracion_total": round_seconds(stopped_time + moving_time),
+        "coste_total": round(total_fare, 2)
+    }
+
+
+def distance_trip_info(distance):
+    '''
+    Calcula la tarifa de un viaje por distancia y crea su registro de historial.
+    Se aplica la franja horaria del momento del cálculo.
+    Devuelve (tarifa, trip_info).
+    '''
+    now = datetime.now()
+    total_fare = calculate_distance_fare(distance, start=local_seconds(now))
+    return total_fare, {
+        "fecha": now,
+        "tipo": "distancia",
+        "distancia_total": round(distance, 2),
+        "coste_total": round(total_fare, 2)
+    }
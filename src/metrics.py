@@ -0,0 +1,295 @@
+import os
+import time
+import bisect
+import atexit
+import logging
+import threading
+import functools
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import metrics_config
+
+# =========================
+# Instrumentación (histogramas de latencia y contadores)
+# =========================
+# Desactivada por defecto. Se decide al importar este módulo (METRICS_ENABLED
+# en el .env o el entorno): con ella desactivada, timed() devuelve la función
+# original sin envolver y timer() un contexto vacío, así el coste es nulo
+# en las funciones calientes.
+# Las métricas se exportan en el formato de texto de Prometheus, a un archivo
+# (para el textfile collector de node_exporter) o por HTTP en /metrics.
+
+ENABLED = metrics_config()['enabled']
+
+# Límites superiores de los buckets, en segundos (de 10 µs a 5 s)
+BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+           0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Descripción de las métricas conocidas (# HELP)
+DESCRIPTIONS = {
+    'taximeter_command_seconds': "Tiempo de proceso de cada comando de la CLI",
+    'gui_handler_seconds': "Tiempo de los manejadores de la GUI",
+    'meter_transition_seconds': "Tiempo de los cambios de estado del motor del viaje",
+    'fare_calculation_seconds': "Tiempo de cálculo de una tarifa",
+    'history_save_seconds': "Tiempo de save_history (encolar o escribir un trayecto)",
+}
+
+
+class Histogram:
+    '''Histograma de latencias con buckets fijos (acumulativos al exportar).'''
+    __slots__ = ('counts', 'sum', 'count', 'lock')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)  # el último es +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect.bisect_left(BUCKETS, seconds)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += seconds
+            self.count += 1
+
+    def quantile(self, q):
+        '''Estimación del cuantil q (0..1) interpolando dentro del bucket, como histogram_quantile.'''
+        with self.lock:
+            counts, total = list(self.counts), self.count
+        if total == 0:
+            return None
+        rank = q * total
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                if i == len(BUCKETS):
+                    return lower
+                return lower + (BUCKETS[i] - lower) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Counter:
+    __slots__ = ('value', 'lock')
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+
+class Registry:
+    '''Métricas por (nombre, etiquetas).'''
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+
+    def _get(self, table, factory, name, labels):
+        key = (name, tuple(sorted(labels.items())))
+        metric = table.get(key)
+        if metric is None:
+            with self.lock:
+                metric = table.setdefault(key, factory())
+        return metric
+
+    def histogram(self, name, **labels):
+        return self._get(self.histograms, Histogram, name, labels)
+
+    def counter(self, name, **labels):
+        return self._get(self.counters, Counter, name, labels)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+    def render(self):
+        '''Todas las métricas en el formato de texto de Prometheus.'''
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                if name in DESCRIPTIONS:
+                    lines.append(f"# HELP {name} {DESCRIPTIONS[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            header(name, 'histogram')
+            with histogram.lock:
+                counts, total, count = list(histogram.counts), histogram.sum, histogram.count
+            cumulative = 0
+            for bound, n in zip(BUCKETS + (None,), counts):
+                cumulative += n
+                le = '+Inf' if bound is None else repr(bound)
+                lines.append(f"{name}_bucket{_labels(labels, le=le)} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        for (name, labels), counter in sorted(self.counters.items()):
+            header(name, 'counter')
+            lines.append(f"{name}{_labels(labels)} {counter.value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in pairs) + "}"
+
+
+REGISTRY = Registry()
+
+
+# =========================
+# API de instrumentación
+# =========================
+class _Timer:
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+        return False
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name, **labels):
+    '''Contexto que mide el bloque en el histograma name (no hace nada si está desactivada).'''
+    if not ENABLED:
+        return _NULL_TIMER
+    return _Timer(REGISTRY.histogram(name, **labels))
+
+
+def timed(name, **labels):
+    '''
+    Decorador que mide cada llamada en el histograma name y cuenta las
+    excepciones en <name sin _seconds>_errors_total.
+    Si la instrumentación está desactivada devuelve la función sin cambios.
+    '''
+    def decorate(function):
+        if not ENABLED:
+            return function
+        histogram = REGISTRY.histogram(name, **labels)
+        errors = REGISTRY.counter(name.removesuffix('_seconds') + '_errors_total', **labels)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            except Exception:
+                errors.inc()
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - start)
+        return wrapper
+    return decorate
+
+
+def inc(name, amount=1, **labels):
+    '''Suma amount al contador name.'''
+    if ENABLED:
+        REGISTRY.counter(name, **labels).inc(amount)
+
+
+def enable():
+    '''Activa la instrumentación (solo afecta a lo que se decore o mida a partir de ahora).'''
+    global ENABLED
+    ENABLED = True
+
+
+# =========================
+# Exportación
+# =========================
+def write_textfile(path):
+    '''Escribe las métricas en path de forma atómica.'''
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = REGISTRY.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # sin una línea por petición en stderr
+
+
+def serve(port, host='127.0.0.1'):
+    '''Sirve /metrics por HTTP en un hilo de fondo. Devuelve el servidor (server_address, shutdown()).'''
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
+
+
+def start_exporter():
+    '''
+    Arranca la exportación configurada en el .env (ver config.metrics_config):
+    el archivo de texto, reescrito periódicamente y al salir, y/o el endpoint HTTP.
+    No hace nada si la instrumentación está desactivada.
+    '''
+    if not ENABLED:
+        return None
+    settings = metrics_config()
+    if settings['file']:
+        path = settings['file']
+
+        def export():
+            while True:
+                time.sleep(settings['interval'])
+                try:
+                    write_textfile(path)
+                except OSError as e:
+                    logging.error("No se pudieron escribir las métricas: %s", e)
+
+        threading.Thread(target=export, name="metrics-file", daemon=True).start()
+        atexit.register(write_textfile, path)
+    server = None
+    if settings['port']:
+        try:
+            server = serve(settings['port'])
+            logging.info("Métricas en http://127.0.0.1:%s/metrics", settings['port'])
+        except OSError as e:
+            logging.error("No se pudo abrir el puerto de métricas %s: %s", settings['port'], e)
+    return server
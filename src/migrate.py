@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import argparse
+from config import history_config
+from history import BACKENDS, open_backend
+from trip_format import read_trips
+
+# =========================
+# Migración de historial.txt antiguos
+# =========================
+
+def migrate(sources, backend, batch_size=10_000, out=sys.stderr):
+    '''
+    Convierte uno o varios historial.txt al backend indicado.
+    Lee en streaming y escribe por lotes, informando del avance.
+    Los bloques mal formados se informan y se saltan.
+    Devuelve (trayectos migrados, bloques con errores).
+    '''
+    migrated = 0
+    errors = 0
+    started = time.monotonic()
+    total_bytes = sum(os.path.getsize(path) for path in sources)
+    done_before = 0
+
+    # Durante la migración no se fuerza la escritura de cada lote
+    backend.set_durability('none')
+
+    for path in sources:
+        def on_error(line, reason):
+            nonlocal errors
+            errors += 1
+            print(f"{path}:{line}: bloque descartado ({reason})", file=out)
+
+        def on_progress(done):
+            seconds = max(time.monotonic() - started, 1e-9)
+            read = done_before + done
+            percent = 100 * read / total_bytes if total_bytes else 100
+            print(f"{percent:5.1f}% - {read / 1e6:.0f} MB - {migrated} trayectos"
+                  f" - {read / 1e6 / seconds:.1f} MB/s", file=out)
+
+        batch = []
+        for trip in read_trips(path, on_error, on_progress):
+            batch.append(trip)
+            if len(batch) >= batch_size:
+                backend.append_many(batch)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            backend.append_many(batch)
+            migrated += len(batch)
+        done_before += os.path.getsize(path)
+
+    backend.set_durability('fsync')
+    backend.sync()
+    print(f"Migración terminada: {migrated} trayectos, {errors} bloques con errores,"
+          f" {time.monotonic() - started:.1f} s", file=out)
+    return migrated, errors
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Migra historial.txt antiguos al historial estructurado.")
+    parser.add_argument('sources', nargs='+', help="archivos historial.txt a migrar")
+    parser.add_argument('--backend', choices=sorted(BACKENDS),
+                        help="backend de destino (por defecto el de HISTORY_BACKEND en .env)")
+    parser.add_argument('--dest', help="ruta de destino (por defecto la del backend)")
+    parser.add_argument('--batch-size', type=int, default=10_000, help="trayectos por lote")
+    args = parser.parse_args(argv)
+
+    dest = args.dest or BACKENDS[args.backend or history_config()['backend']][1]
+    if os.path.exists(dest) and any(os.path.exists(source) and os.path.samefile(source, dest) for source in args.sources):
+        parser.error("el destino no puede ser uno de los archivos a migrar")
+    backend = open_backend(args.backend, dest)
+    try:
+        _, errors = migrate(args.sources, backend, args.batch_size)
+    finally:
+        backend.close()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
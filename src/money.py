@@ -0,0 +1,66 @@
+import numpy as np
+
+# =========================
+# Aritmética de importes en punto fijo
+# =========================
+# Todo el cálculo de tarifas se hace con enteros:
+#   tarifas     -> micro-euros (µ€/s, µ€/km y µ€ de bajada de bandera)
+#   tiempos     -> milisegundos
+#   distancias  -> metros
+#   importes    -> nano-euros (1e-9 €), porque µ€/s × ms = µ€/km × m = 1e-9 €
+# Reglas de redondeo (todos los valores son >= 0, siempre mitad hacia arriba):
+#   - segundos a ms y km a metros, al entrar en el cálculo;
+#   - nano-euros a céntimos, una sola vez por viaje (nunca por tramo);
+#   - los tiempos de un viaje terminado, al centésimo de segundo (round_seconds),
+#     que es como se guardan en el historial: el viaje se cobra con esos
+#     tiempos, así volver a tarificar el registro guardado da el mismo céntimo.
+# Así el mismo viaje da el mismo céntimo en la CLI, la GUI y las conciliaciones,
+# y la suma de los recibos coincide con la recaudación.
+MICROS = 1_000_000
+NANOS_PER_CENT = 10_000_000
+# Importe máximo de un viaje en nano-euros (unos 4.600 millones de euros):
+# con margen bajo el máximo de int64, así los productos enteros no se desbordan
+MAX_NANOS = 2 ** 62
+
+
+def to_micros(rate):
+    """Tarifa en euros -> micro-euros."""
+    return round(rate * MICROS)
+
+
+def to_ms(seconds):
+    """Segundos -> milisegundos enteros. Acepta escalares o arrays de NumPy."""
+    if isinstance(seconds, np.ndarray):
+        return np.floor(seconds * 1000 + 0.5).astype(np.int64)
+    return int(seconds * 1000 + 0.5)
+
+
+def round_seconds(seconds):
+    """Segundos al centésimo, mitad hacia arriba. Acepta escalares o arrays de NumPy."""
+    if isinstance(seconds, np.ndarray):
+        return np.floor(seconds * 100 + 0.5) / 100
+    return int(seconds * 100 + 0.5) / 100
+
+
+def to_meters(km):
+    """Kilómetros -> metros enteros. Acepta escalares o arrays de NumPy."""
+    return to_ms(km)
+
+
+def nanos_to_cents(nanos):
+    """Nano-euros -> céntimos, redondeando la mitad hacia arriba."""
+    return (nanos + NANOS_PER_CENT // 2) // NANOS_PER_CENT
+
+
+def cents_to_euros(cents):
+    """Céntimos -> euros (float con dos decimales exactos al formatear)."""
+    if isinstance(cents, np.ndarray):
+        return cents / 100
+    return int(cents) / 100
+
+
+def euros_to_cents(euros):
+    """Importe ya redondeado a céntimos (p. ej. del historial) -> céntimos enteros."""
+    if isinstance(euros, np.ndarray):
+        return np.round(euros * 100).astype(np.int64)
+    return round(euros * 100)
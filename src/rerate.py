@@ -0,0 +1,356 @@
+import os
+import sys
+import gzip
+import json
+import time
+import sqlite3
+import argparse
+from contextlib import closing, contextmanager
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from config import current_tariff, history_config
+from fares import calculate_time_fares_cents, calculate_distance_fares_cents
+from money import euros_to_cents
+from trip_format import SEPARATOR, CONTROL, format_date, parse_blocks
+from history import BACKENDS
+from segments import Segments
+from history_index import locked, open_lock
+
+# =========================
+# Re-tarificación del historial
+# =========================
+# Recalcula lo que habría costado cada trayecto del historial con otra tarifa
+# y suma las diferencias por día y tipo de trayecto.
+# El historial se parte en bloques (rangos de bytes de historial.txt o rangos
+# de id de SQLite) que cada proceso lee por su cuenta: al proceso principal
+# solo vuelven los totales de cada bloque, así escala con el número de núcleos.
+# Cada bloque terminado se apunta en un archivo de control; al relanzar el
+# trabajo con el mismo historial y la misma tarifa se saltan los ya hechos.
+
+CHUNK_BYTES = 64 * 1024 * 1024  # historial.txt
+CHUNK_ROWS = 250_000            # SQLite
+OUTPUT = ('fecha', 'tipo', 'viajes', 'coste_anterior', 'coste_nuevo', 'diferencia')
+
+# Inicio de un bloque de historial.txt: separador seguido de la línea de control
+# (o de la fecha, en historiales antiguos)
+_OPENINGS = tuple(("\n" + SEPARATOR + "\n" + label).encode('utf-8') for label in (CONTROL + ": ", "Fecha: "))
+_OPENING_SIZE = max(len(opening) for opening in _OPENINGS)
+
+
+def plan_chunks(path, chunk_bytes=CHUNK_BYTES, chunk_rows=CHUNK_ROWS):
+    '''
+    Parte el historial en bloques independientes.
+    Devuelve una lista de tareas: rangos de id ('sqlite', ruta, desde, hasta)
+    o rangos de bytes alineados al inicio de un trayecto
+    ('text', ruta, desde, hasta, segmento). En el historial de texto, segmento
+    es el número de segmento de esos bytes: los cerrados van primero, enteros
+    si ya están comprimidos, y el activo lleva el número que tendrá al
+    cerrarse, así las tareas siguen valiendo después (ver _read_text).
+    '''
+    if path.endswith('.db'):
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+            lo, hi = conn.execute("SELECT MIN(id), MAX(id) FROM trayectos").fetchone()
+        if lo is None:
+            return []
+        return [('sqlite', path, start, min(start + chunk_rows, hi + 1))
+                for start in range(lo, hi + 1, chunk_rows)]
+
+    tasks = []
+    segments = Segments(path)
+    # Con el candado compartido nadie cierra el segmento activo mientras tanto
+    with _history_lock(path):
+        sealed = segments.load()
+        for segment in sealed:
+            raw = segments.path(segment, '.txt')
+            if os.path.exists(raw):
+                tasks += _plan_text(path, raw, segment['id'], chunk_bytes)
+            else:
+                tasks.append(('text', path, 0, segment['bytes'], segment['id']))
+        if os.path.exists(path):
+            tasks += _plan_text(path, path, sealed[-1]['id'] + 1 if sealed else 1, chunk_bytes)
+    return tasks
+
+
+@contextmanager
+def _history_lock(path):
+    """Candado compartido del historial de texto (el que toman los escritores)."""
+    fd = open_lock(path)
+    try:
+        with locked(fd, shared=True):
+            yield
+    finally:
+        os.close(fd)
+
+
+def _plan_text(path, source, segment, chunk_bytes):
+    """Tareas 'text' de source, el archivo del segmento segment del historial path."""
+    size = os.path.getsize(source)
+    cuts = [0]
+    with open(source, 'rb') as f:
+        for position in range(chunk_bytes, size, chunk_bytes):
+            if position <= cuts[-1]:
+                continue
+            # Busca el siguiente inicio de trayecto leyendo solo un poco
+            while True:
+                f.seek(position)
+                window = f.read(64 * 1024)
+                found = [at for at in (window.find(opening) for opening in _OPENINGS) if at != -1]
+                if found:
+                    cuts.append(position + min(found) + 1)
+                    break
+                if len(window) < 64 * 1024:
+                    break
+                # Solapa la ventana siguiente por si el separador quedó partido
+                position += len(window) - _OPENING_SIZE
+    cuts.append(size)
+    return [('text', path, a, b, segment) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+
+def _read_text(path, lo, hi, segment):
+    """
+    Bytes lo..hi del segmento segment del historial de texto path. Se busca
+    en el manifiesto: si ya está cerrado, en su archivo (o en el .gz si ya
+    se comprimió); si no, sigue siendo historial.txt.
+    """
+    segments = Segments(path)
+    with _history_lock(path):
+        if any(stored['id'] == segment for stored in segments.load()):
+            source = segments.path({'id': segment}, '.txt')
+            try:
+                f = open(source, 'rb')
+            except FileNotFoundError:
+                f = gzip.open(source + '.gz', 'rb')
+        else:
+            f = open(path, 'rb')
+    # El archivo abierto sigue siendo válido aunque después se cierre o comprima
+    with f:
+        f.seek(lo)
+        return f.read(hi - lo)
+
+
+def _read_chunk(kind, path, lo, hi, segment=None):
+    """Filas (fecha, tipo, distancia, parado, movimiento, coste) y bloques con errores de una tarea."""
+    if kind == 'sqlite':
+        with closing(sqlite3.connect(f"file:{path}?mode=ro", uri=True)) as conn:
+            rows = conn.execute(
+                "SELECT fecha, tipo, distancia_total, tiempo_parado,"
+                " tiempo_movimiento, coste_total FROM trayectos WHERE id >= ? AND id < ?",
+                (lo, hi)).fetchall()
+        return rows, 0
+
+    errors = 0
+
+    def on_error(line, reason):
+        nonlocal errors
+        errors += 1
+
+    text = _read_text(path, lo, hi, segment).decode('utf-8', errors='replace')
+    rows = [(format_date(t['fecha']), t['tipo'], t.get('distancia_total'), t.get('tiempo_parado'),
+             t.get('tiempo_movimiento'), t['coste_total'])
+            for t in parse_blocks(text.splitlines(), on_error)]
+    return rows, errors
+
+
+def rerate_chunk(task, tariff):
+    '''
+    Re-tarifica una tarea de plan_chunks con la tarifa indicada.
+    Devuelve ([(día, tipo, viajes, céntimos antes, céntimos ahora), ...], trayectos con errores).
+    Con franjas horarias, los viajes por distancia usan la franja de su fecha;
+    los de tiempo usan la tarifa general, porque el historial no guarda sus tramos.
+    '''
+    rows, errors = _read_chunk(*task)
+    if not rows:
+        return [], errors
+    dates, tipos, distance, stopped, moving, old = zip(*rows)
+    dates = np.array(dates)
+    tipos = np.array(tipos)
+    distance = np.array(distance, dtype=np.float64)  # None -> NaN
+    stopped = np.array(stopped, dtype=np.float64)
+    moving = np.array(moving, dtype=np.float64)
+    old = euros_to_cents(np.array(old, dtype=np.float64))
+
+    is_time = (tipos == 'tiempo') & (stopped >= 0) & (moving >= 0)
+    is_distance = (tipos == 'distancia') & (distance > 0)
+    valid = is_time | is_distance
+    new = np.zeros(len(rows), dtype=np.int64)
+    new[is_time] = calculate_time_fares_cents(stopped[is_time], moving[is_time], tariff)
+    starts = None
+    if tariff.bands:
+        # Las fechas del historial son hora local: como datetime64 ya son segundos locales
+        starts = dates[is_distance].astype('datetime64[s]').astype(np.float64)
+    new[is_distance] = calculate_distance_fares_cents(distance[is_distance], tariff, starts)
+    errors += int((~valid).sum())
+
+    days = dates[valid].astype('U10')  # 'AAAA-MM-DD'
+    keys, inverse = np.unique(np.char.add(np.char.add(days, ' '), tipos[valid]), return_inverse=True)
+    totals = np.zeros((len(keys), 3), dtype=np.int64)
+    np.add.at(totals, inverse, np.stack([np.ones(len(inverse), dtype=np.int64), old[valid], new[valid]], axis=1))
+    return [(*key.split(' '), *total) for key, total in zip(keys.tolist(), totals.tolist())], errors
+
+
+# =========================
+# Archivo de control (reanudación)
+# =========================
+# JSON Lines: una cabecera que identifica el trabajo (historial, tarifa y los
+# bloques planificados en la primera ejecución) y una línea por bloque
+# terminado con sus totales. Al reanudar se usan esos mismos bloques, así los
+# trayectos añadidos después no invalidan lo ya hecho (quedan fuera del
+# trabajo). Una línea cortada (el proceso murió escribiéndola) se ignora y
+# ese bloque se repite.
+
+def _job_header(path, tariff, tasks):
+    return {
+        'historial': os.path.abspath(path),
+        # La versión solo refleja la fecha del .env: no cuenta para reanudar
+        'tarifa': repr(replace(tariff, version=0)),
+        'bloques': [[task[0], *task[2:]] for task in tasks],
+    }
+
+
+def load_checkpoint(path, history, tariff):
+    """
+    (tareas, bloques ya terminados {índice: (filas, errores)}) si el archivo
+    es de un trabajo con este historial y esta tarifa, o (None, {}).
+    """
+    if not path or not os.path.exists(path):
+        return None, {}
+    done = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        lines = iter(f)
+        try:
+            header = json.loads(next(lines))
+            tasks = [(kind, history, *rest) for kind, *rest in header['bloques']]
+        except (StopIteration, ValueError, KeyError, TypeError):
+            return None, {}
+        if header != _job_header(history, tariff, tasks):
+            return None, {}
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            done[entry['bloque']] = ([tuple(row) for row in entry['filas']], entry['errores'])
+    return tasks, done
+
+
+# =========================
+# Trabajo completo
+# =========================
+def rerate(path, tariff=None, workers=None, checkpoint=None,
+           chunk_bytes=CHUNK_BYTES, chunk_rows=CHUNK_ROWS, out=sys.stderr):
+    '''
+    Re-tarifica todo el historial (historial.txt o historial.db) con tariff
+    (por defecto la vigente), repartiendo los bloques entre workers procesos
+    (por defecto uno por núcleo; con 1 se hace en este proceso).
+    Con checkpoint, los bloques terminados se guardan en ese archivo y un
+    relanzamiento del mismo trabajo continúa donde se quedó, con los mismos
+    bloques (los trayectos añadidos entretanto no entran).
+    Devuelve ({(día, tipo): [viajes, céntimos antes, céntimos ahora]}, trayectos con errores).
+    '''
+    tariff = tariff or current_tariff()
+    started = time.monotonic()
+    tasks, done = load_checkpoint(checkpoint, path, tariff)
+    if tasks is None:
+        tasks = plan_chunks(path, chunk_bytes, chunk_rows)
+    header = _job_header(path, tariff, tasks)
+    if done:
+        print(f"Reanudando: {len(done)} de {len(tasks)} bloques ya terminados", file=out)
+
+    log = None
+    if checkpoint:
+        # Se reescribe con lo ya hecho, así no quedan líneas cortadas ni trabajos antiguos
+        log = open(checkpoint, 'w', encoding='utf-8')
+        log.write(json.dumps(header) + "\n")
+        for i, (rows, errors) in sorted(done.items()):
+            log.write(json.dumps({'bloque': i, 'filas': rows, 'errores': errors}) + "\n")
+        log.flush()
+
+    def finished(i, result):
+        done[i] = result
+        if log is not None:
+            rows, errors = result
+            log.write(json.dumps({'bloque': i, 'filas': rows, 'errores': errors}) + "\n")
+            log.flush()
+            os.fsync(log.fileno())
+        print(f"{len(done)}/{len(tasks)} bloques - {time.monotonic() - started:.1f} s", file=out)
+
+    pending = [i for i in range(len(tasks)) if i not in done]
+    try:
+        if workers == 1 or len(pending) <= 1:
+            for i in pending:
+                finished(i, rerate_chunk(tasks[i], tariff))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(rerate_chunk, tasks[i], tariff): i for i in pending}
+                for future in as_completed(futures):
+                    finished(futures[future], future.result())
+    finally:
+        if log is not None:
+            log.close()
+
+    # Une los totales de todos los bloques
+    totals = {}
+    errors = 0
+    for rows, chunk_errors in done.values():
+        errors += chunk_errors
+        for day, tipo, count, old, new in rows:
+            total = totals.setdefault((day, tipo), [0, 0, 0])
+            total[0] += count
+            total[1] += old
+            total[2] += new
+    return totals, errors
+
+
+def write_deltas(totals, stream):
+    """Escribe las diferencias por día y tipo en CSV (importes en euros)."""
+    stream.write(",".join(OUTPUT) + "\n")
+    for (day, tipo), (count, old, new) in sorted(totals.items()):
+        stream.write(f"{day},{tipo},{count},{old / 100:.2f},{new / 100:.2f},{(new - old) / 100:.2f}\n")
+
+
+def summary(totals, errors, stream):
+    """Resumen por tipo de trayecto y total."""
+    by_type = {}
+    for (_, tipo), values in totals.items():
+        by_type.setdefault(tipo, [0, 0, 0])
+        by_type[tipo] = [a + b for a, b in zip(by_type[tipo], values)]
+    by_type['total'] = [sum(v[k] for v in by_type.values()) for k in range(3)]
+    for tipo, (count, old, new) in by_type.items():
+        print(f"{tipo}: {count} trayectos, antes {old / 100:.2f} €, ahora {new / 100:.2f} €,"
+              f" diferencia {(new - old) / 100:+.2f} €", file=stream)
+    if errors:
+        print(f"{errors} trayectos con errores no se han re-tarificado", file=stream)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Recalcula el historial con otra tarifa y suma las diferencias por día y tipo.")
+    parser.add_argument('source', nargs='?', help="historial.txt o historial.db (por defecto el del .env)")
+    parser.add_argument('--workers', type=int, help="procesos (por defecto uno por núcleo)")
+    parser.add_argument('--checkpoint', help="archivo de control para poder reanudar el trabajo")
+    parser.add_argument('--output', help="CSV de diferencias (por defecto la salida estándar)")
+    for option, key in (('--base-fare', 'base_fare'), ('--price-per-km', 'price_per_km'),
+                        ('--stopped-fare', 'stopped_fare'), ('--moving-fare', 'moving_fare')):
+        parser.add_argument(option, dest=key, type=float, help="sustituye el valor del .env")
+    args = parser.parse_args(argv)
+
+    source = args.source or BACKENDS[history_config()['backend']][1]
+    if not os.path.exists(source):
+        parser.error(f"no existe el historial {source}")
+    overrides = {key: getattr(args, key) for key in ('base_fare', 'price_per_km', 'stopped_fare', 'moving_fare')
+                 if getattr(args, key) is not None}
+    tariff = replace(current_tariff(), **overrides)
+
+    totals, errors = rerate(source, tariff, args.workers, args.checkpoint)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            write_deltas(totals, f)
+    else:
+        write_deltas(totals, sys.stdout)
+    summary(totals, errors, sys.stderr)
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,204 @@
+import time
+from datetime import datetime
+from functools import lru_cache
+import numpy as np
+from config import HOLIDAY
+from money import to_micros, to_ms
+
+DAY = 24 * 3600
+DAY_MS = DAY * 1000
+WEEK_MS = 7 * DAY_MS
+# Los segundos locales cuentan desde 1970-01-01 00:00, que fue jueves:
+# se suman 3 días para que las semanas empiecen en lunes
+_MONDAY_SHIFT_MS = 3 * DAY_MS
+_EPOCH = datetime(1970, 1, 1)
+
+
+def local_seconds(value):
+    '''
+    Convierte a segundos de hora local (la hora de pared, sin zona) desde 1970-01-01.
+    Acepta un datetime (sin zona = ya es hora local) o un timestamp epoch
+    (escalar o array); a cada timestamp se le suma el desfase local de su hora,
+    así los cambios de horario de verano se respetan.
+    '''
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return (value - _EPOCH).total_seconds()
+    epoch = np.asarray(value, dtype=np.float64)
+    hours, inverse = np.unique(np.floor(epoch.ravel() / 3600), return_inverse=True)
+    offsets = np.array([time.localtime(h * 3600).tm_gmtoff for h in hours.tolist()], dtype=np.float64)
+    result = epoch + offsets[inverse].reshape(epoch.shape)
+    return float(result) if result.ndim == 0 else result
+
+
+def _scalar(result):
+    return int(result) if np.ndim(result) == 0 else result
+
+
+# =========================
+# Índice de intervalos
+# =========================
+class TariffSchedule:
+    '''
+    Índice de intervalos de una tarifa con franjas horarias (config.Tariff).
+    Precalcula la semana tipo (lunes a domingo) y el día festivo como cortes
+    ordenados con su franja, y la integral acumulada de las tarifas por tiempo
+    en cada corte. El coste de un tramo es la resta de la integral en sus dos
+    extremos (dos búsquedas binarias), aunque cruce muchas franjas, y funciona
+    igual con arrays de millones de tramos.
+    Los instantes son segundos locales (ver local_seconds); internamente todo
+    va en enteros (ms, micro-euros y nano-euros, ver money.py).
+    '''
+
+    def __init__(self, tariff):
+        self.tariff = tariff
+        self.names = ('general',) + tuple(band.name for band in tariff.bands)
+        # Una fila por franja (la 0 es la tarifa general), en micro-euros:
+        # parado, movimiento, base, km
+        self.rates = np.array(
+            [(tariff.stopped_micros, tariff.moving_micros, tariff.base_micros, tariff.km_micros)]
+            + [[to_micros(rate) for rate in (b.stopped_fare, b.moving_fare, b.base_fare, b.price_per_km)]
+               for b in tariff.bands],
+            dtype=np.int64)
+
+        week = [self._day_profile(day) for day in range(7)]
+        self.week_cuts = np.concatenate([cuts + day * DAY_MS for day, (cuts, _) in enumerate(week)])
+        self.week_band = np.concatenate([band for _, band in week])
+        self.week_cum, self.week_total = self._integrate(self.week_cuts, self.week_band, WEEK_MS)
+        self.hol_cuts, self.hol_band = self._day_profile(HOLIDAY)
+        self.hol_cum, self.hol_total = self._integrate(self.hol_cuts, self.hol_band, DAY_MS)
+
+        # Festivos (días desde 1970) y lo que cambia la integral por cada uno
+        self.holidays = np.array([(d - _EPOCH.date()).days for d in tariff.holidays], dtype=np.int64)
+        day_start = ((self.holidays + 3) % 7) * DAY_MS
+        normal = self._week_integral(day_start + DAY_MS) - self._week_integral(day_start)
+        self.hol_delta = np.vstack([np.zeros((1, 2), dtype=np.int64),
+                                    np.cumsum(self.hol_total - normal, axis=0)])
+
+    def _day_profile(self, day):
+        """Cortes de un día (ms desde medianoche) y la franja de cada tramo."""
+        bands = self.tariff.bands
+        cuts = sorted({0} | {t for b in bands if day in b.days for t in (b.start, b.end) if t < DAY})
+        ids = [next((i + 1 for i, b in enumerate(bands) if b.covers(day, cut)), 0) for cut in cuts]
+        # Une tramos consecutivos de la misma franja
+        keep = [0] + [i for i in range(1, len(ids)) if ids[i] != ids[i - 1]]
+        return (np.array([cuts[i] * 1000 for i in keep], dtype=np.int64),
+                np.array([ids[i] for i in keep], dtype=np.intp))
+
+    def _integrate(self, cuts, band, length):
+        """Integral acumulada (parado, movimiento) al principio de cada tramo y total del periodo."""
+        widths = np.diff(np.append(cuts, length))
+        cost = self.rates[band, :2] * widths[:, None]
+        cum = np.vstack([np.zeros((1, 2), dtype=np.int64), np.cumsum(cost, axis=0)])
+        return cum[:-1], cum[-1]
+
+    def _week_integral(self, offset):
+        i = np.searchsorted(self.week_cuts, offset, 'right') - 1
+        return self.week_cum[i] + self.rates[self.week_band[i], :2] * (offset - self.week_cuts[i])[..., None]
+
+    def _hol_integral(self, ms):
+        i = np.searchsorted(self.hol_cuts, ms, 'right') - 1
+        return self.hol_cum[i] + self.rates[self.hol_band[i], :2] * (ms - self.hol_cuts[i])[..., None]
+
+    def _holiday_at(self, day):
+        """(festivos anteriores al día, ¿el día es festivo?)"""
+        before = np.searchsorted(self.holidays, day, 'left')
+        if not len(self.holidays):
+            return before, np.zeros(np.shape(day), dtype=bool)
+        return before, self.holidays[np.minimum(before, len(self.holidays) - 1)] == day
+
+    @staticmethod
+    def _to_ms(t):
+        return to_ms(np.asarray(t, dtype=np.float64))
+
+    def _integral(self, t):
+        """
+        Integral de las tarifas por tiempo hasta t (en ms), partida en
+        (semanas completas, resto (..., 2) en nano-euros).
+        """
+        shifted = t + _MONDAY_SHIFT_MS
+        weeks = shifted // WEEK_MS
+        offset = shifted - weeks * WEEK_MS
+        week = self._week_integral(offset)
+        if not len(self.holidays):
+            return weeks, week
+        day = t // DAY_MS
+        before, on_holiday = self._holiday_at(day)
+        inner = week + self.hol_delta[before]
+        if on_holiday.any():
+            # Ese día se integra con el perfil de festivo en lugar del de la semana
+            ms = t - day * DAY_MS
+            change = self._hol_integral(ms) - (week - self._week_integral(offset - ms))
+            inner = inner + np.where(on_holiday[..., None], change, 0)
+        return weeks, inner
+
+    # =========================
+    # Consultas
+    # =========================
+    def time_cost(self, start, end, moving):
+        '''
+        Coste por tiempo, en nano-euros, de los tramos [start, end) parados
+        (moving=False) o en movimiento (moving=True). Acepta escalares o arrays.
+        '''
+        start_weeks, start_inner = self._integral(self._to_ms(start))
+        end_weeks, end_inner = self._integral(self._to_ms(end))
+        cost = (end_weeks - start_weeks)[..., None] * self.week_total + (end_inner - start_inner)
+        return _scalar(np.where(moving, cost[..., 1], cost[..., 0]))
+
+    def band_index(self, t):
+        '''Franja vigente en t (índice de names). Acepta escalares o arrays.'''
+        t = self._to_ms(t)
+        offset = (t + _MONDAY_SHIFT_MS) % WEEK_MS
+        band = self.week_band[np.searchsorted(self.week_cuts, offset, 'right') - 1]
+        if len(self.holidays):
+            day = t // DAY_MS
+            _, on_holiday = self._holiday_at(day)
+            ms = t - day * DAY_MS
+            band = np.where(on_holiday, self.hol_band[np.searchsorted(self.hol_cuts, ms, 'right') - 1], band)
+        return int(band) if np.ndim(band) == 0 else band
+
+    def rates_at(self, t):
+        '''Tarifas (parado, movimiento, base, km) vigentes en t, en micro-euros.'''
+        return self.rates[self.band_index(t)]
+
+    def split(self, start, end):
+        '''
+        Reparte el intervalo [start, end) entre las franjas que cruza.
+        Devuelve una lista de (inicio, fin, nombre de la franja), en segundos locales.
+        '''
+        pieces = []
+        t, end = int(self._to_ms(start)), int(self._to_ms(end))
+        while t < end:
+            band, until = self._piece(t)
+            until = min(until, end)
+            name = self.names[band]
+            if pieces and pieces[-1][2] == name:
+                pieces[-1] = (pieces[-1][0], until, name)
+            else:
+                pieces.append((t, until, name))
+            t = until
+        return [(a / 1000, b / 1000, name) for a, b, name in pieces]
+
+    def _piece(self, t):
+        """Franja vigente en t (ms) y el instante en que termina."""
+        day = t // DAY_MS
+        before, on_holiday = self._holiday_at(day)
+        if on_holiday:
+            ms = t - day * DAY_MS
+            i = int(np.searchsorted(self.hol_cuts, ms, 'right')) - 1
+            cut = int(self.hol_cuts[i + 1]) if i + 1 < len(self.hol_cuts) else DAY_MS
+            return int(self.hol_band[i]), day * DAY_MS + cut
+        offset = (t + _MONDAY_SHIFT_MS) % WEEK_MS
+        i = int(np.searchsorted(self.week_cuts, offset, 'right')) - 1
+        cut = int(self.week_cuts[i + 1]) if i + 1 < len(self.week_cuts) else WEEK_MS
+        until = t - offset + cut
+        if before < len(self.holidays):
+            until = min(until, int(self.holidays[before]) * DAY_MS)
+        return int(self.week_band[i]), until
+
+
+@lru_cache(maxsize=16)
+def schedule_for(tariff):
+    '''Índice de intervalos de una tarifa (se construye una vez por versión).'''
+    return TariffSchedule(tariff)
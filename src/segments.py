@@ -0,0 +1,292 @@
+import os
+import json
+import gzip
+import shutil
+import threading
+from collections import OrderedDict
+from history_index import MappedHistory, load_index, build_index, is_ordered, date_positions, as_index
+
+# =========================
+# Segmentos del historial de texto
+# =========================
+# historial.txt es el segmento activo. Al llegar a HISTORY_SEGMENT_BYTES (o al
+# cambiar de día, con HISTORY_SEGMENT_DAILY) se sella: se mueve con su índice a
+# historial.txt.segmentos/ como 000001.txt y 000001.idx, y después se comprime
+# en segundo plano (000001.txt.gz). manifiesto.json guarda de cada segmento
+# cuántos trayectos tiene, su fecha mínima y máxima y si sus fechas van en
+# orden, así una consulta por fechas se salta sin abrirlos los segmentos que
+# no le tocan.
+# Los segmentos sellados no cambian nunca: los ids de los trayectos (su
+# posición en todo el historial) son estables.
+
+SEGMENTS_SUFFIX = '.segmentos'
+
+
+class Segments:
+    '''
+    Segmentos sellados de un historial de texto.
+    Los cambios del manifiesto se hacen con el candado del historial tomado
+    (HistoryIndex.locked), así varios procesos pueden sellar y comprimir.
+    Guarda en caché los últimos segmentos descomprimidos.
+    '''
+
+    def __init__(self, history_path, cache_size=2):
+        self.directory = history_path + SEGMENTS_SUFFIX
+        self.manifest_path = os.path.join(self.directory, 'manifiesto.json')
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.Lock()
+
+    def path(self, segment, suffix):
+        return os.path.join(self.directory, f"{segment['id']:06d}{suffix}")
+
+    def load(self):
+        '''Segmentos sellados en orden (dicts del manifiesto).'''
+        try:
+            with open(self.manifest_path, 'r', encoding='utf-8') as f:
+                return json.load(f)['segmentos']
+        except FileNotFoundError:
+            return []
+
+    def save(self, segments):
+        '''Escribe el manifiesto de forma atómica (con el candado del historial tomado).'''
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = self.manifest_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'segmentos': segments}, f, indent=1)
+        os.replace(tmp, self.manifest_path)
+
+    def seal(self, history_path, index_path):
+        '''
+        Sella el segmento activo: mueve historial.txt y su índice (ya al día)
+        a un segmento nuevo. Con el candado del historial tomado.
+        Devuelve el segmento, o None si el activo está vacío.
+        '''
+        entries = load_index(index_path)
+        if not len(entries):
+            return None
+        segments = self.load()
+        segment = {
+            'id': segments[-1]['id'] + 1 if segments else 1,
+            'trayectos': len(entries),
+            'desde': float(entries['timestamp'].min()),
+            'hasta': float(entries['timestamp'].max()),
+            'ordenado': is_ordered(entries['timestamp']),
+            'bytes': os.path.getsize(history_path),
+            'comprimido': False,
+        }
+        del entries
+        os.makedirs(self.directory, exist_ok=True)
+        # Primero el índice: si se corta aquí, el activo se vuelve a indexar
+        os.replace(index_path, self.path(segment, '.idx'))
+        os.replace(history_path, self.path(segment, '.txt'))
+        self.save(segments + [segment])
+        return segment
+
+    def repair(self):
+        '''
+        Añade al manifiesto los segmentos que se movieron sin llegar a
+        apuntarse (caída al sellar) y borra los originales de los ya
+        comprimidos. Con el candado del historial tomado.
+        Devuelve los segmentos pendientes de comprimir.
+        '''
+        if not os.path.isdir(self.directory):
+            return []
+        segments = self.load()
+        known = {segment['id'] for segment in segments}
+        for name in sorted(os.listdir(self.directory)):
+            stem, extension = os.path.splitext(name)
+            if extension != '.txt' or not stem.isdigit() or int(stem) in known:
+                continue
+            raw = os.path.join(self.directory, name)
+            entries = build_index(raw)
+            with open(os.path.join(self.directory, stem + '.idx'), 'wb') as f:
+                f.write(entries.tobytes())
+            if not len(entries):
+                continue
+            segments.append({
+                'id': int(stem),
+                'trayectos': len(entries),
+                'desde': float(entries['timestamp'].min()),
+                'hasta': float(entries['timestamp'].max()),
+                'ordenado': is_ordered(entries['timestamp']),
+                'bytes': os.path.getsize(raw),
+                'comprimido': False,
+            })
+            known.add(int(stem))
+            segments.sort(key=lambda segment: segment['id'])
+            self.save(segments)
+        for segment in segments:
+            if segment['comprimido'] and os.path.exists(self.path(segment, '.txt')):
+                # Caída justo después de comprimirlo
+                os.remove(self.path(segment, '.txt'))
+        return [segment for segment in segments if not segment['comprimido']]
+
+    def compress(self, segment, lock):
+        '''
+        Comprime un segmento sellado (000001.txt -> 000001.txt.gz) y lo apunta
+        en el manifiesto. lock es el candado del historial (HistoryIndex.locked).
+        '''
+        raw = self.path(segment, '.txt')
+        if not os.path.exists(raw):
+            return
+        compressed = raw + '.gz'
+        with open(raw, 'rb') as source, gzip.open(compressed + '.tmp', 'wb', compresslevel=6) as target:
+            shutil.copyfileobj(source, target, 1 << 20)
+        os.replace(compressed + '.tmp', compressed)
+        with lock():
+            segments = self.load()
+            for stored in segments:
+                if stored['id'] == segment['id']:
+                    stored['comprimido'] = True
+                    stored['bytes_comprimidos'] = os.path.getsize(compressed)
+            self.save(segments)
+            # Los lectores que ya lo tengan abierto siguen leyéndolo hasta cerrarlo
+            os.remove(raw)
+
+    def data(self, segment):
+        '''Bytes del texto de un segmento (descomprimido si hace falta), con caché.'''
+        with self.lock:
+            if segment['id'] in self.cache:
+                self.cache.move_to_end(segment['id'])
+                return self.cache[segment['id']]
+        try:
+            with open(self.path(segment, '.txt'), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            # Ya comprimido (aunque la instantánea del manifiesto sea anterior)
+            with gzip.open(self.path(segment, '.txt.gz'), 'rb') as f:
+                data = f.read()
+        with self.lock:
+            self.cache[segment['id']] = data
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return data
+
+    def entries(self, segment):
+        '''Índice de un segmento (sin descomprimirlo).'''
+        return load_index(self.path(segment, '.idx'))
+
+
+def _overlaps(segment, start, end):
+    """False si ningún trayecto del segmento puede estar en [start, end)."""
+    if start is not None and segment['hasta'] < start.timestamp():
+        return False
+    return end is None or segment['desde'] < end.timestamp()
+
+
+class HistorySnapshot:
+    '''
+    Vista de todo el historial de texto en un momento dado: los segmentos
+    sellados y el activo, con ids de trayecto globales (1..len).
+    Los segmentos solo se leen (y descomprimen) si hacen falta sus trayectos.
+    Las partes son tuplas (primer id - 1, trayectos, segmento o None si es el activo).
+    '''
+
+    def __init__(self, segments, sealed, active):
+        self.segments = segments
+        self.parts = []
+        first = 0
+        for segment in sealed:
+            self.parts.append((first, segment['trayectos'], segment))
+            first += segment['trayectos']
+        active.first_id = first
+        self.active = active
+        self.parts.append((first, len(active), None))
+        self.readers = {}
+
+    def __len__(self):
+        first, count, _ = self.parts[-1]
+        return first + count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.active.close()
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+
+    def reader(self, part):
+        '''Lector (MappedHistory) de una parte, con los ids globales.'''
+        first, _, segment = part
+        if segment is None:
+            return self.active
+        if segment['id'] not in self.readers:
+            self.readers[segment['id']] = MappedHistory.from_data(
+                self.segments.entries(segment), self.segments.data(segment), first, segment.get('ordenado'))
+        return self.readers[segment['id']]
+
+    def entries(self, part):
+        '''Índice de una parte (sin leer sus trayectos).'''
+        segment = part[2]
+        if segment is None:
+            return self.active.index
+        if segment['id'] in self.readers:
+            return self.readers[segment['id']].index
+        return self.segments.entries(segment)
+
+    def ordered(self, part):
+        '''True si las fechas de una parte van en orden creciente.'''
+        segment = part[2]
+        if segment is None:
+            return self.active.ordered
+        if 'ordenado' not in segment:
+            # Manifiesto anterior a este campo
+            segment['ordenado'] = is_ordered(self.entries(part)['timestamp'])
+        return segment['ordenado']
+
+    def in_date_order(self):
+        '''True si todo el historial, segmento tras segmento, va en orden de fecha.'''
+        last = None
+        for part in self.parts:
+            if not self.ordered(part):
+                return False
+            if part[2] is not None:
+                first, final = part[2]['desde'], part[2]['hasta']
+            elif part[1]:
+                timestamps = self.active.index['timestamp']
+                first, final = float(timestamps[0]), float(timestamps[-1])
+            else:
+                continue
+            if last is not None and first < last:
+                return False
+            last = final
+        return True
+
+    def ranges(self, start=None, end=None):
+        '''
+        (parte, posiciones) de los trayectos con start <= fecha < end de cada
+        parte (ver date_positions), saltando los segmentos cuyo rango de
+        fechas no coincide.
+        '''
+        for part in self.parts:
+            if part[2] is not None and not _overlaps(part[2], start, end):
+                continue
+            positions = date_positions(self.entries(part)['timestamp'], start, end, self.ordered(part))
+            if len(positions):
+                yield part, positions
+
+    def costs(self, part, positions):
+        '''Costes del índice de una parte en positions (sin leer sus trayectos).'''
+        return self.entries(part)['cost'][as_index(positions)]
+
+    def records_range(self, lo, hi):
+        '''Trayectos con id global lo+1..hi.'''
+        trips = []
+        for part in self.parts:
+            first, count, _ = part
+            a, b = max(lo, first), min(hi, first + count)
+            if a < b:
+                trips += self.reader(part).records_range(a - first, b - first)
+        return trips
+
+    def text(self, part):
+        '''Texto en bytes de una parte, tal cual está escrito.'''
+        if part[2] is None:
+            return self.active.data[:] if self.active.data is not None else b""
+        return self.segments.data(part[2])
@@ -0,0 +1,547 @@
+import os
+import sqlite3
+import threading
+from datetime import datetime
+from itertools import groupby
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from trip_format import (
+    DATE_FORMAT, FIELDS, format_date, format_block
+)
+from history_index import HistoryIndex, MappedHistory, O_BINARY, locked, open_lock, same_file, scan_blocks, _map
+from segments import Segments, HistorySnapshot
+from money import euros_to_cents, cents_to_euros
+from aggregates import SummaryFile, add_trips, compare, day_range, summarize
+
+# Columnas por las que se permite ordenar en las consultas
+ORDER_COLUMNS = ('id', 'fecha', 'tipo', 'coste_total')
+
+
+def _matches(trip, start, end, tipo, min_cost, max_cost):
+    """Comprueba si un trayecto cumple los filtros de una consulta."""
+    if start is not None and trip['fecha'] < start:
+        return False
+    if end is not None and trip['fecha'] >= end:
+        return False
+    if tipo is not None and trip['tipo'] != tipo:
+        return False
+    if min_cost is not None and trip['coste_total'] < min_cost:
+        return False
+    if max_cost is not None and trip['coste_total'] > max_cost:
+        return False
+    return True
+
+
+# =========================
+# Backend de texto (formato clásico)
+# =========================
+class TextBackend:
+    """
+    Guarda los trayectos como bloques de texto en historial.txt, con un
+    índice lateral (historial.txt.idx) de offsets, fechas y costes. Las
+    consultas por fecha usan búsqueda binaria sobre el índice y solo leen
+    los bloques necesarios. Los totales por día y tipo se guardan en
+    historial.txt.sum y se ponen al día con cada lote escrito, como la
+    tabla resumen de SQLite.
+    Varios procesos (CLI, GUI, servicios) pueden escribir a la vez: cada lote
+    se añade con una sola escritura en modo O_APPEND, con un candado
+    compartido entre escritores, y cada bloque lleva su línea de control,
+    así un bloque cortado o mezclado se detecta y se salta al leer. El índice
+    y los totales se ponen al día con lo escrito por todos antes de cada
+    lectura (ver HistoryIndex.catch_up).
+    Con segment_bytes (o daily=True) el historial se parte en segmentos: al
+    llegar a ese tamaño (o al empezar un día nuevo) historial.txt se sella y
+    se comprime en segundo plano (ver segments.py). Las lecturas recorren
+    todos los segmentos como si fueran un solo archivo.
+    """
+
+    def __init__(self, path, segment_bytes=0, daily=False):
+        self.path = path
+        self.durability = 'flush'
+        self.segment_bytes = segment_bytes
+        self.daily = daily
+        self.fd = None
+        # Candado compartido de los escritores: el que sella el segmento
+        # activo toma el exclusivo (HistoryIndex.locked) y nadie escribe en él
+        self.write_fd = None
+        # Día del primer trayecto del segmento abierto en fd (None: sin leer)
+        self.active_day = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.index = HistoryIndex(path)
+        self.segments = Segments(path)
+        self.totals = SummaryFile(path)
+        # Un único hilo comprime los segmentos sellados, en orden
+        self.compressor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="history-compress")
+        with self.index.locked():
+            pending = self.segments.repair()
+        for segment in pending:
+            self.compressor.submit(self.segments.compress, segment, self.index.locked)
+        # Indexa lo que falte (historiales antiguos o escritos por otro programa)
+        with self._snapshot() as snapshot:
+            self.totals.catch_up(snapshot)
+
+    def set_durability(self, policy):
+        """'none' y 'flush': lo escrito ya está en el sistema operativo; 'fsync': además fsync."""
+        self.durability = policy
+
+    def append(self, trip_info):
+        self.append_many([trip_info])
+        self.sync()
+
+    def append_many(self, trips):
+        if self.daily:
+            # Con un segmento por día el lote se parte donde cambia el día,
+            # así cada trayecto va al segmento de su día
+            for _, same_day in groupby(trips, key=lambda trip: trip['fecha'].date()):
+                self._append_batch(list(same_day))
+        else:
+            self._append_batch(trips)
+
+    def _append_batch(self, trips):
+        data = "".join(format_block(trip) for trip in trips).encode('utf-8')
+        with self.write_lock:
+            if self.write_fd is None:
+                self.write_fd = open_lock(self.path)
+            roll = True
+            while True:
+                with locked(self.write_fd, shared=True):
+                    if self.fd is not None and not same_file(self.fd, self.path):
+                        # Otro proceso ha sellado el segmento: se sigue en el nuevo
+                        self._close_fd()
+                    if self.fd is None:
+                        self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | O_BINARY, 0o644)
+                    if not (roll and self._should_roll(trips[0]['fecha'])):
+                        # Una sola escritura por lote: con O_APPEND no se intercala con la de otro proceso
+                        written = os.write(self.fd, data)
+                        while written < len(data):
+                            # Escritura parcial (disco lleno, señal): el bloque partido se saltará al leer
+                            written += os.write(self.fd, data[written:])
+                        # Con O_APPEND el offset de fd queda justo tras lo escrito por este proceso
+                        end = os.lseek(self.fd, 0, os.SEEK_CUR)
+                        written_to = os.fstat(self.fd)
+                        break
+                roll = self._roll()
+        self._add_totals(trips, end - len(data), end, written_to)
+
+    def _add_totals(self, trips, start, end, written_to):
+        """
+        Suma a los totales el lote recién escrito en los bytes [start, end) del
+        archivo written_to (os.stat del segmento activo), sin releerlo. Si
+        antes hay trayectos de otros procesos aún sin sumar, o el segmento ya
+        se ha sellado, los totales se ponen al día leyendo el historial.
+        """
+        with self.lock:
+            with self.index.locked() as fd:
+                self.index.catch_up_locked(fd)
+                try:
+                    current = os.path.samestat(written_to, os.stat(self.path))
+                except OSError:
+                    current = False
+                if current:
+                    offsets = self.index.load()['offset']
+                    first = int(np.searchsorted(offsets, start))
+                    ours = int(np.searchsorted(offsets, end)) - first
+                    before = sum(segment['trayectos'] for segment in self.segments.load()) + first
+                    if ours == len(trips) and self.totals.covered == before:
+                        self.totals.add(trips)
+                        return
+            self._current_totals()
+
+    def _should_roll(self, date):
+        """True si el segmento activo debe sellarse antes de escribir un trayecto de date."""
+        if not self.segment_bytes and not self.daily:
+            return False
+        stat = os.fstat(self.fd)
+        if self.segment_bytes and stat.st_size >= self.segment_bytes:
+            return True
+        if not self.daily or stat.st_size == 0:
+            return False
+        if self.active_day is None:
+            # El primer trayecto de un archivo no cambia: se lee una vez por segmento
+            self.active_day = self._first_day()
+        return self.active_day is not None and date.date() > self.active_day
+
+    def _first_day(self):
+        """Día del primer trayecto del segmento activo, o None si aún no tiene ninguno entero."""
+        data = _map(self.path)
+        if data is None:
+            return None
+        try:
+            first = next(scan_blocks(data), None)
+        finally:
+            data.close()
+        return None if first is None else first[1]['fecha'].date()
+
+    def _roll(self):
+        """
+        Sella el segmento activo y lo comprime en segundo plano.
+        Devuelve False si no había nada que sellar (ningún trayecto entero).
+        """
+        with self.index.locked() as fd:
+            if self.fd is not None and not same_file(self.fd, self.path):
+                # Ya lo ha sellado otro proceso
+                return True
+            self.index.catch_up_locked(fd)
+            segment = self.segments.seal(self.path, self.index.path)
+            if segment is not None:
+                self.index.close_file()
+        if segment is None:
+            return False
+        self._close_fd()
+        self.compressor.submit(self.segments.compress, segment, self.index.locked)
+        return True
+
+    def _close_fd(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.active_day = None
+
+    def sync(self):
+        if self.fd is not None and self.durability == 'fsync':
+            os.fsync(self.fd)
+        if self.durability != 'none':
+            with self.lock:
+                self.totals.save()
+
+    def reader(self):
+        """
+        Lector mapeado en memoria del segmento activo (usa el índice lateral):
+        una instantánea de sus trayectos completos en este momento.
+        """
+        self.index.catch_up()
+        return MappedHistory(self.index)
+
+    def _snapshot(self):
+        """Instantánea de todo el historial: segmentos sellados y activo (ver HistorySnapshot)."""
+        with self.index.locked() as fd:
+            self.index.catch_up_locked(fd)
+            sealed = self.segments.load()
+            active = MappedHistory(self.index)
+        return HistorySnapshot(self.segments, sealed, active)
+
+    def _current_totals(self):
+        """Pone al día los totales con lo escrito por todos (con el lock tomado)."""
+        with self._snapshot() as snapshot:
+            self.totals.catch_up(snapshot)
+
+    def iter_trips(self):
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self, after_id=0, size=10_000):
+        """Trayectos con id mayor que after_id, en listas de hasta size (memoria acotada)."""
+        with self._snapshot() as snapshot:
+            for first in range(after_id, len(snapshot), size):
+                yield snapshot.records_range(first, first + size)
+
+    def query(self, start=None, end=None, tipo=None, min_cost=None, max_cost=None,
+              order_by='fecha', descending=False, offset=0, limit=None):
+        if order_by not in ORDER_COLUMNS:
+            raise ValueError(f"No se puede ordenar por {order_by}")
+        with self._snapshot() as snapshot:
+            ranges = list(snapshot.ranges(start, end))
+            if (tipo is None and min_cost is None and max_cost is None
+                    and (order_by == 'id' or order_by == 'fecha' and snapshot.in_date_order())):
+                # Las posiciones ya van en el orden pedido: solo se leen los bloques
+                # de la página, y los segmentos que quedan antes de ella ni se abren
+                trips = []
+                for part, positions in (reversed(ranges) if descending else ranges):
+                    if limit is not None and len(trips) >= limit:
+                        break
+                    n = len(positions)
+                    if offset >= n:
+                        offset -= n
+                        continue
+                    take = n - offset if limit is None else min(n - offset, limit - len(trips))
+                    if descending:
+                        trips += snapshot.reader(part).read(positions[n - offset - take:n - offset])[::-1]
+                    else:
+                        trips += snapshot.reader(part).read(positions[offset:offset + take])
+                    offset = 0
+                return trips
+            # Con otros filtros u orden, o fechas desordenadas: se filtra y se ordena
+            trips = [t for part, positions in ranges for t in snapshot.reader(part).read(positions)
+                     if _matches(t, None, None, tipo, min_cost, max_cost)]
+        trips.sort(key=lambda t: (t[order_by], t['id']), reverse=descending)
+        stop = None if limit is None else offset + limit
+        return trips[offset:stop]
+
+    def count(self, start=None, end=None, tipo=None, min_cost=None, max_cost=None):
+        with self._snapshot() as snapshot:
+            total = 0
+            for part, positions in snapshot.ranges(start, end):
+                if tipo is None:
+                    costs = snapshot.costs(part, positions)
+                    if min_cost is not None:
+                        costs = costs[costs >= min_cost]
+                    if max_cost is not None:
+                        costs = costs[costs <= max_cost]
+                    total += len(costs)
+                else:
+                    total += sum(1 for t in snapshot.reader(part).read(positions)
+                                 if _matches(t, None, None, tipo, min_cost, max_cost))
+            return total
+
+    def revenue(self, start=None, end=None, tipo=None):
+        with self._snapshot() as snapshot:
+            cents = 0
+            for part, positions in snapshot.ranges(start, end):
+                if tipo is None:
+                    cents += int(euros_to_cents(snapshot.costs(part, positions)).sum())
+                else:
+                    cents += sum(euros_to_cents(t['coste_total'])
+                                 for t in snapshot.reader(part).read(positions) if t['tipo'] == tipo)
+            return cents_to_euros(cents)
+
+    def summary(self, start=None, end=None, tipo=None):
+        with self.lock:
+            self._current_totals()
+            return summarize(self.totals.rows(start, end, tipo))
+
+    def daily_summary(self, start=None, end=None, tipo=None):
+        with self.lock:
+            self._current_totals()
+            return self.totals.rows(start, end, tipo)
+
+    def rebuild_summary(self, check_only=False):
+        with self.lock:
+            fresh = {}
+            # Se relee una instantánea: lo que se escriba mientras tanto se suma después
+            with self._snapshot() as snapshot:
+                self.totals.catch_up(snapshot)
+                step = 10_000
+                for first in range(0, len(snapshot), step):
+                    add_trips(fresh, snapshot.records_range(first, first + step))
+                covered = len(snapshot)
+            differences = compare(self.totals.totals, fresh)
+            if not check_only:
+                self.totals.replace(fresh, covered)
+                self.totals.save()
+        return differences
+
+    def read_text(self):
+        with self._snapshot() as snapshot:
+            return b"".join(snapshot.text(part) for part in snapshot.parts).decode('utf-8', errors='replace')
+
+    def close(self):
+        with self.write_lock:
+            self._close_fd()
+            if self.write_fd is not None:
+                os.close(self.write_fd)
+                self.write_fd = None
+        # Termina de comprimir los segmentos sellados
+        self.compressor.shutdown(wait=True)
+        with self.lock:
+            self.index.close()
+            self.totals.save()
+
+
+# =========================
+# Backend SQLite (registros indexados)
+# =========================
+class SQLiteBackend:
+    """
+    Guarda los trayectos como registros en una base SQLite en modo WAL,
+    con índices por fecha, tipo y coste.
+    Los totales por día y tipo (tabla resumen) se actualizan en la misma
+    transacción que cada lote de trayectos.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS trayectos (
+            id INTEGER PRIMARY KEY,
+            fecha TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            distancia_total REAL,
+            tiempo_parado REAL,
+            tiempo_movimiento REAL,
+            duracion_total REAL,
+            coste_total REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_trayectos_fecha ON trayectos (fecha);
+        CREATE INDEX IF NOT EXISTS idx_trayectos_tipo ON trayectos (tipo, fecha);
+        CREATE INDEX IF NOT EXISTS idx_trayectos_coste ON trayectos (coste_total);
+        CREATE TABLE IF NOT EXISTS resumen (
+            dia TEXT NOT NULL,
+            tipo TEXT NOT NULL,
+            viajes INTEGER NOT NULL,
+            centimos INTEGER NOT NULL,
+            ms_parado INTEGER NOT NULL,
+            ms_movimiento INTEGER NOT NULL,
+            metros INTEGER NOT NULL,
+            PRIMARY KEY (dia, tipo)
+        );
+    """
+
+    # Mismo redondeo que aggregates.add_trips (money.py), para recalcular en SQL
+    SUMMARY_FROM_TRIPS = """
+        SELECT substr(fecha, 1, 10), tipo, COUNT(*),
+               SUM(CAST(ROUND(coste_total * 100) AS INTEGER)),
+               SUM(CAST(COALESCE(tiempo_parado, 0) * 1000 + 0.5 AS INTEGER)),
+               SUM(CAST(COALESCE(tiempo_movimiento, 0) * 1000 + 0.5 AS INTEGER)),
+               SUM(CAST(COALESCE(distancia_total, 0) * 1000 + 0.5 AS INTEGER))
+        FROM trayectos GROUP BY 1, 2
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("PRAGMA busy_timeout=5000")
+        new_summary = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'resumen'").fetchone() is None
+        self.conn.executescript(self.SCHEMA)
+        if new_summary:
+            # Base creada antes de existir la tabla resumen: se calcula una vez
+            self.rebuild_summary()
+
+    # Política de durabilidad -> PRAGMA synchronous (se aplica en cada commit)
+    SYNCHRONOUS = {'none': 'OFF', 'flush': 'NORMAL', 'fsync': 'FULL'}
+
+    def set_durability(self, policy):
+        with self.lock:
+            self.conn.execute(f"PRAGMA synchronous={self.SYNCHRONOUS[policy]}")
+
+    def append(self, trip_info):
+        self.append_many([trip_info])
+
+    def sync(self):
+        # Cada lote ya se confirma en su propia transacción
+        pass
+
+    def append_many(self, trips):
+        rows = [
+            (
+                format_date(t['fecha']), t['tipo'], t.get('distancia_total'),
+                t.get('tiempo_parado'), t.get('tiempo_movimiento'),
+                t.get('duracion_total'), t['coste_total'],
+            )
+            for t in trips
+        ]
+        totals = [(*key, *values) for key, values in add_trips({}, trips).items()]
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT INTO trayectos (fecha, tipo, distancia_total, tiempo_parado,"
+                " tiempo_movimiento, duracion_total, coste_total) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self.conn.executemany(
+                "INSERT INTO resumen VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (dia, tipo) DO UPDATE SET"
+                " viajes = viajes + excluded.viajes, centimos = centimos + excluded.centimos,"
+                " ms_parado = ms_parado + excluded.ms_parado,"
+                " ms_movimiento = ms_movimiento + excluded.ms_movimiento,"
+                " metros = metros + excluded.metros",
+                totals,
+            )
+
+    @staticmethod
+    def _where(start, end, tipo, min_cost, max_cost):
+        clauses, params = [], []
+        if start is not None:
+            clauses.append("fecha >= ?")
+            params.append(format_date(start))
+        if end is not None:
+            clauses.append("fecha < ?")
+            params.append(format_date(end))
+        if tipo is not None:
+            clauses.append("tipo = ?")
+            params.append(tipo)
+        if min_cost is not None:
+            clauses.append("coste_total >= ?")
+            params.append(min_cost)
+        if max_cost is not None:
+            clauses.append("coste_total <= ?")
+            params.append(max_cost)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        return where, params
+
+    @staticmethod
+    def _row_to_trip(row):
+        trip = {'id': row[0]}
+        for key, value in zip(FIELDS, row[1:]):
+            if value is not None:
+                trip[key] = value
+        trip['fecha'] = datetime.strptime(trip['fecha'], DATE_FORMAT)
+        return trip
+
+    def iter_trips(self):
+        # Por lotes: la memoria no crece con el tamaño del historial
+        for chunk in self.iter_chunks():
+            yield from chunk
+
+    def iter_chunks(self, after_id=0, size=10_000):
+        """Trayectos con id mayor que after_id, en listas de hasta size (memoria acotada)."""
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, " + ", ".join(FIELDS) + " FROM trayectos WHERE id > ? ORDER BY id LIMIT ?",
+                    (after_id, size)).fetchall()
+            if not rows:
+                return
+            yield [self._row_to_trip(row) for row in rows]
+            after_id = rows[-1][0]
+
+    def query(self, start=None, end=None, tipo=None, min_cost=None, max_cost=None,
+              order_by='fecha', descending=False, offset=0, limit=None):
+        if order_by not in ORDER_COLUMNS:
+            raise ValueError(f"No se puede ordenar por {order_by}")
+        where, params = self._where(start, end, tipo, min_cost, max_cost)
+        direction = "DESC" if descending else "ASC"
+        sql = ("SELECT id, " + ", ".join(FIELDS) + " FROM trayectos" + where
+               + f" ORDER BY {order_by} {direction}, id {direction} LIMIT ? OFFSET ?")
+        params += [-1 if limit is None else limit, offset]
+        with self.lock:
+            rows = self.conn.execute(sql, params).fetchall()
+        return [self._row_to_trip(row) for row in rows]
+
+    def count(self, start=None, end=None, tipo=None, min_cost=None, max_cost=None):
+        where, params = self._where(start, end, tipo, min_cost, max_cost)
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM trayectos" + where, params).fetchone()[0]
+
+    def revenue(self, start=None, end=None, tipo=None):
+        where, params = self._where(start, end, tipo, None, None)
+        with self.lock:
+            # Se suma en céntimos enteros para que coincida con la suma de los recibos
+            total = self.conn.execute("SELECT SUM(CAST(ROUND(coste_total * 100) AS INTEGER)) FROM trayectos"
+                                      + where, params).fetchone()[0]
+        return cents_to_euros(total or 0)
+
+    def daily_summary(self, start=None, end=None, tipo=None):
+        lo, hi = day_range(start, end)
+        clauses, params = [], []
+        for clause, value in (("dia >= ?", lo), ("dia < ?", hi), ("tipo = ?", tipo)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        where = (" WHERE " + " AND ".join(clauses)) if clauses else ""
+        with self.lock:
+            return self.conn.execute("SELECT * FROM resumen" + where + " ORDER BY dia, tipo", params).fetchall()
+
+    def summary(self, start=None, end=None, tipo=None):
+        return summarize(self.daily_summary(start, end, tipo))
+
+    def rebuild_summary(self, check_only=False):
+        with self.lock, self.conn:
+            stored = {(row[0], row[1]): list(row[2:]) for row in self.conn.execute("SELECT * FROM resumen")}
+            fresh = {(row[0], row[1]): list(row[2:]) for row in self.conn.execute(self.SUMMARY_FROM_TRIPS)}
+            differences = compare(stored, fresh)
+            if differences and not check_only:
+                self.conn.execute("DELETE FROM resumen")
+                self.conn.executemany("INSERT INTO resumen VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [(*key, *values) for key, values in fresh.items()])
+        return differences
+
+    def read_text(self):
+        return "".join(format_block(trip) for trip in self.iter_trips())
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
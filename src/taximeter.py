@@ -1,50 +1,24 @@
-import time
 import os
 import logging
 from history import save_history
-from datetime import datetime
-from config import fare_config
-
-# =========================
-# Configuración de logging
-# =========================
-if not os.path.exists('logs'):
-    os.makedirs('logs')
-
-logging.basicConfig(
-    filename='logs/taximeter.log', 
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
+from config import history_config, log_config, watch_tariff
+from log_setup import setup_logging
+from events import open_event_log
+from checkpoint import open_checkpoint, recover
+from metrics import timer, start_exporter
+# Las funciones de tarifa viven en fares.py (se importan también desde aquí)
+from fares import (
+    calculate_time_fare, calculate_distance_fare,
+    calculate_time_fares, calculate_distance_fares,
 )
-
-#Cargar la configuracion del archivo .env
-config = fare_config()
+from meter import TripMeter, MOVING, time_trip_info, distance_trip_info
 
 # =========================
-# Función de tarifa
+# Configuración de logging
 # =========================
-
-def calculate_time_fare(seconds_stopped, seconds_moving):
-    '''
-    funcion para calcular la tarifa usando tiempo.
-    stopped: 0.02€/s
-    moving: 0.05€/s
-    '''
-    if seconds_stopped < 0 or seconds_moving < 0:
-        raise ValueError("Los tiempos no pueden ser negativos")
-    fare = (seconds_stopped * config['stopped_fare']) + (seconds_moving * config['moving_fare'])
-    #print(lang["total_fare"].format(fare=fare))
-    return fare
-
-def calculate_distance_fare(distance):
-    '''
-    funcion para calcular la tarifa usando distancia.
-    '''
-    if distance <= 0:
-        raise ValueError("La distancia debe ser mayor que 0")
-    fare = config['base_fare'] + distance * config['price_per_km']
-    #print(lang["total_fare"].format(fare=fare))
-    return fare
+def setup_cli_logging():
+    '''Logging en segundo plano con rotación en logs/taximeter.log.'''
+    setup_logging(os.path.join('logs', 'taximeter.log'), **log_config())
 
 #Función validador de distancia
 def get_distance(lang):
@@ -56,12 +30,46 @@ def get_distance(lang):
             distance = float(input(lang["enter_distance"]))
             if distance <= 0:
                 print(lang["invalid_distance"])
-                logging.error(f"Distancia introducida por el usuario no válida: {distance} km")
+                logging.error("Distancia introducida por el usuario no válida: %s km", distance)
                 continue
             return distance
         except ValueError:
             print(lang["invalid_distance"])
 
+# =========================
+# Resumen y viaje interrumpido
+# =========================
+def show_summary(lang, stopped_time, moving_time, total_fare):
+    '''Muestra el resumen de un viaje por tiempo terminado.'''
+    print(lang["finish_header"])
+    print(lang["time_stopped"].format(t=stopped_time))
+    print(lang["time_moving"].format(t=moving_time))
+    print(lang["total_fare"].format(fare=total_fare))
+
+
+def recover_trip(lang, meter, checkpoint):
+    '''
+    Si el proceso anterior murió a mitad de viaje, pregunta si retomarlo;
+    si no, lo cierra cobrando hasta el último checkpoint y lo guarda en el historial.
+    '''
+    snapshot = checkpoint.load()
+    if snapshot is None:
+        return
+    resume = False
+    if not snapshot['finished']:
+        stopped, moving = snapshot['elapsed']
+        answer = input(lang["interrupted_trip"].format(stopped=stopped, moving=moving)).strip().lower()
+        resume = answer in ('s', 'si', 'sí', 'y', 'yes')
+    result = recover(meter, snapshot, resume)
+    if result is None:
+        state = lang["cmd_move"] if meter.state == MOVING else lang["cmd_stop"]
+        print(lang["trip_resumed"].format(state=state))
+        return
+    print(lang["trip_recovered"])
+    show_summary(lang, *result)
+    checkpoint.release(save_history(time_trip_info(*result)))
+    logging.info("Trayecto por tiempo recuperado guardado en historial")
+
 # =========================
 # Función principal
 # =========================
@@ -70,130 +78,89 @@ def taximeter(lang, commands):
     funcion para manejar y mostrar las opciones
     del taximetro usando diccionarios de idioma.
     '''
-    trip_activate = False
-    start_time = 0
-    stopped_time = 0
-    moving_time = 0
-    state = None
-    state_start_time = 0
+    setup_cli_logging()
+    watch_tariff()
+    start_exporter()
+    settings = history_config()
+    checkpoint = open_checkpoint(settings['checkpoint'], 'cli')
+    meter = TripMeter(listener=open_event_log(settings['event_log']), checkpoint=checkpoint)
     
     print(lang["welcome"])
     print(lang["commands"])
+    if checkpoint is not None:
+        recover_trip(lang, meter, checkpoint)
+        # Durante el viaje la CLI espera en input(): el checkpoint se refresca en un hilo
+        checkpoint.start_heartbeat(settings['checkpoint_interval'])
 
     while True: 
         command = input('> ').strip().lower()
         
         #Iniciar viaje
         if command == commands["start"]:
-            if trip_activate:
+            if meter.active:
                 print(lang["start_error"])
                 logging.error("Intento de inicio de viaje cuando ya hay un viaje en curso")
                 continue
             
-            trip_activate = True
-            start_time = time.time()
-            stopped_time = 0
-            moving_time = 0
-            state = 'stopped'
-            state_start_time = time.time()
-            
             # Elegir modo de cálculo
             mode = input(lang["choose_mode"]).strip().lower()
             if mode in ("distancia", "distance"):
                 try:
                     distance = get_distance(lang)
-                    total_fare = calculate_distance_fare(distance)
-                    print(lang["total_fare"].format(fare=total_fare))
-                    logging.info(f"Viaje calculado por distancia: {distance} km, Total: {total_fare} €")
-                
-                    trip_info = {
-                        "fecha": datetime.now(),
-                        "tipo": "distancia",
-                        "distancia_total": round(distance, 2),
-                        "coste_total": round(total_fare, 2)
-                    }
-                    save_history(trip_info)
-                    logging.info("Trayecto por distancia guardado en historial")
+                    # Se mide a partir de aquí, sin el tiempo que el usuario tarda en responder
+                    with timer('taximeter_command_seconds', command='distance'):
+                        total_fare, trip_info = distance_trip_info(distance)
+                        print(lang["total_fare"].format(fare=total_fare))
+                        logging.info("Viaje calculado por distancia: %s km, Total: %s €", distance, total_fare)
+                        save_history(trip_info)
+                        logging.info("Trayecto por distancia guardado en historial")
                 
                 except ValueError:
                     print(lang["invalid_distance"])
                     logging.error("Distancia inválida introducida por el usuario")
-                    
-                # Reiniciar variables para permitir nuevo viaje
-                trip_activate = False
                 continue
             
-            print(lang["trip_started"])
-            logging.info("Viaje iniciado (modo tiempo)")
+            with timer('taximeter_command_seconds', command='start'):
+                meter.start()
+                print(lang["trip_started"])
+                logging.info("Viaje iniciado (modo tiempo)")
 
         #Cambio de estado
         elif command in (commands["stop"], commands["move"]):
-            if not trip_activate:
+            if not meter.active:
                 print(lang["no_trip"])
                 logging.error("Intento de cambio de estado sin viaje en curso")
                 continue
             
-            #Calcula el tiempo del estado anterior
-            duration = time.time() - state_start_time
-            if state == 'stopped':
-                stopped_time += duration
-            else:
-                moving_time += duration
-            
-            #Cambia el estado
-            state = 'stopped' if command == commands["stop"] else 'moving'
-            state_start_time = time.time()
-            
-            #Muestra el cambio de estado usando el diccionario
-            if state == 'stopped':
-                print(lang["state_changed"].format(cmd=lang["cmd_stop"], state=lang["cmd_stop"]))
-            else:
-                print(lang["state_changed"].format(cmd=lang["cmd_move"], state=lang["cmd_move"]))
-            logging.info(f"Cambio de estado a {state}")
+            #Cambia el estado (el motor acumula el tiempo del estado anterior)
+            name = 'stop' if command == commands["stop"] else 'move'
+            with timer('taximeter_command_seconds', command=name):
+                if name == 'stop':
+                    meter.stop()
+                    print(lang["state_changed"].format(cmd=lang["cmd_stop"], state=lang["cmd_stop"]))
+                else:
+                    meter.move()
+                    print(lang["state_changed"].format(cmd=lang["cmd_move"], state=lang["cmd_move"]))
+                logging.info("Cambio de estado a %s", meter.state)
 
         #Finalizar el viaje
         elif command == commands["finish"]:
-            if not trip_activate:
+            if not meter.active:
                 print(lang["no_trip"])
                 logging.error("Intento de finalizar viaje sin viaje activo")
                 continue
             
-            duration = time.time() - state_start_time
-            if state == "stopped":
-                stopped_time += duration
-            else:
-                moving_time += duration
-            
-            #Mostrar resumen del viaje
-            print(lang["finish_header"])
-            print(lang["time_stopped"].format(t=stopped_time))
-            print(lang["time_moving"].format(t=moving_time))
-            
-            #Calcula la tarifa total
-            total_fare = calculate_time_fare(stopped_time, moving_time)
-            print(lang["total_fare"].format(fare=total_fare))
-            logging.info(f"Viaje finalizado. Total: {total_fare:.2f} €")    
-
-            # ===========================
-            # CREAR TRAYECTO PARA HISTORIAL
-            # ===========================
-            trip_info = {
-                "fecha": datetime.now(),
-                "tipo": "tiempo",
-                "tiempo_parado": round(stopped_time, 2),
-                "tiempo_movimiento": round(moving_time, 2),
-                "duracion_total": round(stopped_time + moving_time, 2),
-                "coste_total": round(total_fare, 2)
-            }
+            with timer('taximeter_command_seconds', command='finish'):
+                stopped_time, moving_time, total_fare = meter.finish()
 
-            save_history(trip_info)
-            logging.info("Trayecto por tiempo guardado en historial")
+                #Mostrar resumen del viaje
+                show_summary(lang, stopped_time, moving_time, total_fare)
+                logging.info("Viaje finalizado. Total: %.2f €", total_fare)
 
-            #Reinicia las variables para un nuevo viaje
-            trip_activate = False
-            stopped_time = 0
-            moving_time = 0
-            state = None
+                future = save_history(time_trip_info(stopped_time, moving_time, total_fare))
+                if checkpoint is not None:
+                    checkpoint.release(future)
+                logging.info("Trayecto por tiempo guardado en historial")
 
         #Salir del programa
         elif command == commands['exit']:
@@ -203,7 +170,7 @@ def taximeter(lang, commands):
         #Comando desconocido
         else:
             print(lang["unknown"])
-            logging.warning(f"Comando desconocido introducido: {command}")
+            logging.warning("Comando desconocido introducido: %s", command)
 
 if __name__ == '__main__':
     taximeter()
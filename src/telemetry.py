@@ -0,0 +1,542 @@
+import os
+import sys
+import csv
+import time
+import socket
+import argparse
+from datetime import datetime
+import numpy as np
+from config import current_tariff, telemetry_config
+from fleet import FleetManager
+from fares import calculate_distance_fare
+from schedule import local_seconds
+from meter import time_trip_info
+from history import save_history
+
+# =========================
+# Telemetría GPS
+# =========================
+# Una línea por posición: id_viaje,timestamp,lat,lon
+# (timestamp en segundos epoch, lat y lon en grados), y una línea
+# id_viaje,timestamp,fin cuando termina el viaje.
+# Los ids de viaje son enteros y no se reutilizan; un viaje empieza
+# con su primera posición. Se ignoran las líneas vacías, los
+# comentarios (#) y una cabecera que empiece por "id".
+
+EARTH_RADIUS_KM = 6371.0088
+CHUNK_BYTES = 1 << 20
+SMOOTHING = 3  # tramos con los que se suaviza la distancia
+
+TRIP_OUTPUT = ('id', 'inicio', 'fin', 'tiempo_parado', 'tiempo_movimiento', 'distancia_total',
+               'coste_tiempo', 'coste_distancia', 'posiciones', 'descartadas', 'cierre')
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    '''Distancia en km sobre la esfera entre pares de puntos en grados (arrays).'''
+    lat1, lon1, lat2, lon2 = (np.radians(a) for a in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+
+# =========================
+# Lectura
+# =========================
+def _three_commas_per_line(data, count):
+    """True si data tiene count líneas (separadas por \\n) y cada una tiene exactamente 3 comas."""
+    raw = np.frombuffer(data, dtype=np.uint8)
+    breaks = np.flatnonzero(raw == ord("\n"))
+    if len(breaks) != count - (0 if data.endswith(b"\n") else 1):
+        # Otros saltos de línea (\r suelto, etc.): lo decide el camino lento
+        return False
+    line_of_comma = np.searchsorted(breaks, np.flatnonzero(raw == ord(",")))
+    return bool(np.all(np.bincount(line_of_comma, minlength=count) == 3))
+
+
+def parse_block(data):
+    '''
+    Convierte un bloque de líneas completas en columnas.
+    Devuelve (ids, timestamps, lat, lon, fines, errores): fines es una lista
+    de (id, timestamp) y errores una lista de (línea, mensaje).
+    '''
+    lines = data.decode('utf-8', errors='replace').splitlines()
+    # Camino rápido: solo posiciones bien formadas, convertidas de una vez.
+    # Cada línea debe tener sus 3 comas: si no, una de 3 campos junto a una
+    # de 5 desplazaría todas las posiciones siguientes sin dar error
+    fields = ",".join(lines).split(",")
+    if len(fields) == 4 * len(lines) and _three_commas_per_line(data, len(lines)):
+        try:
+            return (np.array(fields[0::4], dtype=np.int64), np.array(fields[1::4], dtype=np.float64),
+                    np.array(fields[2::4], dtype=np.float64), np.array(fields[3::4], dtype=np.float64),
+                    [], [])
+        except ValueError:
+            pass
+    ids, ts, lats, lons, ends, errors = [], [], [], [], [], []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#') or line.lower().startswith('id'):
+            continue
+        parts = [part.strip() for part in line.split(',')]
+        try:
+            if len(parts) == 3 and parts[2].lower() == 'fin':
+                ends.append((int(parts[0]), float(parts[1])))
+                continue
+            if len(parts) != 4:
+                raise ValueError(f"se esperaban 4 campos y hay {len(parts)}")
+            trip_id, t, lat, lon = int(parts[0]), float(parts[1]), float(parts[2]), float(parts[3])
+        except ValueError as e:
+            errors.append((line, str(e)))
+            continue
+        ids.append(trip_id)
+        ts.append(t)
+        lats.append(lat)
+        lons.append(lon)
+    return (np.array(ids, dtype=np.int64), np.array(ts, dtype=np.float64),
+            np.array(lats, dtype=np.float64), np.array(lons, dtype=np.float64), ends, errors)
+
+
+def read_blocks(stream, size=CHUNK_BYTES):
+    '''
+    Lee un flujo binario en bloques de líneas completas de hasta unos size bytes.
+    Entrega lo que va llegando sin esperar a llenar el bloque (tuberías y sockets).
+    '''
+    rest = b""
+    read = getattr(stream, 'read1', stream.read)
+    while True:
+        data = read(size)
+        if not data:
+            break
+        data = rest + data
+        cut = data.rfind(b"\n") + 1
+        rest = data[cut:]
+        if cut:
+            yield data[:cut]
+    if rest.strip():
+        yield rest
+
+
+def _address(spec):
+    '''unix:RUTA o tcp:[HOST:]PUERTO -> (familia, dirección).'''
+    kind, _, where = spec.partition(':')
+    if kind == 'unix':
+        return socket.AF_UNIX, where
+    if kind == 'tcp':
+        host, _, port = where.rpartition(':')
+        return socket.AF_INET, (host or '127.0.0.1', int(port))
+    raise ValueError(f"Dirección no válida: {spec!r} (usa unix:RUTA o tcp:[HOST:]PUERTO)")
+
+
+def listen(spec):
+    '''Abre un socket local que escucha en spec (unix:RUTA o tcp:[HOST:]PUERTO).'''
+    family, address = _address(spec)
+    if family == socket.AF_UNIX:
+        if os.path.exists(address):
+            os.remove(address)  # socket de una ejecución anterior
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(address)
+        server.listen(1)
+        return server
+    return socket.create_server(address)
+
+
+def accept_stream(server):
+    '''Espera una conexión (por ejemplo, un replay) y devuelve su flujo de lectura.'''
+    conn, _ = server.accept()
+    server.close()
+    stream = conn.makefile('rb')
+    conn.close()  # el socket sigue abierto hasta cerrar el flujo
+    return stream
+
+
+# =========================
+# Pipeline
+# =========================
+class GpsPipeline:
+    '''
+    Convierte las posiciones GPS de muchos viajes a la vez en los tiempos
+    y distancias de un FleetManager, bloque a bloque y con NumPy.
+    De cada viaje solo se guardan sus últimas posiciones (window), así la
+    memoria no crece con la duración del viaje.
+    - Descarta posiciones inválidas, repetidas o anteriores a la última procesada.
+    - Quita los picos (una posición que se aleja y vuelve a más de max_speed)
+      y no suma la distancia de los tramos imposibles (saltos del GPS).
+    - La velocidad se mide sobre los últimos window tramos: con el taxi parado,
+      el ruido del GPS no suma distancia ni lo pasa a movimiento.
+    - Los tramos a moving_speed o más suman distancia y tiempo en movimiento;
+      el resto, tiempo parado.
+    Cada viaje terminado lleva sus dos tarifas, por tiempo y por distancia.
+    Las velocidades van en km/h; sin valores se usan los del .env (config.telemetry_config).
+    '''
+
+    def __init__(self, tariff=None, moving_speed=None, max_speed=None, window=None,
+                 trip_timeout=None, capacity=1024):
+        settings = telemetry_config()
+        self.tariff = tariff
+        # Velocidades en km/s, la unidad de haversine_km entre timestamps
+        self.moving_speed = (moving_speed or settings['moving_speed']) / 3600
+        self.max_speed = (max_speed or settings['max_speed']) / 3600
+        self.window = window or settings['window']
+        self.keep = max(self.window, SMOOTHING)  # posiciones que se guardan por viaje
+        self.trip_timeout = trip_timeout or settings['trip_timeout']
+        self.now = 0.0
+        self.latest = -np.inf  # timestamp más reciente recibido
+        self.fleet = FleetManager(clock=lambda: self.now, wall_clock=lambda: self.now)
+        self.slots = {}
+        self.free = []
+        self.size = 0
+        self.capacity = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        def grow(name, dtype, fill=0, width=None):
+            shape = (capacity,) if width is None else (capacity, width)
+            new = np.full(shape, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+        grow('ids', object, None)
+        grow('tariffs', object, None)
+        grow('active', bool, False)
+        grow('moving', bool, False)
+        grow('start_t', np.float64)
+        grow('last_t', np.float64, -np.inf)  # última posición aceptada
+        grow('seen_t', np.float64, -np.inf)  # última posición recibida
+        grow('fixes', np.int64)
+        grow('dropped', np.int64)
+        # Últimas posiciones aceptadas, alineadas a la derecha (la más reciente al final)
+        grow('tail_count', np.int64)
+        grow('tail_t', np.float64, 0.0, self.keep)
+        grow('tail_lat', np.float64, 0.0, self.keep)
+        grow('tail_lon', np.float64, 0.0, self.keep)
+        self.capacity = capacity
+
+    def __len__(self):
+        return len(self.slots)
+
+    def _start(self, trip_id, when):
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self._allocate(self.capacity * 2)
+            slot = self.size
+            self.size += 1
+        tariff = self.tariff or current_tariff()
+        self.now = when
+        self.fleet.start(trip_id, when, tariff)
+        self.slots[trip_id] = slot
+        self.ids[slot] = trip_id
+        self.tariffs[slot] = tariff
+        self.active[slot] = True
+        self.moving[slot] = False
+        self.start_t[slot] = when
+        self.last_t[slot] = self.seen_t[slot] = -np.inf
+        self.fixes[slot] = self.dropped[slot] = self.tail_count[slot] = 0
+        return slot
+
+    def _slots_for(self, ids, t):
+        '''Fila de cada posición; los viajes nuevos empiezan en su primera posición.'''
+        unique, inverse = np.unique(ids, return_inverse=True)
+        first = np.full(len(unique), np.inf)
+        np.minimum.at(first, inverse, t)
+        slots = np.empty(len(unique), dtype=np.int64)
+        for i, trip_id in enumerate(unique.tolist()):
+            slot = self.slots.get(trip_id)
+            slots[i] = self._start(trip_id, float(first[i])) if slot is None else slot
+        return slots[inverse]
+
+    def feed(self, ids, t, lat, lon, ends=()):
+        '''
+        Procesa un bloque de posiciones (arrays) y de fines de viaje (id, timestamp).
+        Devuelve los viajes terminados (ver finish).
+        '''
+        ids = np.asarray(ids, dtype=np.int64)
+        t = np.asarray(t, dtype=np.float64)
+        if len(ids):
+            self._process(ids, t, np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        finished = [self.finish(trip_id, when) for trip_id, when in ends if trip_id in self.slots]
+        return finished + self.expire()
+
+    def _process(self, ids, t, lat, lon):
+        usable = np.isfinite(t)
+        ids, t, lat, lon = ids[usable], t[usable], lat[usable], lon[usable]
+        if not len(ids):
+            return
+        self.latest = max(self.latest, float(t.max()))
+        slot = self._slots_for(ids, t)
+        np.add.at(self.fixes, slot, 1)
+        np.maximum.at(self.seen_t, slot, t)
+
+        # Orden por viaje y tiempo; fuera las inválidas, repetidas y atrasadas
+        order = np.lexsort((t, slot))
+        slot, t, lat, lon = slot[order], t[order], lat[order], lon[order]
+        same = np.r_[False, slot[1:] == slot[:-1]]
+        keep = (np.isfinite(lat) & np.isfinite(lon) & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+                & ((lat != 0) | (lon != 0))          # 0,0: el receptor aún no tiene posición
+                & (t > self.last_t[slot])
+                & ~(same & (t == np.r_[-np.inf, t[:-1]])))
+        np.add.at(self.dropped, slot[~keep], 1)
+        slot, t, lat, lon = slot[keep], t[keep], lat[keep], lon[keep]
+        if not len(slot):
+            return
+
+        # Delante de las posiciones nuevas de cada viaje, sus últimas posiciones ya procesadas
+        k = self.keep
+        touched = np.unique(slot)
+        tail = np.arange(k) >= (k - self.tail_count[touched])[:, None]
+        slot = np.concatenate([np.broadcast_to(touched[:, None], tail.shape)[tail], slot])
+        t = np.concatenate([self.tail_t[touched][tail], t])
+        lat = np.concatenate([self.tail_lat[touched][tail], lat])
+        lon = np.concatenate([self.tail_lon[touched][tail], lon])
+        new = np.arange(len(slot)) >= tail.sum()
+        order = np.argsort(slot, kind='stable')
+        slot, t, lat, lon, new = slot[order], t[order], lat[order], lon[order], new[order]
+
+        # Picos: se llega y se sale de la posición a una velocidad imposible
+        same = slot[1:] == slot[:-1]
+        fast = same & (haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]) > self.max_speed * np.diff(t))
+        spike = new & np.r_[False, fast] & np.r_[fast, False]
+        if spike.any():
+            np.add.at(self.dropped, slot[spike], 1)
+            slot, t, lat, lon, new = slot[~spike], t[~spike], lat[~spike], lon[~spike], new[~spike]
+
+        position = np.arange(len(slot))
+        has_prev = np.r_[False, slot[1:] == slot[:-1]]
+        has_next = np.r_[has_prev[1:], False]
+        group_start = np.maximum.accumulate(np.where(has_prev, 0, position))
+        group_end = np.minimum.accumulate(np.where(has_next, len(slot), position)[::-1])[::-1]
+
+        # Tramos (de la posición anterior a cada posición nueva)
+        seg = np.flatnonzero(new & has_prev)
+        if len(seg):
+            step = np.r_[0.0, haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:])]
+            jump = has_prev & (step > self.max_speed * np.r_[1.0, np.diff(t)])
+            self._segments(slot[seg], seg, group_start[seg], t, lat, lon, step, jump)
+
+        # Guardar las últimas k posiciones de cada viaje
+        rank = group_end - position  # 0 = la más reciente
+        last = rank < k
+        rows, cols = slot[last], k - 1 - rank[last]
+        self.tail_t[rows, cols] = t[last]
+        self.tail_lat[rows, cols] = lat[last]
+        self.tail_lon[rows, cols] = lon[last]
+        self.tail_count[slot[~has_prev]] = np.minimum(k, group_end[~has_prev] - position[~has_prev] + 1)
+        self.last_t[slot[~has_next]] = t[~has_next]
+
+    def _segments(self, seg_slot, seg, window_start, t, lat, lon, step, jump):
+        '''
+        Aplica los tramos seg (índices de su posición final, agrupados por viaje):
+        cambios de estado y distancia en movimiento. step y jump son, por posición,
+        la distancia desde la anterior y si ese paso es un salto del GPS.
+        '''
+        # Distancia del tramo: la cuerda de los últimos SMOOTHING tramos repartida por
+        # tiempo, así el ruido de cada posición no se acumula
+        dt = t[seg] - t[seg - 1]
+        start = np.maximum(seg - SMOOTHING, window_start)
+        km = haversine_km(lat[start], lon[start], lat[seg], lon[seg]) / (t[seg] - t[start]) * dt
+        # Si la cuerda cruza un salto del GPS se usa el paso, y el salto no cuenta
+        jumps = np.cumsum(jump)
+        crossed = jumps[seg] > jumps[start]
+        km[crossed] = step[seg][crossed]
+        km[jump[seg]] = 0.0
+        start = np.maximum(seg - self.window, window_start)
+        speed = haversine_km(lat[start], lon[start], lat[seg], lon[seg]) / (t[seg] - t[start])
+        moving = speed >= self.moving_speed
+
+        # Cambios de estado: al principio del tramo que cambia
+        first = np.r_[True, seg_slot[1:] != seg_slot[:-1]]
+        previous = np.where(first, self.moving[seg_slot], np.r_[False, moving[:-1]])
+        for j in np.flatnonzero(moving != previous).tolist():
+            trip_id = self.ids[seg_slot[j]]
+            when = float(t[seg[j] - 1])
+            if moving[j]:
+                self.fleet.move(trip_id, when)
+            else:
+                self.fleet.stop(trip_id, when)
+        final = np.r_[seg_slot[1:] != seg_slot[:-1], True]
+        self.moving[seg_slot[final]] = moving[final]
+
+        self.now = self.latest
+        distance = np.bincount(seg_slot, weights=np.where(moving, km, 0.0), minlength=self.size)
+        for slot in np.flatnonzero(distance).tolist():
+            self.fleet.add_distance(self.ids[slot], float(distance[slot]))
+
+    def finish(self, trip_id, when=None, reason='fin'):
+        '''
+        Termina un viaje y devuelve un diccionario con los campos de TRIP_OUTPUT:
+        tiempos, distancia (km), las dos tarifas y cuántas posiciones se descartaron.
+        '''
+        slot = self.slots.pop(trip_id)
+        end = max(float(self.start_t[slot]), float(self.last_t[slot]), when if when is not None else -np.inf)
+        self.now = end
+        stopped, moving, distance, time_fare = self.fleet.finish(trip_id, end)
+        start = float(self.start_t[slot])
+        distance_fare = None
+        if distance > 0:
+            distance_fare = calculate_distance_fare(distance, self.tariffs[slot], start=local_seconds(start))
+        trip = {
+            'id': trip_id,
+            'inicio': datetime.fromtimestamp(start),
+            'fin': datetime.fromtimestamp(end),
+            'tiempo_parado': stopped,
+            'tiempo_movimiento': moving,
+            'distancia_total': distance,
+            'coste_tiempo': time_fare,
+            'coste_distancia': distance_fare,
+            'posiciones': int(self.fixes[slot]),
+            'descartadas': int(self.dropped[slot]),
+            'cierre': reason,
+        }
+        self.ids[slot] = None
+        self.tariffs[slot] = None
+        self.active[slot] = False
+        self.free.append(slot)
+        return trip
+
+    def expire(self):
+        '''Termina los viajes sin posiciones en trip_timeout segundos (el taxi dejó de emitir).'''
+        n = self.size
+        idle = np.flatnonzero(self.active[:n] & (self.seen_t[:n] < self.latest - self.trip_timeout))
+        return [self.finish(self.ids[slot], reason='inactivo') for slot in idle.tolist()]
+
+    def close(self):
+        '''Termina los viajes que siguen abiertos al acabar los datos.'''
+        return [self.finish(trip_id, reason='fin de datos') for trip_id in list(self.slots)]
+
+
+def trip_record(trip, tipo):
+    '''Registro de historial (por tiempo o por distancia) de un viaje terminado.'''
+    if tipo == 'tiempo':
+        info = time_trip_info(trip['tiempo_parado'], trip['tiempo_movimiento'], trip['coste_tiempo'])
+        info['fecha'] = trip['fin']
+        return info
+    return {
+        "fecha": trip['fin'],
+        "tipo": "distancia",
+        "distancia_total": round(trip['distancia_total'], 2),
+        "coste_total": round(trip['coste_distancia'], 2)
+    }
+
+
+def _row(trip):
+    return (trip['id'], trip['inicio'].isoformat(sep=' ', timespec='seconds'),
+            trip['fin'].isoformat(sep=' ', timespec='seconds'),
+            round(trip['tiempo_parado'], 2), round(trip['tiempo_movimiento'], 2),
+            round(trip['distancia_total'], 3), f"{trip['coste_tiempo']:.2f}",
+            '' if trip['coste_distancia'] is None else f"{trip['coste_distancia']:.2f}",
+            trip['posiciones'], trip['descartadas'], trip['cierre'])
+
+
+# =========================
+# Ejecución
+# =========================
+def run(stream, out=sys.stdout, err=sys.stderr, save=None, pipeline=None, chunk_bytes=CHUNK_BYTES,
+        name='-'):
+    '''
+    Procesa un flujo binario de posiciones y escribe en out (CSV, TRIP_OUTPUT)
+    cada viaje a medida que termina. Con save ('tiempo' o 'distancia') guarda
+    también cada viaje en el historial con ese tipo de tarifa.
+    Devuelve (viajes terminados, líneas con errores).
+    '''
+    pipeline = pipeline or GpsPipeline()
+    writer = csv.writer(out, lineterminator='\n')
+    writer.writerow(TRIP_OUTPUT)
+    trips = errors = 0
+
+    def emit(finished):
+        nonlocal trips
+        writer.writerows(_row(trip) for trip in finished)
+        if save:
+            for trip in finished:
+                if save == 'tiempo' or trip['coste_distancia'] is not None:
+                    save_history(trip_record(trip, save))
+        trips += len(finished)
+        if finished:
+            out.flush()
+
+    for block in read_blocks(stream, chunk_bytes):
+        ids, t, lat, lon, ends, bad = parse_block(block)
+        for line, message in bad:
+            print(f"{name}: {message}: {line!r}", file=err)
+        errors += len(bad)
+        emit(pipeline.feed(ids, t, lat, lon, ends))
+    emit(pipeline.close())
+    return trips, errors
+
+
+def replay(source, target, speed=0.0):
+    '''
+    Envía las posiciones de source (archivo o '-') al pipeline que escucha en target.
+    Con speed > 0 respeta los timestamps (1 = tiempo real, 10 = diez veces más rápido);
+    con 0 las envía tan rápido como puede. Devuelve las líneas enviadas.
+    '''
+    family, address = _address(target)
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.connect(address)
+    stream = sys.stdin.buffer if source == '-' else open(source, 'rb')
+    sent = 0
+    pending = []
+    first = None
+    started = time.monotonic()
+    try:
+        for line in stream:
+            if speed > 0:
+                try:
+                    t = float(line.split(b",", 2)[1])
+                except (IndexError, ValueError):
+                    t = None
+                if t is not None:
+                    first = t if first is None else first
+                    wait = started + (t - first) / speed - time.monotonic()
+                    if wait > 0:
+                        sock.sendall(b"".join(pending))
+                        pending = []
+                        time.sleep(wait)
+            pending.append(line)
+            sent += 1
+            if len(pending) >= 4096:
+                sock.sendall(b"".join(pending))
+                pending = []
+        sock.sendall(b"".join(pending))
+    finally:
+        sock.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    return sent
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='telemetry.py',
+        description="Calcula tiempos, distancias y tarifas de los viajes a partir de posiciones GPS.")
+    parser.add_argument('source', nargs='?', default='-',
+                        help="archivo, '-' (stdin), unix:RUTA o tcp:[HOST:]PUERTO para recibir un replay")
+    parser.add_argument('--replay', metavar='DESTINO',
+                        help="en lugar de procesar, envía source a un pipeline que escucha en DESTINO")
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help="con --replay: velocidad de reproducción (1 = tiempo real, 0 = sin esperas)")
+    parser.add_argument('--save', choices=('tiempo', 'distancia'),
+                        help="guarda cada viaje en el historial con esa tarifa")
+    parser.add_argument('--chunk-bytes', type=int, default=CHUNK_BYTES, help="tamaño de los bloques de lectura")
+    args = parser.parse_args(argv)
+
+    if args.replay:
+        sent = replay(args.source, args.replay, args.speed)
+        print(f"{sent} líneas enviadas a {args.replay}", file=sys.stderr)
+        return 0
+    if args.source.startswith(('unix:', 'tcp:')):
+        server = listen(args.source)
+        print(f"Esperando posiciones en {args.source}...", file=sys.stderr)
+        stream = accept_stream(server)
+    else:
+        stream = sys.stdin.buffer if args.source == '-' else open(args.source, 'rb')
+    try:
+        _, errors = run(stream, save=args.save, chunk_bytes=args.chunk_bytes, name=args.source)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    return 1 if errors else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
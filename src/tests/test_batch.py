@@ -0,0 +1,139 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import csv
+import json
+from batch import run
+from config import Tariff
+from fares import calculate_time_fare, calculate_distance_fare
+
+TARIFF = Tariff(base_fare=2.5, price_per_km=1.2, stopped_fare=0.02, moving_fare=0.05)
+
+
+def price(text, **kwargs):
+    """Ejecuta batch.run sobre un texto y devuelve (filas de salida, texto de errores, resultado)."""
+    out, err = io.StringIO(), io.StringIO()
+    source = kwargs.pop('source', 'viajes.csv')
+    stdin = sys.stdin
+    sys.stdin = io.StringIO(text)
+    try:
+        result = run(['-'], out=out, err=err, tariff=TARIFF,
+                     fmt='jsonl' if source.endswith('.jsonl') else 'csv', **kwargs)
+    finally:
+        sys.stdin = stdin
+    out.seek(0)
+    if kwargs.get('out_fmt') == 'jsonl':
+        rows = [json.loads(line) for line in out]
+    else:
+        rows = list(csv.DictReader(out))
+    return rows, err.getvalue(), result
+
+
+# =========================
+# Viajes terminados
+# =========================
+def test_trips_csv_matches_scalar_fares():
+    text = ("id,tipo,tiempo_parado,tiempo_movimiento,distancia_total\n"
+            "a1,tiempo,60,120,\n"
+            "a2,distancia,,,0.25\n"
+            "a3,tiempo,0.5,0.01,\n")
+    rows, err, (written, errors) = price(text, chunk_size=2)
+    assert (written, errors) == (3, 0)
+    assert err == ""
+    assert [r['id'] for r in rows] == ['a1', 'a2', 'a3']
+    assert rows[0]['coste_total'] == f"{calculate_time_fare(60, 120, TARIFF):.2f}"
+    assert rows[1]['coste_total'] == f"{calculate_distance_fare(0.25, TARIFF):.2f}"
+    assert rows[2]['coste_total'] == f"{calculate_time_fare(0.5, 0.01, TARIFF):.2f}"
+
+
+def test_trips_report_errors_per_record():
+    text = ("id,tipo,tiempo_parado,tiempo_movimiento,distancia_total\n"
+            "b1,tiempo,-1,5,\n"
+            "b2,bus,1,1,\n"
+            "b3,distancia,,,abc\n"
+            "b4,tiempo,1\n"
+            "b5,tiempo,10,10,\n")
+    rows, err, (written, errors) = price(text)
+    assert (written, errors) == (5, 4)
+    assert [r['coste_total'] for r in rows] == ['', '', '', '', f"{calculate_time_fare(10, 10, TARIFF):.2f}"]
+    assert "negativos" in rows[0]['error']
+    assert rows[1]['error'] == "tipo desconocido: 'bus'"
+    assert "no es numérico" in rows[2]['error']
+    assert "columnas" in rows[3]['error']
+    assert "registro 4:" in err and "registro 5:" not in err
+
+
+def test_non_finite_and_huge_values_are_record_errors():
+    text = ("id,tipo,tiempo_parado,tiempo_movimiento,distancia_total\n"
+            "y,tiempo,inf,5,\n"
+            "n,tiempo,nan,5,\n"
+            "z,distancia,,,inf\n"
+            "a,tiempo,1e300,1,\n"
+            "d,distancia,,,1e300\n"
+            "ok,tiempo,3,4,\n")
+    rows, err, (written, errors) = price(text)
+    assert (written, errors) == (6, 5)
+    assert [r['coste_total'] for r in rows[:5]] == [''] * 5
+    assert "finitos" in rows[0]['error'] and "finitos" in rows[1]['error'] and "finito" in rows[2]['error']
+    assert "demasiado grandes" in rows[3]['error'] and "demasiado grande" in rows[4]['error']
+    assert rows[5]['coste_total'] == f"{calculate_time_fare(3, 4, TARIFF):.2f}"
+
+
+def test_trips_jsonl_to_jsonl():
+    text = (json.dumps({'id': 1, 'tipo': 'tiempo', 'tiempo_parado': 3, 'tiempo_movimiento': 4}) + "\n"
+            + "no es json\n"
+            + json.dumps({'id': 2, 'tipo': 'distancia', 'distancia_total': 2}) + "\n")
+    rows, err, (written, errors) = price(text, source='viajes.jsonl', out_fmt='jsonl')
+    assert (written, errors) == (3, 1)
+    assert rows[0] == {'id': 1, 'tipo': 'tiempo', 'coste_total': f"{calculate_time_fare(3, 4, TARIFF):.2f}", 'error': ''}
+    assert rows[1]['error'].startswith("JSON no válido")
+    assert rows[2]['coste_total'] == f"{calculate_distance_fare(2, TARIFF):.2f}"
+
+
+def test_blank_lines_are_skipped():
+    text = ("id,tipo,tiempo_parado,tiempo_movimiento,distancia_total\n"
+            "\n"
+            "c1,tiempo,3,4,\n"
+            "\n")
+    rows, err, (written, errors) = price(text)
+    assert (written, errors) == (1, 0) and rows[0]['id'] == 'c1'
+    text = "\n" + json.dumps({'id': 'c2', 'tipo': 'distancia', 'distancia_total': 2}) + "\n\n"
+    rows, err, (written, errors) = price(text, source='viajes.jsonl', out_fmt='jsonl')
+    assert (written, errors) == (1, 0) and rows[0]['id'] == 'c2'
+
+
+# =========================
+# Flujo de eventos
+# =========================
+def test_events_price_finished_trips():
+    text = ("id,instante,evento,valor\n"
+            "t1,100,start,\n"
+            "t2,100,start,\n"
+            "t1,110,move,\n"
+            "t1,130,finish,\n"
+            "t3,130,stop,\n")
+    rows, err, (written, errors) = price(text, mode='events')
+    assert (written, errors) == (3, 2)
+    assert rows[0]['id'] == 't1'
+    assert float(rows[0]['tiempo_parado']) == 10 and float(rows[0]['tiempo_movimiento']) == 20
+    assert rows[0]['coste_total'] == f"{calculate_time_fare(10, 20, TARIFF):.2f}"
+    assert rows[1]['id'] == 't3' and "t3" in rows[1]['error']
+    assert rows[2] == {'id': 't2', 'tipo': '', 'tiempo_parado': '', 'tiempo_movimiento': '',
+                       'distancia_total': '', 'coste_total': '', 'error': 'viaje sin finalizar'}
+    assert "id t2: viaje sin finalizar" in err
+
+
+def test_events_with_distance_use_the_distance_fare():
+    text = ("id,instante,evento,valor\n"
+            "t1,100,start,\n"
+            "t1,110,move,\n"
+            "t1,120,distance,2.5\n"
+            "t1,125,distance,inf\n"
+            "t1,130,finish,\n")
+    rows, err, (written, errors) = price(text, mode='events')
+    assert (written, errors) == (2, 1)
+    assert "finito" in rows[0]['error']
+    rows = rows[1:]
+    assert rows[0]['tipo'] == 'distancia' and float(rows[0]['distancia_total']) == 2.5
+    assert rows[0]['coste_total'] == f"{calculate_distance_fare(2.5, TARIFF):.2f}"
@@ -0,0 +1,38 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+from bench import synthetic_trips, history_file, run_benchmarks, compare
+from storage import SQLiteBackend
+
+
+def test_synthetic_trips_are_reproducible():
+    first = list(synthetic_trips(50, seed=3))
+    assert first == list(synthetic_trips(50, seed=3))
+    assert first != list(synthetic_trips(50, seed=4))
+    assert {t['tipo'] for t in first} == {'tiempo', 'distancia'}
+    assert all(a['fecha'] < b['fecha'] for a, b in zip(first, first[1:]))
+
+
+def test_history_file_is_generated_once(tmp_path):
+    path = history_file(str(tmp_path), 'sqlite', 120)
+    mtime = os.path.getmtime(path)
+    assert history_file(str(tmp_path), 'sqlite', 120) == path
+    assert os.path.getmtime(path) == mtime
+    backend = SQLiteBackend(path)
+    assert backend.count() == 120
+    backend.close()
+
+
+def test_small_run_and_regression_check(tmp_path):
+    report = run_benchmarks(['history_write', 'history_read'], ['200'], ['text'],
+                            str(tmp_path), repeat=1, out=io.StringIO())
+    results = report['results']
+    assert results['history_write.text.200']['better'] == 'higher'
+    assert results['history_read.text.200.first_page.p99_ms']['unit'] == 'ms'
+
+    slower = {'results': {name: dict(r, value=r['value'] * (0.5 if r['better'] == 'higher' else 2))
+                          for name, r in results.items()}}
+    assert all(regression for *_, regression in compare(slower, report))
+    assert not any(regression for *_, regression in compare(report, slower))
+    assert not any(regression for *_, regression in compare(report, report))
@@ -0,0 +1,114 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from concurrent.futures import Future
+from config import Tariff
+from fares import calculate_time_fare
+from meter import TripMeter, STOPPED, MOVING, time_trip_info
+from checkpoint import TripCheckpoint, recover, checkpoint_path, SLOT_SIZE
+from storage import SQLiteBackend
+import history
+
+# Versión distinta de la del .env: el checkpoint debe reconstruir esta tarifa
+TARIFF = Tariff(base_fare=2.5, price_per_km=1.2, stopped_fare=0.02, moving_fare=0.05, version=1)
+T0 = 1_700_000_000.0
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def crashed_trip(path):
+    '''Un viaje parado 10 s y en movimiento 20 s cuyo proceso muere (último touch a los 25 s).'''
+    clock = Clock()
+    meter = TripMeter(clock=clock, wall_clock=lambda: T0 + clock.now, checkpoint=TripCheckpoint(path))
+    meter.start(trip_id=42, tariff=TARIFF)
+    clock.now += 10
+    meter.move()
+    meter.checkpoint.touch(T0 + clock.now + 15)
+    # Sin close(): el proceso "muere" aquí
+    return TripCheckpoint(path)
+
+
+def test_checkpoint_path():
+    assert checkpoint_path(os.path.join('data', 'viaje_en_curso.ckpt'), 'gui') == \
+        os.path.join('data', 'viaje_en_curso.gui.ckpt')
+    assert checkpoint_path('', 'cli') == ''
+
+
+def test_interrupted_trip_is_closed_up_to_last_checkpoint(tmp_path):
+    checkpoint = crashed_trip(str(tmp_path / 'viaje.ckpt'))
+    snapshot = checkpoint.load()
+    assert snapshot['trip'] == 42 and snapshot['state'] == MOVING and not snapshot['finished']
+    assert snapshot['elapsed'] == pytest.approx((10, 15))
+    assert snapshot['tariff'].as_dict() == TARIFF.as_dict()
+
+    meter = TripMeter(checkpoint=checkpoint)
+    stopped, moving, fare = recover(meter, snapshot)
+    assert (stopped, moving) == pytest.approx((10, 15))
+    assert fare == calculate_time_fare(10, 15, TARIFF)
+    # Terminado pero pendiente del historial hasta que se confirme el guardado
+    assert checkpoint.load()['finished']
+    future = Future()
+    checkpoint.release(future)
+    assert checkpoint.load() is not None
+    future.set_result(None)
+    assert checkpoint.load() is None
+    checkpoint.close()
+
+
+class BrokenBackend(SQLiteBackend):
+    """Backend cuyo disco no acepta escrituras."""
+
+    def append(self, trip_info):
+        raise OSError("disco lleno")
+
+
+def test_failed_save_keeps_the_recovered_trip(tmp_path):
+    checkpoint = crashed_trip(str(tmp_path / 'viaje.ckpt'))
+    result = recover(TripMeter(checkpoint=checkpoint), checkpoint.load())
+    # Sin escritor en segundo plano: el Future ya viene completado (con el error)
+    history.set_backend(BrokenBackend(str(tmp_path / 'historial.db')))
+    try:
+        checkpoint.release(history.save_history(time_trip_info(*result)))
+        assert checkpoint.load()['finished']
+        history.set_backend(SQLiteBackend(str(tmp_path / 'historial.db')))
+        checkpoint.release(history.save_history(time_trip_info(*result)))
+        assert checkpoint.load() is None
+    finally:
+        history.close_history()
+    checkpoint.close()
+
+
+def test_resumed_trip_does_not_charge_the_downtime(tmp_path):
+    checkpoint = crashed_trip(str(tmp_path / 'viaje.ckpt'))
+    clock = Clock()
+    meter = TripMeter(clock=clock, wall_clock=lambda: T0 + 3600 + clock.now, checkpoint=checkpoint)
+    assert recover(meter, checkpoint.load(), resume=True) is None
+    assert meter.active and meter.trip_id == 42 and meter.state == MOVING
+    clock.now += 5
+    meter.stop()
+    clock.now += 2
+    # El viaje nuevo no se borra con la confirmación de uno anterior
+    checkpoint.release()
+    assert checkpoint.load()['state'] == STOPPED
+    assert meter.finish() == (pytest.approx(12), pytest.approx(20), calculate_time_fare(12, 20, TARIFF))
+    checkpoint.close()
+
+
+def test_torn_write_falls_back_to_previous_copy(tmp_path):
+    path = str(tmp_path / 'viaje.ckpt')
+    checkpoint = crashed_trip(path)
+    seq = checkpoint.seq
+    checkpoint.close()
+    # Escritura cortada a medias en la copia más reciente
+    with open(path, 'r+b') as f:
+        f.seek((seq % 2) * SLOT_SIZE + 20)
+        f.write(b'\xff' * 8)
+    snapshot = TripCheckpoint(path).load()
+    # La copia anterior es el cambio a movimiento, antes del último touch
+    assert snapshot['state'] == MOVING and snapshot['elapsed'] == pytest.approx((10, 0))
@@ -0,0 +1,113 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import random
+import numpy as np
+from events import EventLog, Replayer, read_events, replay_file, START, MOVE, FINISH
+from fleet import FleetManager
+from meter import TripMeter
+from datetime import date
+from config import Tariff, parse_band
+
+
+def simulate(listener, trips=40, steps=3000, seed=3, tariffs=(None,), wall_start=0.0):
+    """Maneja una flota con eventos aleatorios y devuelve los viajes terminados en vivo."""
+    rng = random.Random(seed)
+    fleet = FleetManager(listener=listener, wall_clock=lambda: wall_start + now)
+    now = 0.0
+    finished = {}
+    next_id = 1
+    for _ in range(steps):
+        now += rng.random() * 10
+        if len(fleet) < trips and rng.random() < 0.2:
+            fleet.start(next_id, now, rng.choice(tariffs))
+            next_id += 1
+            continue
+        if not len(fleet):
+            continue
+        trip_id = rng.choice(list(fleet.slots))
+        action = rng.random()
+        if action < 0.4:
+            fleet.move(trip_id, now)
+        elif action < 0.7:
+            fleet.stop(trip_id, now)
+        elif action < 0.9:
+            fleet.clock = lambda: now
+            fleet.add_distance(trip_id, rng.random())
+        else:
+            stopped, moving, distance, fare = fleet.finish(trip_id, now)
+            finished[trip_id] = (stopped, moving, distance, fare)
+    return finished
+
+
+# =========================
+# Reproducción = camino en vivo
+# =========================
+@pytest.mark.parametrize('chunk_size', [7, 1000, 1 << 20])
+def test_replay_matches_live(tmp_path, chunk_size):
+    path = str(tmp_path / 'eventos.bin')
+    log = EventLog(path, buffer_size=64)
+    live = simulate(log)
+    log.close()
+
+    replayed = {}
+    for trips in replay_file(path, chunk_size):
+        for t in trips:
+            replayed[int(t['trip'])] = (float(t['stopped_time']), float(t['moving_time']),
+                                        float(t['distance']), float(t['fare']))
+    assert set(replayed) == set(live)
+    for trip_id, (stopped, moving, distance, fare) in live.items():
+        r_stopped, r_moving, r_distance, r_fare = replayed[trip_id]
+        assert (r_stopped, r_moving, r_fare) == (stopped, moving, fare)
+        assert r_distance == pytest.approx(distance)
+
+
+def test_replay_uses_trip_tariff(tmp_path):
+    tariffs = {v: Tariff(1.5, 0.25, 0.01 * v, 0.03 * v, version=v) for v in (1, 2, 3)}
+    path = str(tmp_path / 'eventos.bin')
+    log = EventLog(path)
+    live = simulate(log, steps=800, tariffs=list(tariffs.values()))
+    log.close()
+
+    replayed = {int(t['trip']): float(t['fare'])
+                for trips in replay_file(path, tariffs=tariffs) for t in trips}
+    assert replayed == {trip_id: fare for trip_id, (_, _, _, fare) in live.items()}
+
+
+def test_replay_with_time_bands(tmp_path):
+    flat = {'base_fare': 1.5, 'price_per_km': 0.25}
+    # Una franja cada media hora para que los viajes crucen muchas, y hoy festivo
+    bands = tuple(parse_band(f'h{h}', f'mon-sun,hol {h:02d}:00-{h:02d}:30 0.0{h % 7 + 1} 0.{h % 5 + 1}', flat)
+                  for h in range(24))
+    bands += (parse_band('festivo', 'hol 12:00-18:00 0.09 0.2', flat),)
+    tariff = Tariff(1.5, 0.25, 0.02, 0.05, version=7, bands=bands, holidays=(date.today(),))
+
+    path = str(tmp_path / 'eventos.bin')
+    log = EventLog(path, clock=lambda: 0.0)
+    _, _, _, wall_start = log.buffer[0]    # ancla: reloj 0 = hora real wall_start
+    live = simulate(log, steps=1500, tariffs=[tariff], wall_start=wall_start)
+    log.close()
+    replayer = Replayer({7: tariff})
+    replayed = {int(t['trip']): float(t['fare'])
+                for chunk in read_events(path) for t in replayer.feed(chunk)}
+    assert replayed == {trip_id: fare for trip_id, (_, _, _, fare) in live.items()}
+
+
+def test_replay_meter_and_invalid_events(tmp_path):
+    path = str(tmp_path / 'eventos.bin')
+    log = EventLog(path)
+    meter = TripMeter(listener=log)
+    meter.start(now=10.0, trip_id=5)
+    meter.move(now=12.5)
+    live = meter.finish(now=20.0)
+    log.record(MOVE, 99, 21.0)      # evento sin START
+    log.record(MOVE, 5, 22.0)       # evento después del FINISH
+    log.close()
+
+    replayer = Replayer()
+    trips = np.concatenate([replayer.feed(chunk) for chunk in read_events(path)])
+    assert len(trips) == 1
+    assert (trips['stopped_time'][0], trips['moving_time'][0], trips['fare'][0]) == live
+    assert replayer.skipped == 2
+    anchor_clock, anchor_wall = replayer.anchors[0]
+    assert replayer.wall_time(anchor_clock + 2) == anchor_wall + 2
@@ -0,0 +1,61 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import numpy as np
+from datetime import datetime, timedelta
+from storage import TextBackend, SQLiteBackend
+from export import export, load_columns, read_manifest, TIPOS
+
+
+def make_trips(n, first_day=datetime(2025, 2, 1, 9, 0, 0)):
+    trips = []
+    for i in range(n):
+        fecha = first_day + timedelta(minutes=7 * i)
+        if i % 2:
+            trips.append({'fecha': fecha, 'tipo': 'tiempo', 'tiempo_parado': i + 0.5,
+                          'tiempo_movimiento': 2.0 * i, 'duracion_total': 3.0 * i + 0.5,
+                          'coste_total': round(0.02 * i + 0.01, 2)})
+        else:
+            trips.append({'fecha': fecha, 'tipo': 'distancia', 'distancia_total': i / 10 + 0.1,
+                          'coste_total': round(1.5 + i / 40, 2)})
+    return trips
+
+
+@pytest.mark.parametrize("backend_class, name", [(TextBackend, 'historial.txt'), (SQLiteBackend, 'historial.db')])
+def test_export_is_incremental_and_memory_mapped(tmp_path, backend_class, name):
+    backend = backend_class(str(tmp_path / name))
+    trips = make_trips(250)
+    backend.append_many(trips[:200])
+    out = str(tmp_path / 'export')
+    assert export(backend, out, chunk_size=64, parquet=False, out=io.StringIO()) == 200
+
+    backend.append_many(trips[200:])
+    assert export(backend, out, chunk_size=64, parquet=False, out=io.StringIO()) == 50
+    assert export(backend, out, parquet=False, out=io.StringIO()) == 0
+    backend.close()
+
+    columns = load_columns(out)
+    assert isinstance(columns['coste_centimos'], np.memmap)
+    assert columns['id'].tolist() == list(range(1, 251))
+    assert columns['fecha'][3] == np.datetime64(trips[3]['fecha'])
+    assert [TIPOS[c] for c in columns['tipo'][:2]] == ['distancia', 'tiempo']
+    assert np.isnan(columns['distancia_total'][1]) and columns['tiempo_parado'][1] == 1.5
+    assert columns['coste_centimos'].sum() == sum(round(t['coste_total'] * 100) for t in trips)
+    # Los .npy son archivos NumPy normales
+    assert np.load(os.path.join(out, 'coste_total.npy')).shape == (250,)
+
+
+def test_export_discards_an_interrupted_run(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+    backend.append_many(make_trips(30))
+    out = str(tmp_path / 'export')
+    export(backend, out, parquet=False, out=io.StringIO())
+    # Restos de una ejecución cortada antes de actualizar el manifiesto
+    with open(os.path.join(out, 'id.npy'), 'ab') as f:
+        f.write(np.arange(5, dtype='<i8').tobytes())
+    backend.append_many(make_trips(10, datetime(2025, 3, 1)))
+    assert export(backend, out, parquet=False, out=io.StringIO()) == 10
+    assert load_columns(out)['id'].tolist() == list(range(1, 41))
+    assert read_manifest(out)['ultimo_id'] == 40
+    backend.close()
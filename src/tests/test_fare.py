@@ -1,8 +1,18 @@
 import pytest
 import sys, os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
-from taximeter import calculate_time_fare, calculate_distance_fare
-from config import fare_config
+import numpy as np
+from taximeter import (
+    calculate_time_fare, calculate_distance_fare,
+    calculate_time_fares, calculate_distance_fares,
+)
+from datetime import datetime, date
+from config import fare_config, Tariff, parse_band
+from fares import (
+    calculate_segment_nanos, calculate_time_fare_cents, calculate_time_fares_cents,
+    calculate_distance_fare_cents, calculate_distance_fares_cents,
+)
+from schedule import schedule_for, local_seconds
 
 # Carga la configuración para usar las tarifas reales
 config = fare_config()
@@ -54,7 +64,8 @@ def test_known_values():
     moving_time = 120   # 120 segundos en movimiento
     expected_fare = (stopped_time * config['stopped_fare']) + (moving_time * config['moving_fare'])
     fare = calculate_time_fare(stopped_time, moving_time)
-    assert fare == expected_fare, "La tarifa calculada no coincide con el valor esperado"
+    # La tarifa se redondea al céntimo
+    assert fare == round(expected_fare, 2), "La tarifa calculada no coincide con el valor esperado"
 
 
 # =========================
@@ -97,4 +108,132 @@ def test_invalid_type():
     with pytest.raises(TypeError):
         calculate_distance_fare("cinco")  # No se puede multiplicar string
     with pytest.raises(TypeError):
-        calculate_time_fare("10", "20")   # String en vez de número
\ No newline at end of file
+        calculate_time_fare("10", "20")   # String en vez de número
+
+# =========================
+# Tarifas por lotes
+# =========================
+def test_batch_matches_scalar():
+    stopped = [0, 10, 60, 3.7]
+    moving = [0, 20, 120, 9.1]
+    fares = calculate_time_fares(stopped, moving)
+    assert fares.tolist() == [calculate_time_fare(s, m) for s, m in zip(stopped, moving)]
+
+    distances = np.array([0.0001, 5, 7.5, 10_000])
+    fares_dist = calculate_distance_fares(distances)
+    assert fares_dist.tolist() == [calculate_distance_fare(d) for d in distances.tolist()]
+
+
+def test_batch_invalid_indices():
+    with pytest.raises(ValueError, match=r"\[1, 3\]"):
+        calculate_time_fares([1, -1, 2, 3], [1, 1, 1, -5])
+    with pytest.raises(ValueError, match=r"\[0, 2\]"):
+        calculate_distance_fares([0, 5, -3])
+
+
+@pytest.mark.parametrize("bad", [float('nan'), float('inf'), -float('inf')])
+def test_non_finite_values_are_rejected(bad):
+    with pytest.raises(ValueError, match="finitos"):
+        calculate_time_fare(bad, 1)
+    with pytest.raises(ValueError, match=r"finitos \(índices: \[1\]\)"):
+        calculate_time_fares([1, 2], [1, bad])
+    with pytest.raises(ValueError, match="finito"):
+        calculate_distance_fare(bad)
+    with pytest.raises(ValueError, match=r"finito \(índices: \[0\]\)"):
+        calculate_distance_fares([bad, 1])
+
+
+def test_values_that_overflow_are_rejected():
+    # Lo más grande que cabe sigue coincidiendo con el cálculo escalar
+    assert calculate_distance_fares([1e9]).tolist() == [calculate_distance_fare(1e9)]
+    for huge in (1e12, 1e300):
+        with pytest.raises(ValueError, match="demasiado grande"):
+            calculate_distance_fare(huge)
+        with pytest.raises(ValueError, match=r"demasiado grande \(índices: \[1\]\)"):
+            calculate_distance_fares([1, huge])
+        with pytest.raises(ValueError, match="demasiado grandes"):
+            calculate_time_fare(1, huge)
+        with pytest.raises(ValueError, match=r"demasiado grandes \(índices: \[0\]\)"):
+            calculate_time_fares([huge, 1], [1, 1])
+
+
+# =========================
+# Franjas horarias
+# =========================
+FLAT = {'base_fare': 1.5, 'price_per_km': 0.25}
+BANDED = Tariff(1.5, 0.25, 0.02, 0.05, bands=(
+    parse_band('noche', 'mon-sun 22:00-06:00 0.03 0.07 2.1 0.35', FLAT),
+    parse_band('finde', 'sat,sun,hol 00:00-24:00 0.025 0.06', FLAT),
+), holidays=(date(2026, 10, 12),))
+
+
+def test_segment_crosses_bands():
+    # Viernes 21:00 -> martes 07:00, con el lunes festivo
+    start = local_seconds(datetime(2026, 10, 9, 21))
+    end = local_seconds(datetime(2026, 10, 13, 7))
+    pieces = schedule_for(BANDED).split(start, end)
+    assert [name for _, _, name in pieces] == [
+        'general', 'noche', 'finde', 'noche', 'finde', 'noche', 'finde', 'noche', 'general']
+    # Lunes festivo: la noche del domingo termina a las 00:00 y el lunes entero es 'finde'
+    assert pieces[6][1] - pieces[6][0] == 24 * 3600
+
+    rates = {'general': (0.02, 0.05), 'noche': (0.03, 0.07), 'finde': (0.025, 0.06)}
+    for moving in (False, True):
+        # Nano-euros exactos: ms × µ€/s
+        expected = sum(round((b - a) * 1000) * round(rates[name][moving] * 1e6) for a, b, name in pieces)
+        assert calculate_segment_nanos(start, end, moving, BANDED) == expected
+
+    # Sin franjas coincide con la tarifa plana
+    flat = Tariff(1.5, 0.25, 0.02, 0.05)
+    assert calculate_segment_nanos(start, start + 100, True, flat) == 100 * 0.05 * 10**9
+
+
+def test_segment_fares_batch():
+    rng = np.random.default_rng(5)
+    starts = local_seconds(datetime(2026, 10, 1)) + rng.random(500) * 30 * 24 * 3600
+    ends = starts + rng.random(500) * 3 * 24 * 3600
+    moving = rng.random(500) < 0.5
+    nanos = calculate_segment_nanos(starts, ends, moving, BANDED)
+    assert nanos.dtype == np.int64
+    assert nanos.tolist() == [calculate_segment_nanos(a, b, m, BANDED) for a, b, m in zip(starts, ends, moving)]
+    with pytest.raises(ValueError, match=r"\[1\]"):
+        calculate_segment_nanos([0, 10], [5, 5], False, BANDED)
+
+
+def test_distance_fare_uses_start_band():
+    night = local_seconds(datetime(2026, 10, 14, 23))
+    day = local_seconds(datetime(2026, 10, 14, 12))
+    assert calculate_distance_fare(10, BANDED, start=night) == 5.6
+    assert calculate_distance_fare(10, BANDED, start=day) == calculate_distance_fare(10, BANDED)
+    fares = calculate_distance_fares([10, 10], BANDED, starts=[night, day])
+    assert fares.tolist() == [calculate_distance_fare(10, BANDED, start=night),
+                              calculate_distance_fare(10, BANDED, start=day)]
+
+
+# =========================
+# Céntimos exactos
+# =========================
+def test_cents_rounding():
+    tariff = Tariff(1.5, 0.25, 0.02, 0.05)
+    # 0.25 s en movimiento = 1.25 céntimos -> 1; 0.3 s = 1.5 céntimos -> 2 (mitad hacia arriba)
+    assert calculate_time_fare_cents(0, 0.25, tariff) == 1
+    assert calculate_time_fare_cents(0, 0.3, tariff) == 2
+    assert calculate_time_fare(0, 0.3, tariff) == 0.02
+    # 0.1 + 0.2 km no arrastra el error binario: 1.5 € + 300 m × 0.25 €/km = 1.575 -> 1.58
+    assert calculate_distance_fare_cents(0.1 + 0.2, tariff) == 158
+
+
+def test_cents_batch_matches_scalar_and_sums():
+    rng = np.random.default_rng(11)
+    stopped = rng.random(20_000) * 600
+    moving = rng.random(20_000) * 1800
+    cents = calculate_time_fares_cents(stopped, moving)
+    assert cents.dtype == np.int64
+    assert cents.tolist() == [calculate_time_fare_cents(s, m) for s, m in zip(stopped.tolist(), moving.tolist())]
+    # La recaudación es exactamente la suma de los recibos impresos
+    receipts = [f"{calculate_time_fare(s, m):.2f}" for s, m in zip(stopped.tolist(), moving.tolist())]
+    assert int(cents.sum()) == sum(int(r.replace('.', '')) for r in receipts)
+
+    distances = rng.random(1000) * 40 + 0.01
+    assert calculate_distance_fares_cents(distances).tolist() == \
+        [calculate_distance_fare_cents(d) for d in distances.tolist()]
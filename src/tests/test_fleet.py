@@ -0,0 +1,85 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import random
+from datetime import datetime
+from config import Tariff, parse_band
+from fleet import FleetManager
+from meter import TripMeter
+
+
+# =========================
+# Coincidencia con TripMeter
+# =========================
+def test_fleet_matches_meter():
+    rng = random.Random(7)
+    fleet = FleetManager(capacity=2)   # obliga a crecer
+    meters = {}
+    now = 1000.0
+    for trip_id in range(50):
+        fleet.start(trip_id, now)
+        meters[trip_id] = TripMeter()
+        meters[trip_id].start(now)
+    for _ in range(2000):
+        now += rng.random() * 30
+        trip_id = rng.randrange(50)
+        if rng.random() < 0.5:
+            fleet.stop(trip_id, now)
+            meters[trip_id].stop(now)
+        else:
+            fleet.move(trip_id, now)
+            meters[trip_id].move(now)
+
+    now += 5
+    ids, fares = fleet.live_fares(now)
+    assert dict(zip(ids.tolist(), fares.tolist())) == {i: m.current_fare(now) for i, m in meters.items()}
+
+    for trip_id in range(0, 50, 3):
+        stopped, moving, distance, fare = fleet.finish(trip_id, now)
+        assert (stopped, moving, fare) == meters.pop(trip_id).finish(now)
+    assert len(fleet) == len(meters)
+    assert len(fleet.live_fares(now)[0]) == len(meters)
+
+
+def test_live_fares_with_mixed_tariffs():
+    flat = {'base_fare': 1.5, 'price_per_km': 0.25}
+    night = Tariff(1.5, 0.25, 0.02, 0.05, bands=(parse_band('noche', 'mon-sun 22:00-06:00 0.03 0.07', flat),))
+    weekend = Tariff(1.5, 0.25, 0.02, 0.05, bands=(parse_band('finde', 'sat,sun 00:00-24:00 0.025 0.06', flat),))
+    # Igual a night pero otro objeto: comparte código de tarifa
+    tariffs = (night, weekend, Tariff(1.5, 0.25, 0.02, 0.05), Tariff(1.5, 0.25, 0.02, 0.05, bands=night.bands))
+    wall = lambda: datetime(2026, 10, 9, 21, 30).timestamp()
+    rng = random.Random(3)
+    fleet = FleetManager(capacity=4, wall_clock=wall)
+    meters = {}
+    for trip_id in range(30):
+        fleet.start(trip_id, 0.0, tariffs[trip_id % 4])
+        meters[trip_id] = TripMeter(wall_clock=wall)
+        meters[trip_id].start(0.0, tariff=tariffs[trip_id % 4])
+    now = 0.0
+    for _ in range(300):
+        now += rng.random() * 600
+        trip_id = rng.randrange(30)
+        if rng.random() < 0.5:
+            fleet.stop(trip_id, now)
+            meters[trip_id].stop(now)
+        else:
+            fleet.move(trip_id, now)
+            meters[trip_id].move(now)
+    assert len(fleet.coded) == 3
+    ids, fares = fleet.live_fares(now)
+    assert dict(zip(ids.tolist(), fares.tolist())) == {i: m.current_fare(now) for i, m in meters.items()}
+
+
+def test_fleet_events_and_slot_reuse():
+    fleet = FleetManager(capacity=1)
+    fleet.start('a', 0.0)
+    fleet.add_distance('a', 2.5)
+    with pytest.raises(RuntimeError):
+        fleet.start('a', 1.0)
+    with pytest.raises(KeyError):
+        fleet.stop('b', 1.0)
+    fleet.finish('a', 10.0)
+    fleet.start('b', 10.0)
+    assert fleet.size == 1
+    ids, fares = fleet.live_distance_fares()
+    assert len(ids) == 0
@@ -0,0 +1,435 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import json
+import threading
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
+from storage import TextBackend, SQLiteBackend
+from trip_format import format_block, parse_blocks
+from writer import HistoryWriter
+from migrate import migrate
+
+
+def sample_trips():
+    return [
+        {'fecha': datetime(2025, 1, 1, 10, 0, 0), 'tipo': 'distancia',
+         'distancia_total': 5.0, 'coste_total': 2.75},
+        {'fecha': datetime(2025, 1, 2, 12, 30, 0), 'tipo': 'tiempo',
+         'tiempo_parado': 10.0, 'tiempo_movimiento': 20.0,
+         'duracion_total': 30.0, 'coste_total': 1.2},
+        {'fecha': datetime(2025, 1, 3, 8, 15, 0), 'tipo': 'distancia',
+         'distancia_total': 12.5, 'coste_total': 4.63},
+    ]
+
+
+@pytest.fixture(params=['text', 'sqlite'])
+def backend(request, tmp_path):
+    if request.param == 'text':
+        b = TextBackend(str(tmp_path / 'historial.txt'))
+    else:
+        b = SQLiteBackend(str(tmp_path / 'historial.db'))
+    yield b
+    b.close()
+
+
+# =========================
+# Guardar y consultar
+# =========================
+def test_query_by_date_and_type(backend):
+    backend.append_many(sample_trips())
+    trips = backend.query(start=datetime(2025, 1, 2), end=datetime(2025, 1, 4))
+    assert [t['coste_total'] for t in trips] == [1.2, 4.63]
+
+    trips = backend.query(tipo='distancia', order_by='coste_total', descending=True)
+    assert [t['distancia_total'] for t in trips] == [12.5, 5.0]
+    assert backend.count(tipo='tiempo') == 1
+
+
+def test_dates_out_of_order(backend):
+    # Trayectos que no llegan en orden de fecha (telemetría, migraciones, varios procesos)
+    trips = [{'fecha': datetime(2025, 1, day, 9, 0), 'tipo': 'distancia', 'distancia_total': 1.0,
+              'coste_total': float(day)} for day in (5, 1, 9, 3)]
+    backend.append_many(trips[:2])
+    backend.append_many(trips[2:])
+    first_days = dict(start=datetime(2025, 1, 1), end=datetime(2025, 1, 4))
+    assert sorted(t['coste_total'] for t in backend.query(**first_days)) == [1.0, 3.0]
+    assert backend.count(**first_days) == 2
+    assert backend.revenue(**first_days) == 4.0
+    assert [t['coste_total'] for t in backend.query()] == [1.0, 3.0, 5.0, 9.0]
+    assert [t['coste_total'] for t in backend.query(descending=True, offset=1, limit=2)] == [5.0, 3.0]
+    assert [t['id'] for t in backend.query(order_by='id')] == [1, 2, 3, 4]
+
+
+def test_revenue(backend):
+    backend.append_many(sample_trips())
+    assert backend.revenue() == pytest.approx(8.58)
+    assert backend.revenue(start=datetime(2025, 1, 2)) == pytest.approx(5.83)
+
+
+def test_revenue_is_exact_in_cents(backend):
+    trips = [{'fecha': datetime(2025, 1, 1, 0, 0, i), 'tipo': 'distancia',
+              'distancia_total': 1.0, 'coste_total': 0.1} for i in range(30)]
+    backend.append_many(trips)
+    # Con floats 30 × 0.1 daría 3.0000000000000013
+    assert backend.revenue() == 3.0
+    assert backend.revenue(tipo='distancia') == 3.0
+
+
+# =========================
+# Vista de texto
+# =========================
+def test_text_view_round_trip(backend):
+    backend.append_many(sample_trips())
+    parsed = list(parse_blocks(backend.read_text().splitlines()))
+    assert parsed == sample_trips()
+    assert backend.read_text() == "".join(format_block(t) for t in sample_trips())
+
+
+# =========================
+# Escritor en segundo plano
+# =========================
+def test_writer_batches_and_acknowledges(backend):
+    writer = HistoryWriter(backend, batch_size=2, flush_interval=10, durability='fsync')
+    futures = [writer.submit(t) for t in sample_trips()]
+    # Los dos primeros forman un lote completo sin esperar al intervalo
+    futures[1].result(timeout=5)
+    assert backend.count() >= 2
+    writer.flush(timeout=5)
+    assert all(f.done() for f in futures)
+    assert backend.count() == 3
+
+
+def test_writer_drains_on_close(backend):
+    writer = HistoryWriter(backend, batch_size=100, flush_interval=10, durability='none')
+    for trip in sample_trips():
+        writer.submit(trip)
+    writer.close()
+    assert backend.count() == 3
+    with pytest.raises(RuntimeError):
+        writer.submit(sample_trips()[0])
+
+
+def test_writer_submit_racing_close_never_hangs(backend):
+    writer = HistoryWriter(backend, batch_size=7, flush_interval=0.01, durability='none')
+    futures = []
+
+    def submit_many():
+        for trip in sample_trips() * 50:
+            try:
+                futures.append(writer.submit(trip))
+            except RuntimeError:
+                return
+
+    threads = [threading.Thread(target=submit_many) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    writer.close()
+    for thread in threads:
+        thread.join()
+    # Todo lo aceptado antes de cerrar queda escrito
+    for future in futures:
+        future.result(timeout=5)
+    assert backend.count() == len(futures)
+
+
+# =========================
+# Totales por día y tipo
+# =========================
+def test_summary_is_kept_up_to_date(backend):
+    backend.append_many(sample_trips())
+    backend.append(sample_trips()[1])
+    assert backend.summary() == {'viajes': 4, 'coste_total': 9.78, 'tiempo_parado': 20.0,
+                                 'tiempo_movimiento': 40.0, 'distancia_total': 17.5}
+    day = backend.summary(start=datetime(2025, 1, 2), end=datetime(2025, 1, 3))
+    assert (day['viajes'], day['coste_total']) == (2, 2.4)
+    assert backend.summary(tipo='distancia')['distancia_total'] == 17.5
+    assert [row[:4] for row in backend.daily_summary()] == [
+        ('2025-01-01', 'distancia', 1, 275), ('2025-01-02', 'tiempo', 2, 240), ('2025-01-03', 'distancia', 1, 463)]
+    assert backend.rebuild_summary(check_only=True) == []
+
+
+@pytest.mark.parametrize("name", ['historial.txt', 'historial.db'])
+def test_summary_persists_and_rebuilds(tmp_path, name):
+    backend_class = TextBackend if name.endswith('.txt') else SQLiteBackend
+    path = str(tmp_path / name)
+    backend = backend_class(path)
+    backend.append_many(sample_trips())
+    backend.close()
+
+    # Reabierto, los totales se leen de disco; un trayecto más se suma al instante
+    backend = backend_class(path)
+    backend.append(sample_trips()[0])
+    assert backend.summary()['viajes'] == 4
+    # Totales corrompidos: la reconstrucción los detecta y los corrige
+    if backend_class is TextBackend:
+        backend.totals.totals[('2025-01-01', 'distancia')][1] += 1
+    else:
+        backend.conn.execute("UPDATE resumen SET centimos = centimos + 1 WHERE dia = '2025-01-01'")
+    differences = backend.rebuild_summary()
+    assert [(day, tipo) for day, tipo, _, _ in differences] == [('2025-01-01', 'distancia')]
+    assert backend.rebuild_summary() == []
+    assert backend.summary()['coste_total'] == 11.33
+    backend.close()
+
+
+def test_text_summary_catches_up_after_crash(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    backend = TextBackend(path)
+    backend.append_many(sample_trips()[:1])
+    backend.close()
+    # Trayectos escritos sin actualizar historial.txt.sum (caída antes de guardarlo)
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write("".join(format_block(t) for t in sample_trips()[1:]))
+    backend = TextBackend(path)
+    assert backend.summary()['viajes'] == 3
+    assert backend.rebuild_summary(check_only=True) == []
+    backend.close()
+
+
+def test_text_summary_is_saved_with_each_batch(tmp_path, monkeypatch):
+    path = str(tmp_path / 'historial.txt')
+    first, second = TextBackend(path), TextBackend(path)
+    # Sin otros escritores el lote se suma sin releer el historial
+    monkeypatch.setattr(first, '_current_totals', lambda: pytest.fail("no debería releer el historial"))
+    first.append(sample_trips()[0])
+    monkeypatch.undo()
+    with open(path + '.sum', encoding='utf-8') as f:
+        assert json.load(f)['trayectos'] == 1
+    # Otro "proceso" escribe entre medias: se ponen al día sus trayectos y los propios
+    second.append(sample_trips()[1])
+    first.append(sample_trips()[2])
+    with open(path + '.sum', encoding='utf-8') as f:
+        assert json.load(f)['trayectos'] == 3
+    assert first.summary()['viajes'] == 3 and first.rebuild_summary(check_only=True) == []
+    first.close()
+    second.close()
+
+
+# =========================
+# Índice lateral del historial de texto
+# =========================
+def test_index_random_access_and_catch_up(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    # Historial antiguo escrito sin índice
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("".join(format_block(t) for t in sample_trips()[:2]))
+    backend = TextBackend(path)
+    backend.append(sample_trips()[2])
+    with backend.reader() as reader:
+        assert len(reader) == 3
+        assert reader.record(1)['coste_total'] == 1.2
+        assert [t['coste_total'] for t in reader.tail(2)] == [1.2, 4.63]
+        assert reader.positions(datetime(2025, 1, 2), datetime(2025, 1, 3)) == range(1, 2)
+        offsets = reader.index['offset'].tolist()
+    backend.close()
+
+    # El índice regenerado coincide con el mantenido en cada escritura
+    backend.index.rebuild()
+    with backend.reader() as reader:
+        assert reader.index['offset'].tolist() == offsets
+        assert reader.record(2)['distancia_total'] == 12.5
+
+
+# =========================
+# Varios procesos escribiendo a la vez
+# =========================
+# Historial de texto segmentado
+# =========================
+def many_trips(n=90, start=datetime(2025, 1, 1, 8, 0)):
+    """n trayectos cada 40 minutos (varios por día), alternando distancia y tiempo."""
+    trips = []
+    for i in range(n):
+        trip = {'fecha': start + timedelta(minutes=40 * i), 'coste_total': round(2.5 + i * 0.37, 2)}
+        if i % 2:
+            trip.update(tipo='tiempo', tiempo_parado=10.0, tiempo_movimiento=float(i), duracion_total=10.0 + i)
+        else:
+            trip.update(tipo='distancia', distancia_total=1.0 + i)
+        trips.append(trip)
+    return trips
+
+
+def test_segments_roll_compress_and_read_as_one(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    trips = many_trips()
+    backend = TextBackend(path, segment_bytes=2048)
+    for first in range(0, len(trips), 3):
+        backend.append_many(trips[first:first + 3])
+    backend.close()
+
+    backend = TextBackend(path, segment_bytes=2048)
+    sealed = backend.segments.load()
+    assert len(sealed) > 3 and all(segment['comprimido'] for segment in sealed)
+    assert not [name for name in os.listdir(backend.segments.directory) if name.endswith('.txt')]
+    assert sum(segment['trayectos'] for segment in sealed) < len(trips)
+
+    assert backend.count() == len(trips)
+    assert [t['id'] for t in backend.iter_trips()] == list(range(1, len(trips) + 1))
+    assert [t['coste_total'] for t in backend.iter_trips()] == [t['coste_total'] for t in trips]
+    costs = [t['coste_total'] for t in trips]
+    # Páginas que cruzan segmentos, en los dos sentidos
+    for offset, limit in ((0, 5), (7, 20), (40, 100), (89, 5)):
+        assert [t['coste_total'] for t in backend.query(offset=offset, limit=limit)] == costs[offset:offset + limit]
+        page = backend.query(descending=True, offset=offset, limit=limit)
+        assert [t['coste_total'] for t in page] == costs[::-1][offset:offset + limit]
+        assert [t['id'] for t in page] == list(range(len(trips) - offset, 0, -1))[:limit]
+    assert backend.revenue() == pytest.approx(sum(costs))
+    assert backend.count(tipo='tiempo') == 45
+    assert backend.summary()['viajes'] == len(trips)
+    assert backend.rebuild_summary(check_only=True) == []
+    assert len(list(parse_blocks(backend.read_text().splitlines()))) == len(trips)
+    backend.close()
+
+
+def test_segments_outside_the_date_range_are_not_read(tmp_path, monkeypatch):
+    path = str(tmp_path / 'historial.txt')
+    trips = many_trips()
+    backend = TextBackend(path, segment_bytes=2048)
+    backend.append_many(trips[:30])
+    backend.append_many(trips[30:60])
+    backend.append_many(trips[60:])
+    read = []
+    data = backend.segments.data
+    monkeypatch.setattr(backend.segments, 'data', lambda segment: read.append(segment['id']) or data(segment))
+
+    start, end = trips[35]['fecha'], trips[50]['fecha']
+    assert [t['id'] for t in backend.query(start=start, end=end)] == list(range(36, 51))
+    assert backend.count(start=start, end=end) == 15
+    assert read == [2]
+    # Los recuentos e importes sin filtro de tipo solo usan los índices
+    read.clear()
+    assert backend.revenue(start=trips[65]['fecha']) == pytest.approx(sum(t['coste_total'] for t in trips[65:]))
+    assert backend.count() == 90 and read == []
+    backend.close()
+
+
+def test_segments_out_of_order_dates(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    trips = many_trips(n=60)
+    # Cada lote llega en orden, pero los lotes no: los segmentos se solapan
+    batches = [trips[30:45], trips[:15], trips[45:], trips[15:30]]
+    backend = TextBackend(path, segment_bytes=2048)
+    for batch in batches:
+        backend.append_many(batch)
+    assert len(backend.segments.load()) > 1
+    costs = [t['coste_total'] for t in trips]
+    assert [t['coste_total'] for t in backend.query()] == costs
+    assert [t['coste_total'] for t in backend.query(descending=True, limit=10)] == costs[::-1][:10]
+    start, end = trips[10]['fecha'], trips[40]['fecha']
+    assert [t['coste_total'] for t in backend.query(start=start, end=end)] == costs[10:40]
+    assert backend.count(start=start, end=end) == 30
+    assert backend.revenue(start=start, end=end) == pytest.approx(sum(costs[10:40]))
+    assert [t['coste_total'] for t in backend.query(order_by='id', limit=3)] == costs[30:33]
+    backend.close()
+
+
+@pytest.mark.parametrize("batch", [1, 25])
+def test_segments_roll_by_day(tmp_path, batch):
+    path = str(tmp_path / 'historial.txt')
+    trips = many_trips(n=80)
+    backend = TextBackend(path, daily=True)
+    # Los lotes de 25 cruzan el cambio de día: cada trayecto va al segmento de su día
+    for first in range(0, len(trips), batch):
+        backend.append_many(trips[first:first + batch])
+    backend.close()
+    backend = TextBackend(path, daily=True)
+    days = [(datetime.fromtimestamp(segment['desde']).date(), datetime.fromtimestamp(segment['hasta']).date())
+            for segment in backend.segments.load()]
+    assert days == [(day.date(), day.date()) for day in (datetime(2025, 1, 1), datetime(2025, 1, 2))]
+    assert backend.count() == 80 and backend.query(offset=79)[0]['fecha'] == trips[-1]['fecha']
+    backend.close()
+
+
+def test_segment_sealed_without_manifest_is_recovered(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    trips = many_trips(n=10)
+    backend = TextBackend(path)
+    backend.append_many(trips[:6])
+    backend.close()
+    # Caída al sellar: el segmento ya se movió pero no llegó al manifiesto
+    os.makedirs(path + '.segmentos')
+    os.replace(path, os.path.join(path + '.segmentos', '000001.txt'))
+    os.remove(path + '.idx')
+    backend = TextBackend(path)
+    backend.append_many(trips[6:])
+    assert backend.segments.load()[0]['trayectos'] == 6
+    assert [t['id'] for t in backend.query(start=trips[5]['fecha'])] == [6, 7, 8, 9, 10]
+    assert backend.summary()['viajes'] == 10
+    backend.close()
+
+
+# =========================
+def write_trips(path, writer, batches):
+    '''Un proceso que añade batches lotes de 3 trayectos al historial compartido.'''
+    backend = TextBackend(path)
+    for batch in range(batches):
+        backend.append_many([{'fecha': datetime(2025, 1, 1) + timedelta(minutes=batch), 'tipo': 'distancia',
+                              'distancia_total': float(writer), 'coste_total': 1.0 + i} for i in range(3)])
+    backend.close()
+
+
+def test_concurrent_writers_do_not_interleave(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    with ProcessPoolExecutor(4) as pool:
+        for done in [pool.submit(write_trips, path, writer, 200) for writer in range(4)]:
+            done.result()
+    errors = []
+    assert len(list(parse_blocks(open(path, encoding='utf-8'), lambda line, reason: errors.append(reason)))) == 2400
+    assert errors == []
+    backend = TextBackend(path)
+    assert backend.count() == 2400
+    assert backend.summary()['coste_total'] == 4800.0
+    # Cada lote de un proceso quedó entero y seguido
+    with backend.reader() as reader:
+        writers = [t['distancia_total'] for t in reader.records_range(0, len(reader))]
+    assert all(writers[i] == writers[i + 1] == writers[i + 2] for i in range(0, 2400, 3))
+    backend.close()
+
+
+def test_torn_block_is_skipped_and_snapshot_is_stable(tmp_path):
+    path = str(tmp_path / 'historial.txt')
+    trips = sample_trips()
+    backend = TextBackend(path)
+    backend.append(trips[0])
+    reader = backend.reader()
+    # Un proceso muere a mitad de bloque y otro sigue escribiendo detrás
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(format_block(trips[1])[:70])
+    other = TextBackend(path)
+    other.append_many(trips[2:])
+    # El lector abierto antes sigue viendo su instantánea
+    assert len(reader) == 1
+    reader.close()
+    assert [t['coste_total'] for t in backend.query()] == [2.75, 4.63]
+    errors = []
+    assert len(list(parse_blocks(backend.read_text().splitlines(), lambda line, reason: errors.append(reason)))) == 2
+    assert errors == ["bloque cortado"]
+    # Un bloque entero pero alterado tampoco se acepta
+    text = format_block(trips[0]).replace("5.0 km", "6.0 km")
+    assert list(parse_blocks(text.splitlines())) == []
+    other.close()
+    backend.close()
+
+
+# =========================
+# Parser en streaming y migración
+# =========================
+def test_parser_reports_malformed_blocks(tmp_path):
+    good = sample_trips()
+    text = (format_block(good[0])
+            + "\n==============================\nFecha: 2025-01-02 10:00:00\nTipo de trayecto: tiempo\n"
+            + "Coste total: abc €\n==============================\n"
+            + format_block(good[1])[:40]   # bloque cortado
+            + format_block(good[2]))
+    errors = []
+    trips = list(parse_blocks(text.splitlines(), lambda line, reason: errors.append(line)))
+    assert trips == [good[0], good[2]]
+    assert len(errors) == 2
+
+    path = tmp_path / 'legacy.txt'
+    path.write_text(text, encoding='utf-8')
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+    migrated, failed = migrate([str(path)], backend, batch_size=1, out=open(os.devnull, 'w'))
+    assert (migrated, failed) == (2, 2)
+    assert backend.revenue() == pytest.approx(2.75 + 4.63)
+    backend.close()
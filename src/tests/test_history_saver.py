@@ -0,0 +1,59 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from datetime import datetime, timedelta
+from PyQt5.QtCore import QCoreApplication
+from storage import SQLiteBackend
+from writer import HistoryWriter
+import history
+from history_view import HistorySaver
+
+
+def make_trip(i):
+    return {'fecha': datetime(2025, 4, 1, 9, 0, 0) + timedelta(minutes=i), 'tipo': 'distancia',
+            'distancia_total': float(i + 1), 'coste_total': 1.5 + i}
+
+
+class FlakyBackend(SQLiteBackend):
+    """Backend que falla las primeras escrituras (p. ej. una tarjeta SD ocupada)."""
+
+    def __init__(self, path, failures):
+        super().__init__(path)
+        self.failures = failures
+
+    def append_many(self, trips):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disco no disponible")
+        super().append_many(trips)
+
+
+@pytest.fixture
+def app():
+    return QCoreApplication.instance() or QCoreApplication([])
+
+
+@pytest.mark.parametrize("use_writer", [False, True])
+def test_saver_keeps_order_and_loses_nothing_on_close(app, tmp_path, use_writer):
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+    history.set_backend(backend, HistoryWriter(backend, flush_interval=0.01) if use_writer else None)
+    saver = HistorySaver()
+    trips = [make_trip(i) for i in range(20)]
+    for trip in trips:
+        saver.save(trip)
+    # Cerrar justo después de enviar: close() espera a los guardados en curso
+    assert saver.close() == []
+    assert [t['coste_total'] for t in history.query_history()] == [t['coste_total'] for t in trips]
+    history.close_history()
+
+
+def test_failed_saves_are_retried_on_close(app, tmp_path):
+    history.set_backend(FlakyBackend(str(tmp_path / 'historial.db'), failures=1))
+    saver = HistorySaver()
+    saver.save(make_trip(0))
+    saver.pool.waitForDone()
+    assert len(saver.unsaved) == 1
+    assert history.count_history() == 0
+    assert saver.close() == []
+    assert history.count_history() == 1
+    history.close_history()
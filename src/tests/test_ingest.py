@@ -0,0 +1,101 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import asyncio
+from config import Tariff
+from fares import calculate_distance_fare
+from storage import SQLiteBackend
+from ingest import IngestServer, load_test
+
+TARIFF = Tariff(base_fare=2.5, price_per_km=1.2, stopped_fare=0.02, moving_fare=0.05)
+
+
+class FlakyBackend(SQLiteBackend):
+    """Backend que falla las primeras escrituras."""
+
+    def __init__(self, path, failures):
+        super().__init__(path)
+        self.failures = failures
+
+    def append_many(self, trips):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("disco no disponible")
+        super().append_many(trips)
+
+
+async def serve_and(backend, work, **options):
+    server = IngestServer(backend, TARIFF, **options)
+    await server.start(port=0)
+    try:
+        return await work(server.server.sockets[0].getsockname()[1]), server
+    finally:
+        await server.close()
+
+
+def test_load_test_is_fully_stored(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+    stats, server = asyncio.run(serve_and(
+        backend, lambda port: load_test(port, meters=5, trips=20, events=6, chunk=7), max_pending=2))
+    assert stats['errores'] == 0
+    assert stats['confirmadas'] == stats['enviadas'] == 5 * (1 + 18 * 6 + 2)
+    assert backend.count() == server.stats['viajes'] == 100
+    # Los viajes por eventos recorren 1.25 km: se cobran por distancia
+    event_fare = calculate_distance_fare(1.25, TARIFF)
+    distance_fares = sum(calculate_distance_fare(1.5 + trip % 7, TARIFF) for trip in (9, 19)) * 5
+    assert backend.revenue() == pytest.approx(90 * event_fare + distance_fares)
+    backend.close()
+
+
+def test_replies_report_rejected_lines(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+
+    async def send(port):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(b"M,taxi7\nE,1,100,start\nE,1,130,finish\nhola\nT,2,avion,1,2,3,\n"
+                     b"T,3,distancia,,,4.5,\nE,9,100,stop")
+        writer.write_eof()
+        replies = (await reader.read()).decode('utf-8').splitlines()
+        writer.close()
+        return replies
+
+    replies, _ = asyncio.run(serve_and(backend, send))
+    assert replies[0] == "ERR 4 línea no válida: 'hola'"
+    assert replies[1] == "ERR 5 tipo desconocido: 'avion'"
+    assert replies[2] == "OK 6"
+    # La última línea (sin salto de línea) va en su propio bloque
+    assert replies[3] == "ERR 7 No hay un viaje en curso con id taxi7/9"
+    assert replies[4] == "OK 1"
+    assert sorted(trip['tipo'] for trip in backend.query()) == ['distancia', 'tiempo']
+    backend.close()
+
+
+def test_storage_errors_are_retried_not_dropped(tmp_path):
+    backend = FlakyBackend(str(tmp_path / 'historial.db'), failures=2)
+    stats, _ = asyncio.run(serve_and(backend, lambda port: load_test(port, meters=2, trips=10, events=4)))
+    assert stats['confirmadas'] == stats['enviadas']
+    assert backend.count() == 20
+    backend.close()
+
+
+def test_close_while_a_client_is_still_sending(tmp_path):
+    backend = SQLiteBackend(str(tmp_path / 'historial.db'))
+
+    async def scenario():
+        server = IngestServer(backend, TARIFF)
+        await server.start(port=0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', server.server.sockets[0].getsockname()[1])
+        writer.write(b"T,1,distancia,,,2,\n")
+        assert await reader.readline() == b"OK 1\n"
+        # Otro bloque, y la conexión sigue abierta mientras se cierra el servidor
+        writer.write(b"T,2,distancia,,,3,\nT,3,distancia,,,4,\n")
+        await writer.drain()
+        await asyncio.sleep(0.1)
+        await asyncio.wait_for(server.close(), 5)
+        replies = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        return replies
+
+    assert asyncio.run(scenario()) == b"OK 2\n"
+    assert backend.count() == 3
+    backend.close()
@@ -0,0 +1,42 @@
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import gzip
+import logging
+import log_setup
+from log_setup import setup_logging, stop_logging
+
+
+# =========================
+# Rotación y compresión
+# =========================
+def test_rotation_compresses_and_prunes(tmp_path):
+    path = tmp_path / 'logs' / 'taximeter.log'
+    setup_logging(str(path), max_bytes=1024, backup_count=2)
+    try:
+        for i in range(300):
+            logging.info("Cambio de estado a %s (%d)", 'moving', i)
+        logging.debug("no se escribe %s", 'nunca')
+    finally:
+        stop_logging()
+
+    segments = sorted(p.name for p in path.parent.glob('taximeter.log.*'))
+    assert len(segments) == 2 and all(name.endswith('.gz') for name in segments)
+    text = gzip.open(path.parent / segments[-1]).read().decode('utf-8')
+    text += path.read_text(encoding='utf-8')
+    assert "Cambio de estado a moving (299)" in text
+    assert "no se escribe" not in text
+
+
+def test_reconfiguring_closes_the_previous_handlers(tmp_path):
+    setup_logging(str(tmp_path / 'a.log'))
+    try:
+        first = log_setup._listener.handlers[0]
+        logging.info("primero")
+        setup_logging(str(tmp_path / 'b.log'))
+        logging.info("segundo")
+        assert first.stream is None and first.compressor._shutdown
+        assert len(logging.getLogger().handlers) == 1
+    finally:
+        stop_logging()
+    assert "primero" in (tmp_path / 'a.log').read_text(encoding='utf-8')
+    assert "segundo" in (tmp_path / 'b.log').read_text(encoding='utf-8')
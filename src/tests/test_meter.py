@@ -0,0 +1,159 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+from meter import TripMeter, time_trip_info, distance_trip_info
+from fares import calculate_time_fare, calculate_distance_fare
+import config
+import time
+from datetime import datetime
+from fares import calculate_segment_nanos
+from schedule import local_seconds
+
+
+class FakeClock:
+    """Reloj controlado por el test."""
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+# =========================
+# Máquina de estados
+# =========================
+def test_meter_accumulates_states():
+    clock = FakeClock()
+    meter = TripMeter(clock)
+    meter.start()
+    clock.now += 10           # 10 s parado
+    meter.move()
+    clock.now += 20           # 20 s en movimiento
+    assert meter.elapsed() == (10, 20)
+    assert meter.current_fare() == calculate_time_fare(10, 20)
+    meter.stop()
+    clock.now += 5            # 5 s más parado
+    stopped, moving, fare = meter.finish()
+    assert (stopped, moving) == (15, 20)
+    assert fare == calculate_time_fare(15, 20)
+    assert not meter.active and meter.current_fare() == 0
+
+
+def test_finished_fare_matches_the_stored_record():
+    tariff = config.Tariff(base_fare=0.0, price_per_km=1.0, stopped_fare=0.02, moving_fare=0.05)
+    clock = FakeClock()
+    meter = TripMeter(clock)
+    meter.start(tariff=tariff)
+    meter.move()
+    clock.now += 10.096       # 50.48 céntimos sin redondear el tiempo; 10.1 s en el historial
+    stopped, moving, fare = meter.finish()
+    info = time_trip_info(stopped, moving, fare)
+    assert calculate_time_fare(0, 10.096, tariff) != fare
+    assert calculate_time_fare(info['tiempo_parado'], info['tiempo_movimiento'], tariff) == info['coste_total'] == fare
+
+
+def test_meter_invalid_transitions():
+    meter = TripMeter(FakeClock())
+    with pytest.raises(RuntimeError):
+        meter.stop()
+    with pytest.raises(RuntimeError):
+        meter.finish()
+    meter.start()
+    with pytest.raises(RuntimeError):
+        meter.start()
+
+
+# =========================
+# Tarifa en caché y recarga
+# =========================
+@pytest.fixture
+def env_file(tmp_path, monkeypatch):
+    """Usa un .env temporal y restaura la tarifa real al terminar."""
+    path = tmp_path / '.env'
+    path.write_text('BASE_FARE=1.5\nPRICE_PER_KM=0.25\nSTOPPED_FARE=0.02\nMOVING_FARE=0.05\n')
+    monkeypatch.setattr(config, 'ENV_FILE', str(path))
+    config.reload_tariff(force=True)
+    yield path
+    monkeypatch.undo()
+    config.reload_tariff(force=True)
+
+
+def test_trip_keeps_its_tariff(env_file):
+    clock = FakeClock()
+    events = []
+    meter = TripMeter(clock, listener=lambda *event: events.append(event))
+    meter.start()
+    old = meter.tariff
+    assert events[0][3] == old.version
+
+    # Nueva tarifa con otra fecha de modificación
+    env_file.write_text('BASE_FARE=1.5\nPRICE_PER_KM=0.25\nSTOPPED_FARE=0.04\nMOVING_FARE=0.10\n')
+    os.utime(env_file, ns=(0, (old.version + 1_000_000) * 1000))
+    assert config.reload_tariff()
+    assert not config.reload_tariff()  # sin cambios: solo un stat
+    new = config.current_tariff()
+    assert new.stopped_fare == 0.04 and new.version > old.version
+
+    # El viaje en curso sigue con la tarifa con la que empezó
+    clock.now += 10
+    assert meter.finish()[2] == calculate_time_fare(10, 0, old)
+    meter.start()
+    clock.now += 10
+    assert meter.finish()[2] == calculate_time_fare(10, 0, new) == 0.4
+
+
+def test_meter_prices_time_bands(env_file):
+    with open(env_file, 'a') as f:
+        f.write('BAND_NOCHE=mon-sun 22:00-06:00 0.03 0.07\n')
+        f.write('BAND_MALA=mon-sun 25:00-06:00 0.03 0.07\n')   # no válida: se ignora
+        f.write('HOLIDAYS=2026-12-25,no-es-fecha\n')
+    config.reload_tariff(force=True)
+    tariff = config.current_tariff()
+    assert [band.name for band in tariff.bands] == ['noche']
+    assert len(tariff.holidays) == 1
+
+    # Viaje de 21:00 a 01:00: 1 h parado de día, 1 h parado de noche, 2 h en movimiento de noche
+    clock = FakeClock()
+    meter = TripMeter(clock, wall_clock=lambda: time.mktime(datetime(2026, 10, 14, 21).timetuple()))
+    meter.start()
+    clock.now += 2 * 3600
+    assert meter.current_fare() == 180.0
+    meter.move()
+    clock.now += 2 * 3600
+    stopped, moving, fare = meter.finish()
+    assert (stopped, moving) == (7200, 7200)
+    assert fare == 684.0
+    start = local_seconds(datetime(2026, 10, 14, 21))
+    nanos = calculate_segment_nanos(start, start + 7200, False) + calculate_segment_nanos(start + 7200, start + 14400, True)
+    assert fare * 10**9 == nanos
+
+
+def test_process_environment_wins_and_removed_keys_are_dropped(env_file, monkeypatch):
+    monkeypatch.setenv('MOVING_FARE', '0.09')
+    env_file.write_text('BASE_FARE=1.5\nPRICE_PER_KM=0.5\nSTOPPED_FARE=0.02\nMOVING_FARE=0.05\n'
+                        'BAND_NOCHE=mon-sun 22:00-06:00 0.03 0.07\n')
+    config.reload_tariff(force=True)
+    tariff = config.current_tariff()
+    assert (tariff.price_per_km, tariff.moving_fare) == (0.5, 0.09)
+    assert [band.name for band in tariff.bands] == ['noche']
+
+    # Quitadas del .env: dejan de aplicarse al recargar, la del entorno se mantiene
+    env_file.write_text('BASE_FARE=1.5\nSTOPPED_FARE=0.02\n')
+    config.reload_tariff(force=True)
+    tariff = config.current_tariff()
+    assert (tariff.price_per_km, tariff.moving_fare, tariff.bands) == (0.25, 0.09, ())
+    assert 'PRICE_PER_KM' not in os.environ and 'BAND_NOCHE' not in os.environ
+
+
+# =========================
+# Registros de historial
+# =========================
+def test_trip_info():
+    info = time_trip_info(10.004, 20.0, 1.2049)
+    assert (info['tipo'], info['duracion_total'], info['coste_total']) == ('tiempo', 30.0, 1.2)
+
+    fare, info = distance_trip_info(5)
+    assert fare == calculate_distance_fare(5)
+    assert (info['tipo'], info['distancia_total']) == ('distancia', 5)
+    with pytest.raises(ValueError):
+        distance_trip_info(0)
@@ -0,0 +1,82 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import urllib.request
+import metrics
+from metrics import Histogram, REGISTRY, timed, timer, serve, write_textfile
+
+
+@pytest.fixture
+def registry():
+    REGISTRY.clear()
+    yield REGISTRY
+    REGISTRY.clear()
+
+
+def test_histogram_buckets_and_quantile():
+    histogram = Histogram()
+    for _ in range(90):
+        histogram.observe(0.0003)   # bucket (0.00025, 0.0005]
+    for _ in range(10):
+        histogram.observe(0.2)      # bucket (0.1, 0.25]
+    assert histogram.count == 100
+    assert histogram.sum == pytest.approx(90 * 0.0003 + 10 * 0.2)
+    assert 0.00025 < histogram.quantile(0.5) <= 0.0005
+    assert 0.1 < histogram.quantile(0.99) <= 0.25
+    assert Histogram().quantile(0.5) is None
+
+
+def test_timed_counts_calls_and_errors(registry, monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+
+    @timed('fare_calculation_seconds', kind='prueba')
+    def fare(x):
+        if x < 0:
+            raise ValueError(x)
+        return x * 2
+
+    assert fare(3) == 6
+    with pytest.raises(ValueError):
+        fare(-1)
+    with timer('taximeter_command_seconds', command='start'):
+        pass
+
+    text = registry.render()
+    assert '# TYPE fare_calculation_seconds histogram' in text
+    assert 'fare_calculation_seconds_bucket{kind="prueba",le="+Inf"} 2' in text
+    assert 'fare_calculation_seconds_count{kind="prueba"} 2' in text
+    assert 'fare_calculation_errors_total{kind="prueba"} 1' in text
+    assert 'taximeter_command_seconds_count{command="start"} 1' in text
+
+
+def test_disabled_instrumentation_is_a_no_op(registry, monkeypatch):
+    monkeypatch.setattr(metrics, 'ENABLED', False)
+
+    def fare(x):
+        return x
+
+    assert timed('fare_calculation_seconds')(fare) is fare
+    with timer('taximeter_command_seconds', command='start'):
+        pass
+    assert registry.render() == "\n"
+
+
+def test_exporters(registry, monkeypatch, tmp_path):
+    monkeypatch.setattr(metrics, 'ENABLED', True)
+    with timer('history_save_seconds'):
+        pass
+
+    path = str(tmp_path / 'metrics.prom')
+    write_textfile(path)
+    with open(path, encoding='utf-8') as f:
+        assert 'history_save_seconds_count 1' in f.read()
+
+    server = serve(0)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/metrics"
+        with urllib.request.urlopen(url, timeout=5) as response:
+            assert response.status == 200
+            assert 'history_save_seconds_count 1' in response.read().decode('utf-8')
+    finally:
+        server.shutdown()
+        server.server_close()
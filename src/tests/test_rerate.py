@@ -0,0 +1,144 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import json
+from datetime import datetime, timedelta
+from config import Tariff
+from fares import calculate_time_fare, calculate_distance_fare
+from storage import TextBackend, SQLiteBackend
+from rerate import rerate, plan_chunks
+
+OLD = Tariff(base_fare=1.5, price_per_km=0.25, stopped_fare=0.02, moving_fare=0.05)
+NEW = Tariff(base_fare=2.0, price_per_km=0.30, stopped_fare=0.03, moving_fare=0.05)
+
+
+def make_trips(n=400):
+    trips = []
+    fecha = datetime(2024, 3, 1, 8, 0, 0)
+    for i in range(n):
+        fecha += timedelta(minutes=17)
+        if i % 3:
+            stopped, moving = i % 50 + 0.5, i % 70 + 0.25
+            trips.append({'fecha': fecha, 'tipo': 'tiempo', 'tiempo_parado': stopped,
+                          'tiempo_movimiento': moving, 'duracion_total': stopped + moving,
+                          'coste_total': calculate_time_fare(stopped, moving, OLD)})
+        else:
+            km = i % 13 + 0.4
+            trips.append({'fecha': fecha, 'tipo': 'distancia', 'distancia_total': km,
+                          'coste_total': calculate_distance_fare(km, OLD)})
+    return trips
+
+
+def expected(trips):
+    totals = {}
+    for t in trips:
+        if t['tipo'] == 'tiempo':
+            new = calculate_time_fare(t['tiempo_parado'], t['tiempo_movimiento'], NEW)
+        else:
+            new = calculate_distance_fare(t['distancia_total'], NEW)
+        total = totals.setdefault((t['fecha'].date().isoformat(), t['tipo']), [0, 0, 0])
+        total[0] += 1
+        total[1] += round(t['coste_total'] * 100)
+        total[2] += round(new * 100)
+    return totals
+
+
+@pytest.mark.parametrize("backend_class, name", [(TextBackend, 'historial.txt'), (SQLiteBackend, 'historial.db')])
+def test_rerate_matches_trip_by_trip(tmp_path, backend_class, name):
+    trips = make_trips()
+    path = str(tmp_path / name)
+    backend = backend_class(path)
+    backend.append_many(trips)
+    backend.sync()
+    backend.close()
+
+    tasks = plan_chunks(path, chunk_bytes=4096, chunk_rows=50)
+    assert len(tasks) > 4
+    totals, errors = rerate(path, NEW, workers=2, chunk_bytes=4096, chunk_rows=50, out=io.StringIO())
+    assert errors == 0
+    assert totals == expected(trips)
+
+
+def test_rerate_reads_compressed_segments(tmp_path):
+    trips = make_trips()
+    path = str(tmp_path / 'historial.txt')
+    backend = TextBackend(path, segment_bytes=8192)
+    for first in range(0, len(trips), 10):
+        backend.append_many(trips[first:first + 10])
+    backend.close()
+
+    tasks = plan_chunks(path, chunk_bytes=4096)
+    sealed = TextBackend(path).segments.load()
+    assert len(sealed) > 2 and all(segment['comprimido'] for segment in sealed)
+    # Los segmentos comprimidos van enteros; el activo, con el número que tendrá al cerrarse
+    assert [task[4] for task in tasks[:len(sealed)]] == [segment['id'] for segment in sealed]
+    assert tasks[-1][4] == sealed[-1]['id'] + 1
+    totals, errors = rerate(path, NEW, workers=2, chunk_bytes=4096, out=io.StringIO())
+    assert errors == 0
+    assert totals == expected(trips)
+
+
+def test_rerate_resumes_from_checkpoint(tmp_path):
+    path = str(tmp_path / 'historial.db')
+    backend = SQLiteBackend(path)
+    backend.append_many(make_trips())
+    backend.close()
+    checkpoint = str(tmp_path / 'rerate.jsonl')
+    full, _ = rerate(path, NEW, workers=1, checkpoint=checkpoint, chunk_rows=50, out=io.StringIO())
+
+    # Simula una caída: quedan 3 bloques terminados y una línea cortada
+    with open(checkpoint, encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(checkpoint, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:4])
+        f.write(lines[4][:20])
+    out = io.StringIO()
+    resumed, _ = rerate(path, NEW, workers=1, checkpoint=checkpoint, chunk_rows=50, out=out)
+    assert out.getvalue().startswith("Reanudando: 3 de 8 bloques")
+    assert resumed == full
+
+    # Los trayectos añadidos después no invalidan lo ya hecho: se reanuda con los mismos bloques
+    with open(checkpoint, encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(checkpoint, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:4])
+    backend = SQLiteBackend(path)
+    backend.append_many(make_trips(30))
+    backend.close()
+    out = io.StringIO()
+    resumed, _ = rerate(path, NEW, workers=1, checkpoint=checkpoint, chunk_rows=50, out=out)
+    assert out.getvalue().startswith("Reanudando: 3 de 8 bloques")
+    assert resumed == full
+
+    # Con otra tarifa el archivo de control no sirve y se empieza de cero
+    out = io.StringIO()
+    rerate(path, OLD, workers=1, checkpoint=checkpoint, chunk_rows=50, out=out)
+    assert "Reanudando" not in out.getvalue()
+    with open(checkpoint, encoding='utf-8') as f:
+        # Plan nuevo: ya incluye los 30 trayectos añadidos (430 en bloques de 50)
+        assert len([json.loads(line) for line in f]) == 1 + 9
+
+
+def test_rerate_resumes_after_the_active_segment_is_sealed(tmp_path):
+    trips = make_trips()
+    path = str(tmp_path / 'historial.txt')
+    backend = TextBackend(path, segment_bytes=1 << 20)
+    backend.append_many(trips[:200])
+    checkpoint = str(tmp_path / 'rerate.jsonl')
+    full, _ = rerate(path, NEW, workers=1, checkpoint=checkpoint, chunk_bytes=4096, out=io.StringIO())
+    assert full == expected(trips[:200])
+    with open(checkpoint, encoding='utf-8') as f:
+        lines = f.readlines()
+    with open(checkpoint, 'w', encoding='utf-8') as f:
+        f.writelines(lines[:3])
+
+    # El historial.txt de la primera ejecución se cierra (y se comprime) y sigue creciendo
+    backend.segment_bytes = 1
+    backend.append_many(trips[200:])
+    backend.close()
+    assert backend.segments.load()[0]['comprimido']
+    out = io.StringIO()
+    resumed, errors = rerate(path, NEW, workers=1, checkpoint=checkpoint, chunk_bytes=4096, out=out)
+    assert out.getvalue().startswith("Reanudando: 2 de")
+    assert errors == 0 and resumed == full
@@ -0,0 +1,104 @@
+import pytest
+import sys, os
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+import io
+import threading
+import numpy as np
+from config import Tariff
+from fares import calculate_time_fare, calculate_distance_fare
+from telemetry import (GpsPipeline, haversine_km, parse_block, run, listen, accept_stream,
+                       replay, TRIP_OUTPUT)
+
+TARIFF = Tariff(base_fare=2.5, price_per_km=1.2, stopped_fare=0.02, moving_fare=0.05)
+T0 = 1_700_000_000.0
+METERS = 1 / 111195.0  # grados de latitud por metro
+
+
+def cab_fixes(trip_id, seed=0, t0=T0):
+    '''
+    Un taxi que espera 60 s, recorre 3 km en línea recta a 36 km/h y espera 30 s,
+    con ruido de 3 m en cada posición y un pico del GPS a mitad del viaje.
+    '''
+    rng = np.random.default_rng(seed)
+    x = np.r_[np.zeros(60), np.arange(1, 301) * 10.0, np.full(30, 3000.0)]
+    t = t0 + np.arange(len(x), dtype=np.float64)
+    lat = 40.0 + (x + rng.normal(0, 3, len(x))) * METERS
+    lon = -3.7 + rng.normal(0, 3, len(x)) * METERS
+    lat[200] += 0.05
+    return np.full(len(x), trip_id), t, lat, lon
+
+
+def as_text(columns, ends=()):
+    lines = [f"{i},{t:.1f},{lat:.7f},{lon:.7f}" for i, t, lat, lon in zip(*columns)]
+    lines += [f"{i},{t:.1f},fin" for i, t in ends]
+    return ("\n".join(lines) + "\n").encode('utf-8')
+
+
+def test_haversine():
+    assert haversine_km(40.0, -3.7, 41.0, -3.7) == pytest.approx(111.19, abs=0.01)
+    # Madrid - Barcelona
+    assert haversine_km(np.array([40.4168]), np.array([-3.7038]),
+                        np.array([41.3874]), np.array([2.1686]))[0] == pytest.approx(505, abs=2)
+
+
+def test_pipeline_filters_noise_and_drives_both_fares():
+    pipeline = GpsPipeline(tariff=TARIFF, moving_speed=5, max_speed=200, window=10)
+    assert pipeline.feed(*cab_fixes(7)) == []
+    [trip] = pipeline.feed([], [], [], [], ends=[(7, T0 + 390)])
+    assert trip['cierre'] == 'fin' and trip['posiciones'] == 390 and trip['descartadas'] == 1
+    # 3 km recorridos: ni el ruido parado ni el pico suman distancia
+    assert trip['distancia_total'] == pytest.approx(3.0, rel=0.03)
+    assert trip['tiempo_parado'] + trip['tiempo_movimiento'] == pytest.approx(390)
+    assert trip['tiempo_movimiento'] == pytest.approx(300, abs=15)
+    assert trip['coste_tiempo'] == calculate_time_fare(trip['tiempo_parado'], trip['tiempo_movimiento'], TARIFF)
+    assert trip['coste_distancia'] == calculate_distance_fare(trip['distancia_total'], TARIFF)
+    assert len(pipeline) == 0
+
+
+def test_blocks_late_fixes_and_timeouts():
+    columns = cab_fixes(1)
+    pipeline = GpsPipeline(tariff=TARIFF, window=10, trip_timeout=60)
+    # Posiciones repetidas o atrasadas se descartan
+    pipeline.feed(*(c[:100] for c in columns))
+    pipeline.feed(*(c[90:] for c in columns))
+    assert pipeline.dropped[pipeline.slots[1]] == 10 + 1
+    # Otro taxi mucho después: el primero se da por terminado por inactividad
+    [idle] = pipeline.feed([2], [T0 + 1000], [40.0], [-3.7])
+    assert idle['id'] == 1 and idle['cierre'] == 'inactivo'
+    assert [trip['cierre'] for trip in pipeline.close()] == ['fin de datos']
+
+
+def test_run_parses_text_in_any_block_size():
+    data = b"id_viaje,timestamp,lat,lon\n" + as_text(cab_fixes(3), ends=[(3, T0 + 390)]) + b"3,no,es,valida\n"
+    results = []
+    for chunk_bytes in (1 << 20, 64 * 1024):
+        out, err = io.StringIO(), io.StringIO()
+        assert run(io.BytesIO(data), out=out, err=err, chunk_bytes=chunk_bytes,
+                   pipeline=GpsPipeline(tariff=TARIFF, window=10)) == (1, 1)
+        header, row = out.getvalue().splitlines()
+        assert header.split(',') == list(TRIP_OUTPUT)
+        results.append(row)
+        assert "valida" in err.getvalue()
+    assert results[0] == results[1]
+
+    ids, t, lat, lon, ends, errors = parse_block(b"5,10.0,40.1,-3.2\n5,11.0,fin\n")
+    assert ids.tolist() == [5] and ends == [(5, 11.0)] and errors == []
+    # Una línea de 3 campos junto a una de 5 no debe desplazar las posiciones siguientes
+    ids, t, lat, lon, ends, errors = parse_block(b"1,10,40.1\n1,11,40.2,-3.7,9\n2,12,40.3,-3.6\n")
+    assert ids.tolist() == [2] and lat.tolist() == [40.3] and len(errors) == 2
+
+
+def test_socket_replay(tmp_path):
+    path = tmp_path / 'posiciones.csv'
+    path.write_bytes(as_text(cab_fixes(4), ends=[(4, T0 + 390)]))
+    server = listen(f"unix:{tmp_path / 'gps.sock'}")
+    sender = threading.Thread(target=replay, args=(str(path), f"unix:{tmp_path / 'gps.sock'}"))
+    sender.start()
+    stream = accept_stream(server)
+    out = io.StringIO()
+    try:
+        assert run(stream, out=out, pipeline=GpsPipeline(tariff=TARIFF)) == (1, 0)
+    finally:
+        stream.close()
+        sender.join()
+    assert out.getvalue().splitlines()[1].startswith("4,")
@@ -0,0 +1,201 @@
+import zlib
+from datetime import datetime
+
+# =========================
+# Formato de los registros
+# =========================
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+SEPARATOR = "=============================="
+# Línea de control tras el separador de apertura: 'Control: <bytes> <crc32>' del cuerpo
+CONTROL = 'Control'
+_CONTROL_LABEL = CONTROL + ':'
+
+# Campos de un trayecto (mismas claves que trip_info)
+FIELDS = (
+    'fecha', 'tipo', 'distancia_total', 'tiempo_parado',
+    'tiempo_movimiento', 'duracion_total', 'coste_total',
+)
+
+
+def format_date(value):
+    """Convierte un datetime (o texto ya formateado) al formato del historial."""
+    if isinstance(value, datetime):
+        # Equivale a strftime(DATE_FORMAT), pero bastante más rápido
+        return value.isoformat(' ', 'seconds')
+    return value
+
+
+def format_block(trip_info):
+    """
+    Devuelve el bloque de texto legible de un trayecto, con el formato de
+    siempre de historial.txt más una línea de control (longitud en bytes y
+    CRC-32 del cuerpo) con la que los lectores detectan bloques cortados o
+    mezclados con los de otro proceso.
+    """
+    lines = [f"Fecha: {format_date(trip_info['fecha'])}"]
+    lines.append(f"Tipo de trayecto: {trip_info['tipo']}")
+
+    if trip_info['tipo'] == 'distancia':
+        lines.append(f"Distancia: {trip_info['distancia_total']} km")
+
+    if trip_info['tipo'] == 'tiempo':
+        lines.append(f"Tiempo parado: {trip_info['tiempo_parado']} segundos")
+        lines.append(f"Tiempo en movimiento: {trip_info['tiempo_movimiento']} segundos")
+        lines.append(f"Duración total: {trip_info['duracion_total']} segundos")
+
+    lines.append(f"Coste total: {trip_info['coste_total']} €")
+    body = "\n".join(lines) + "\n"
+    data = body.encode('utf-8')
+    return f"\n{SEPARATOR}\n{CONTROL}: {len(data)} {zlib.crc32(data):08x}\n{body}{SEPARATOR}\n"
+
+
+def parse_control(value):
+    """Valor de la línea de control -> (longitud, crc), o None si no es válido."""
+    try:
+        length, crc = value.split()
+        return int(length), int(crc, 16)
+    except ValueError:
+        return None
+
+
+def _parse_date(value):
+    # fromisoformat es mucho más rápido que strptime para este formato fijo
+    if len(value) != 19 or value[10] != ' ':
+        raise ValueError(value)
+    return datetime.fromisoformat(value)
+
+
+def _number(suffix):
+    """Conversor de un valor numérico que puede terminar en una unidad."""
+    def convert(value):
+        if value.endswith(suffix):
+            value = value[:-len(suffix)]
+        return float(value)
+    return convert
+
+
+# Etiqueta del texto -> (clave del trayecto, conversor del valor)
+_LABELS = {
+    'Fecha': ('fecha', _parse_date),
+    'Tipo de trayecto': ('tipo', str),
+    'Distancia': ('distancia_total', _number(' km')),
+    'Tiempo parado': ('tiempo_parado', _number(' segundos')),
+    'Tiempo en movimiento': ('tiempo_movimiento', _number(' segundos')),
+    'Duración total': ('duracion_total', _number(' segundos')),
+    'Coste total': ('coste_total', _number(' €')),
+}
+
+
+# Campos obligatorios según el tipo de trayecto
+REQUIRED = {
+    'tiempo': ('tiempo_parado', 'tiempo_movimiento', 'duracion_total'),
+    'distancia': ('distancia_total',),
+}
+
+
+def _check(trip):
+    """Devuelve el motivo por el que un trayecto está incompleto, o None si es válido."""
+    for key in ('fecha', 'tipo', 'coste_total'):
+        if key not in trip:
+            return f"falta el campo '{key}'"
+    if trip['tipo'] not in REQUIRED:
+        return f"tipo de trayecto desconocido '{trip['tipo']}'"
+    for key in REQUIRED[trip['tipo']]:
+        if key not in trip:
+            return f"falta el campo '{key}'"
+    return None
+
+
+def parse_blocks(lines, on_error=None):
+    """
+    Lee bloques de texto del historial (en streaming, con memoria constante)
+    y devuelve un trayecto (dict con tipos ya convertidos) por bloque válido.
+    Los bloques mal formados no detienen la lectura: se saltan y, si se indica
+    on_error, se llama on_error(numero_de_linea, motivo) por cada uno.
+    Los bloques con línea de control se comprueban enteros; los de historiales
+    antiguos (sin ella) solo por su estructura.
+    """
+    trip = None
+    first_line = 0
+    error = None
+    frame = None   # [longitud, crc, líneas del cuerpo] del bloque con control en curso
+
+    def report(number, message):
+        if on_error is not None:
+            on_error(number, message)
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if line == SEPARATOR:
+            if trip is None:
+                trip, first_line, error, frame = {}, number, None, None
+                continue
+            if frame is not None:
+                body = ("\n".join(frame[2]) + "\n").encode('utf-8')
+                if len(body) != frame[0]:
+                    # Escritura cortada: este separador ya abre el bloque siguiente
+                    report(first_line, "bloque cortado")
+                    trip, first_line, error, frame = {}, number, None, None
+                    continue
+                if zlib.crc32(body) != frame[1]:
+                    error = error or "suma de control incorrecta"
+            problem = error or _check(trip)
+            if problem is None:
+                yield trip
+            else:
+                report(first_line, problem)
+            trip = frame = None
+            continue
+        if not line:
+            if frame is not None:
+                # Un bloque con control no tiene líneas vacías: se cortó antes de cerrarse
+                report(first_line, "bloque cortado")
+                trip = frame = None
+            continue
+        label, _, value = line.partition(': ')
+        if trip is None:
+            if label != 'Fecha':
+                report(number, "texto fuera de un bloque")
+                continue
+            # Bloque sin separador de apertura (p. ej. tras un bloque cortado)
+            trip, first_line, error, frame = {}, number, None, None
+        elif not trip and frame is None and line.startswith(_CONTROL_LABEL):
+            # Una línea de control incompleta no cuadra con ninguna longitud: el bloque está cortado
+            frame = [*(parse_control(line[len(_CONTROL_LABEL):].strip()) or (-1, 0)), []]
+            continue
+        elif label == 'Fecha' and 'fecha' in trip:
+            # Empieza otro trayecto sin haber cerrado el anterior
+            report(first_line, "bloque sin cerrar")
+            trip, first_line, error, frame = {}, number, None, None
+        if frame is not None:
+            frame[2].append(line)
+        if label not in _LABELS:
+            error = error or f"línea no reconocida '{line}'"
+            continue
+        key, convert = _LABELS[label]
+        try:
+            trip[key] = convert(value)
+        except ValueError:
+            error = error or f"valor no válido en '{line}'"
+    if trip is not None:
+        report(first_line, "bloque sin cerrar al final del archivo")
+
+
+def read_trips(path, on_error=None, on_progress=None):
+    """
+    Generador de trayectos de un archivo historial.txt, sin cargarlo en memoria.
+    on_progress(bytes_leidos) se llama cada pocos MB para informar del avance.
+    """
+    step = 8 * 1024 * 1024
+    with open(path, 'r', encoding='utf-8', errors='replace', buffering=1024 * 1024) as f:
+        if on_progress is None:
+            yield from parse_blocks(f, on_error)
+            return
+        next_report = step
+        for trip in parse_blocks(f, on_error):
+            yield trip
+            done = f.buffer.tell()
+            if done >= next_report:
+                on_progress(done)
+                next_report = done + step
+        on_progress(f.buffer.tell())
@@ -0,0 +1,115 @@
+import atexit
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+DURABILITY_POLICIES = ('none', 'flush', 'fsync')
+
+# Marca para que el hilo escritor termine
+_STOP = object()
+
+
+class HistoryWriter:
+    """
+    Escritor en segundo plano del historial (group commit).
+    Acumula los trayectos en una cola y los escribe por lotes,
+    cuando se llena el lote o cuando pasa flush_interval segundos.
+    """
+
+    def __init__(self, backend, batch_size=100, flush_interval=0.5, durability='flush'):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Política de durabilidad no válida: {durability}")
+        self.backend = backend
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.backend.set_durability(durability)
+        self.queue = queue.Queue()
+        self.closed = False
+        # Protege closed y el orden en la cola: nada se encola detrás de _STOP
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self._run, name="history-writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def submit(self, trip_info):
+        """
+        Encola un trayecto y devuelve un Future que se completa
+        cuando el lote que lo contiene está escrito.
+        Lanza RuntimeError si el escritor ya está cerrado.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("El escritor del historial está cerrado")
+            self.queue.put((trip_info, future))
+        return future
+
+    def flush(self, timeout=None):
+        """Espera a que todo lo encolado hasta ahora esté escrito."""
+        future = Future()
+        with self.lock:
+            if self.closed:
+                return
+            self.queue.put((None, future))
+        future.result(timeout)
+
+    def close(self):
+        """Escribe lo pendiente y detiene el hilo escritor."""
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.queue.put(_STOP)
+        self.thread.join()
+
+    # =========================
+    # Hilo escritor
+    # =========================
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.flush_interval
+            # Espera a más trayectos hasta llenar el lote o agotar el tiempo
+            while len(batch) < self.batch_size and item[0] is not None:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+            self._write(batch)
+        # Vaciar lo que quede en la cola antes de salir
+        pending = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not _STOP:
+                pending.append(item)
+        if pending:
+            self._write(pending)
+
+    def _write(self, batch):
+        trips = [trip for trip, _ in batch if trip is not None]
+        try:
+            if trips:
+                self.backend.append_many(trips)
+                self.backend.sync()
+        except Exception as e:
+            print(f"Error al guardar el historial: {e}")
+            for _, future in batch:
+                future.set_exception(e)
+            return
+        for _, future in batch:
+            future.set_result(None)